@@ -24,7 +24,7 @@
 # *
 # **************************************************************************
 
-import pwem, os
+import pwem, os, socket, tempfile
 from subprocess import check_call
 from os.path import join, exists
 from .constants import *
@@ -34,17 +34,48 @@ _logo = "blast_logo.png"
 _references = ['']
 
 BLAST_DIC = {'name': 'blast', 'version': '2.12.0', 'home': 'BLAST_HOME'}
+NCBI_DIC = {'eutils': 'NCBI_EUTILS_URL', 'pubchem': 'PUBCHEM_URL', 'apiKey': 'NCBI_API_KEY'}
+STORE_DIC = {'quota': 'BLAST_DB_QUOTA'}
+STAGING_DIC = {'scratch': 'BLAST_SCRATCH_DIR', 'quota': 'BLAST_SCRATCH_QUOTA'}
+SCHEDULER_DIC = {'ioBandwidth': 'BLAST_IO_BANDWIDTH', 'coldLoads': 'BLAST_COLD_LOADS',
+                 'stateDir': 'BLAST_SCHEDULER_DIR'}
 
 class Plugin(pwem.Plugin):
     _homeVar = BLAST_DIC['home']
     _pathVars = [BLAST_DIC['home']]
     _supportedVersions = [BLAST_DIC['version']]
+    _localDatabases = None
 
     @classmethod
     def _defineVariables(cls):
         """ Return and write a variable in the config file.
         """
         cls._defineEmVar(BLAST_DIC['home'], BLAST_DIC['name'] + '-' + BLAST_DIC['version'])
+        cls._defineVar(NCBI_DIC['eutils'], 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils',
+                       description='Base URL of the NCBI E-utilities')
+        cls._defineVar(NCBI_DIC['pubchem'], 'https://pubchem.ncbi.nlm.nih.gov/rest/pug',
+                       description='Base URL of the PubChem PUG REST service')
+        cls._defineVar(NCBI_DIC['apiKey'], '', description='NCBI API key, raising the E-utilities request rate limit')
+        cls._defineVar(STORE_DIC['quota'], '',
+                       description='Disk quota (GB) of the database snapshots. Unreferenced old snapshots are '
+                                   'deleted, least recently used first, while it is exceeded (all of them if empty)')
+        cls._defineVar(STAGING_DIC['scratch'], '',
+                       description='Node-local scratch directory where the local databases are copied before being '
+                                   'searched, shared by the jobs of the node. If empty, the databases are searched '
+                                   'where they are stored')
+        cls._defineVar(STAGING_DIC['quota'], '',
+                       description='Disk quota (GB) of the databases staged in the scratch directory. The least '
+                                   'recently used ones are evicted when exceeded (or when the disk is full if empty)')
+        cls._defineVar(SCHEDULER_DIC['ioBandwidth'], '',
+                       description='Disk read bandwidth (MB/s) of the databases, used by the host admission to '
+                                   'estimate how long a search takes to load a database not in memory (200 if empty)')
+        cls._defineVar(SCHEDULER_DIC['coldLoads'], '',
+                       description='Maximum number of searches admitted in the host while loading a database not in '
+                                   'memory from disk (2 if empty)')
+        cls._defineVar(SCHEDULER_DIC['stateDir'], '',
+                       description='Node-local directory with the state of the host admission of local searches, '
+                                   'kept in a subdirectory per host name. If empty, the temporary directory of '
+                                   'the node is used')
 
     @classmethod
     def defineBinaries(cls, env):
@@ -71,9 +102,18 @@ class Plugin(pwem.Plugin):
 
 
     @classmethod
-    def runBLAST(cls, protocol, program, args, cwd=None):
-        """ Run BLAST program commands from a given protocol. """
-        protocol.runJob(join(cls.getVar(BLAST_DIC['home']), 'bin', program), args, cwd=cwd)
+    def runBLAST(cls, protocol, program, args, cwd=None, blastDB=None):
+        """ Run BLAST program commands from a given protocol. If blastDB, it is the directory where BLAST looks
+        for the databases (BLASTDB), e.g: a staged copy in scratch """
+        if blastDB is None:
+            protocol.runJob(cls.getProgramPath(program), args, cwd=cwd)
+        else:
+            env = dict(os.environ, BLASTDB=blastDB)
+            protocol.runJob(cls.getProgramPath(program), args, cwd=cwd, env=env)
+
+    @classmethod
+    def getProgramPath(cls, program):
+        return join(cls.getVar(BLAST_DIC['home']), 'bin', program)
 
     @classmethod
     def updateDatabase(cls, protocol, args, cwd=None):
@@ -105,14 +145,103 @@ class Plugin(pwem.Plugin):
     def getDatabasesDir(cls):
         return os.path.abspath(os.path.join(cls.getVar(BLAST_DIC['home']), 'databases'))
 
+    @classmethod
+    def getPSSMCacheDir(cls):
+        return os.path.abspath(os.path.join(cls.getVar(BLAST_DIC['home']), 'pssm_cache'))
+
+    @classmethod
+    def getEutilsURL(cls):
+        return cls.getVar(NCBI_DIC['eutils'])
+
+    @classmethod
+    def getPubChemURL(cls):
+        return cls.getVar(NCBI_DIC['pubchem'])
+
+    @classmethod
+    def getNCBIApiKey(cls):
+        return cls.getVar(NCBI_DIC['apiKey'])
+
+    @classmethod
+    def getSchedulerDir(cls):
+        '''Directory with the state of the host admission of local searches, shared by all the BLAST runs of the
+        host. It is keyed by the host name so that hosts sharing the directory (e.g: NFS) do not mix their runs'''
+        stateDir = cls.getVar(SCHEDULER_DIC['stateDir'])
+        stateDir = os.path.expandvars(stateDir) if stateDir else os.path.join(tempfile.gettempdir(),
+                                                                              'scipion-blast-scheduler')
+        return os.path.abspath(os.path.join(stateDir, socket.gethostname()))
+
+    @classmethod
+    def getIOBandwidth(cls):
+        '''Disk read bandwidth of the databases in bytes/s, or None if not set'''
+        bandwidth = cls.getVar(SCHEDULER_DIC['ioBandwidth'])
+        return float(bandwidth) * 1024 ** 2 if bandwidth else None
+
+    @classmethod
+    def getMaxColdLoads(cls):
+        '''Maximum number of searches loading a non-resident database at the same time, or None if not set'''
+        coldLoads = cls.getVar(SCHEDULER_DIC['coldLoads'])
+        return int(coldLoads) if coldLoads else None
+
+    @classmethod
+    def getSearchAdmission(cls, dbName, nThreads=1, nQueries=1):
+        '''Context manager admitting a local search in the host (see scheduler.SearchAdmission)'''
+        from .scheduler import SearchAdmission
+        return SearchAdmission(dbName, cls.getDatabasesDir(), cls.getSchedulerDir(), nThreads, nQueries,
+                               ioBandwidth=cls.getIOBandwidth(), maxColdLoads=cls.getMaxColdLoads())
+
+    @classmethod
+    def getTimingsFile(cls):
+        '''Timings of the local searches of all the BLAST runs, used to calibrate the automatic tuning'''
+        return os.path.abspath(os.path.join(cls.getVar(BLAST_DIC['home']), 'tuning', 'timings.jsonl'))
+
+    @classmethod
+    def getStoreDir(cls):
+        '''Directory of the versioned snapshots of the local databases'''
+        return os.path.abspath(os.path.join(cls.getVar(BLAST_DIC['home']), 'db_store'))
+
+    @classmethod
+    def getDatabaseStore(cls):
+        from .store import DatabaseStore
+        return DatabaseStore(cls.getStoreDir(), cls.getDatabasesDir())
+
+    @classmethod
+    def getStoreQuota(cls):
+        '''Quota of the database store in bytes, or None if not set'''
+        quota = cls.getVar(STORE_DIC['quota'])
+        return float(quota) * 1024 ** 3 if quota else None
+
+    @classmethod
+    def getScratchDir(cls):
+        '''Node-local directory where the databases are staged before being searched, or None if not set'''
+        scratchDir = cls.getVar(STAGING_DIC['scratch'])
+        return os.path.abspath(os.path.expandvars(scratchDir)) if scratchDir else None
+
+    @classmethod
+    def getScratchQuota(cls):
+        '''Quota of the staged databases in bytes, or None if not set'''
+        quota = cls.getVar(STAGING_DIC['quota'])
+        return float(quota) * 1024 ** 3 if quota else None
+
+    @classmethod
+    def getStagedDatabase(cls, dbPath, staging=True):
+        '''Context manager with the path of a node-local copy of a database (see staging.StagedDatabase)'''
+        from .staging import StagedDatabase
+        scratchDir = cls.getScratchDir() if staging else None
+        return StagedDatabase(dbPath, cls.getDatabasesDir(), scratchDir, cls.getScratchQuota())
+
     @classmethod
     def getLocalDatabases(cls):
-        databases = set([])
-        for file in os.listdir(cls.getDatabasesDir()):
-            databases.add(file.split('.')[0])
-        databases = list(databases)
-        if databases == []:
-            databases = ['None found']
-        databases.sort()
-        return databases
+        """ Names of the databases in the databases directory. It is only listed when needed (database wizard and
+        validation), and again only if the directory changed. A missing directory has no databases. """
+        dbDir = cls.getDatabasesDir()
+        mtime = os.path.getmtime(dbDir) if os.path.isdir(dbDir) else None
+        if cls._localDatabases is None or cls._localDatabases[0] != mtime:
+            databases = set([])
+            if mtime is not None:
+                for file in os.listdir(dbDir):
+                    if not file.startswith('.'):
+                        databases.add(file.split('.')[0])
+            cls._localDatabases = (mtime, sorted(databases))
+
+        return list(cls._localDatabases[1])
 
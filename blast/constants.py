@@ -104,8 +104,30 @@ DEF_BLAST_PARAMS = {'blastn': {'word_size': '11', 'reward': '2', 'penalty': '-3'
                     'tblastx': {'word_size': '3', 'matrix': 4},
                     }
 
-
-
-
-
-
+#Tabular hit table: BLAST -outfmt 6 fields and their numpy types. The string widths of the tables are minimums,
+#widened to fit the parsed ids (getFittedDtype)
+HIT_TABLE_DTYPE = [('qseqid', 'U64'), ('sseqid', 'U64'), ('pident', 'f4'), ('length', 'i4'), ('mismatch', 'i4'),
+                   ('gaps', 'i4'), ('qstart', 'i4'), ('qend', 'i4'), ('sstart', 'i4'), ('send', 'i4'),
+                   ('evalue', 'f8'), ('bitscore', 'f4'), ('staxids', 'U32')]
+HIT_TABLE_FIELDS = [field[0] for field in HIT_TABLE_DTYPE]
+#Compact alignments: the BTOP string of each hit is stored in a side file, referenced by its position in it
+BTOP_DTYPE = [('btopStart', 'i8'), ('btopLength', 'i4')]
+#Exact Smith-Waterman score of the re-scored query-subject pairs (NaN if not re-scored)
+SW_SCORE_DTYPE = [('swscore', 'f4')]
+#Source database of the hits of multi-database searches
+DATABASE_DTYPE = [('database', 'U64')]
+#Hit index: rows of a hit table sorted by evalue (and bitscore), with the columns used to filter them
+HIT_INDEX_DTYPE = [('row', 'i8'), ('evalue', 'f8'), ('bitscore', 'f4'), ('pident', 'f4'), ('coverage', 'f4')]
+
+#Parameter sweep comparison table: one row per combination of parameters
+SWEEP_TABLE_DTYPE = [('label', 'U64'), ('evalue', 'U16'), ('word_size', 'U8'), ('matrix', 'U16'), ('gaps', 'U8'),
+                     ('matchMismatch', 'U8'), ('nHits', 'i4'), ('nPairs', 'i4'), ('nQueries', 'i4'),
+                     ('seconds', 'f4')]
+
+#Reciprocal best hits pair table
+PAIR_TABLE_DTYPE = [('seqA', 'U64'), ('seqB', 'U64'), ('bitscoreAB', 'f4'), ('evalueAB', 'f8'),
+                    ('bitscoreBA', 'f4'), ('evalueBA', 'f8')]
+
+#Database masking
+LOW_COMPLEXITY, REPEATS = 1, 2
+maskChoices = ['None', 'Low complexity (dustmasker / segmasker)', 'Repeats (windowmasker)']
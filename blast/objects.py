@@ -25,3 +25,187 @@
 # *
 # **************************************************************************
 
+
+from pwem.objects import EMFile
+import os
+from pyworkflow.object import Integer, String, Boolean
+
+
+class BLASTHitTable(EMFile):
+    """Columnar table of BLAST hits stored as a numpy .npy file.
+    Columns: qseqid, sseqid, pident, length, mismatch, gaps, qstart, qend, sstart, send, evalue, bitscore, staxids
+    and the position of the BTOP of each alignment in a side .btop file.
+    Optional columns: swscore (hits re-scored with Smith-Waterman) and database (multi-database searches)"""
+
+    def __init__(self, filename=None, **kwargs):
+        size = kwargs.pop('size', None)
+        database = kwargs.pop('database', None)
+        remote = kwargs.pop('remote', False)
+        isAminoacids = kwargs.pop('isAminoacids', True)
+        translatedQueries = kwargs.pop('translatedQueries', False)
+        EMFile.__init__(self, filename=filename, **kwargs)
+        self._size = Integer(size)
+        self._database = String(database)
+        self._remote = Boolean(remote)
+        self._isAminoacids = Boolean(isAminoacids)
+        self._translatedQueries = Boolean(translatedQueries)
+
+    def __str__(self):
+        return '{} ({} hits)'.format(self.getClassName(), self.getSize())
+
+    def getSize(self):
+        return self._size.get()
+
+    def setSize(self, size):
+        self._size.set(size)
+
+    def getDatabase(self):
+        return self._database.get()
+
+    def getDatabases(self):
+        '''Searched databases (several, comma separated, for multi-database searches): the paths of the store
+        snapshots searched, or the database names if they were not in the store'''
+        return self.getDatabase().split(',') if self.getDatabase() else []
+
+    def isRemote(self):
+        return self._remote.get()
+
+    def getSubjectsCacheFile(self):
+        return os.path.splitext(self.getFileName())[0] + '_subjects.fasta'
+
+    def getSubjectSequences(self, ids=None):
+        '''Returns a dictionary {subjectId: sequence} with the full subject sequences of the hits.
+        They are fetched in bulk from the searched database the first time and cached next to the table'''
+        from .utils import getCachedSequences
+        if ids is None:
+            ids = list(dict.fromkeys(self.getHits()['sseqid']))
+        return getCachedSequences(ids, self.getSubjectsCacheFile(), self.getDatabases(), remote=self.isRemote(),
+                                  isAmino=self._isAminoacids.get())
+
+    def getQueriesFile(self):
+        return os.path.splitext(self.getFileName())[0] + '_queries.fasta'
+
+    def getAlignments(self, hits=None):
+        '''Returns a list with the gapped (query, subject) strings of the hits (all by default), rebuilt on demand
+        from the query sequences and the compact alignment (BTOP) of each hit'''
+        from .utils import readFasta, readBtops, getAlignedStrings
+        hits = self.getHits() if hits is None else hits
+        querySeqs = readFasta(self.getQueriesFile())
+        return [getAlignedStrings(querySeqs[hit['qseqid']], hit['qstart'], hit['qend'], btop,
+                                  translate=self._translatedQueries.get())
+                for hit, btop in zip(hits, readBtops(self.getFileName(), hits))]
+
+    def getQueryAlignment(self, queryId):
+        '''Returns the row names and the query-anchored multiple alignment (numpy "S1" matrix) of a query
+        and its hits'''
+        from .utils import readFasta, readBtops, buildQueryAnchoredMSA
+        if self._translatedQueries.get():
+            raise ValueError('Query-anchored alignments are not available for translated queries (blastx, tblastx)')
+        hits = self.filterHits(queryId=queryId)
+        names = [queryId] + ['{}/{}-{}'.format(hit['sseqid'], hit['sstart'], hit['send']) for hit in hits]
+        msa = buildQueryAnchoredMSA(readFasta(self.getQueriesFile())[queryId], hits['qstart'],
+                                    readBtops(self.getFileName(), hits))
+        return names, msa
+
+    def exportAlignment(self, queryId, outFile, fmt='fasta'):
+        '''Writes the query-anchored alignment of a query and its hits in FASTA or Clustal (fmt="clustal") format'''
+        from .utils import writeMSA
+        names, msa = self.getQueryAlignment(queryId)
+        return writeMSA(names, msa, outFile, fmt=fmt)
+
+    def getHits(self, mmap=True):
+        '''Returns the hits as a numpy structured array, memory-mapped by default'''
+        from .utils import loadHitTable
+        return loadHitTable(self.getFileName(), mmap=mmap)
+
+    def filterHits(self, **kwargs):
+        '''Returns the hits passing the thresholds defined in kwargs (see utils.filterHits)'''
+        from .utils import filterHits
+        return filterHits(self.getHits(), **kwargs)
+
+    def getHitPage(self, page=0, pageSize=100, **kwargs):
+        '''Returns a page of the sorted and filtered hits, their query coverage and the number of hits passing the
+        filters, reading only the rows of the page (see utils.getHitPage)'''
+        from .utils import getHitPage
+        return getHitPage(self.getFileName(), page, pageSize, queriesFile=self.getQueriesFile(), **kwargs)
+
+
+class BLASTSimilarityMatrix(EMFile):
+    """Sparse all vs all similarity matrix of a set of sequences, stored as COO arrays in a .npz file
+    (row, col, bitscore, evalue and sequence names)"""
+
+    def __init__(self, filename=None, **kwargs):
+        size = kwargs.pop('size', None)
+        EMFile.__init__(self, filename=filename, **kwargs)
+        self._size = Integer(size)
+
+    def __str__(self):
+        return '{} ({} x {} sequences)'.format(self.getClassName(), self.getSize(), self.getSize())
+
+    def getSize(self):
+        return self._size.get()
+
+    def setSize(self, size):
+        self._size.set(size)
+
+    def getMatrix(self, values='bitscore'):
+        '''Returns the scipy.sparse COO matrix of bitscores or evalues'''
+        from .utils import loadSimilarityMatrix
+        return loadSimilarityMatrix(self.getFileName(), values=values)
+
+    def getSequenceNames(self):
+        '''Returns the names of the sequences in the rows / columns order'''
+        from .utils import loadSimilarityNames
+        return loadSimilarityNames(self.getFileName())
+
+
+class BLASTPairTable(EMFile):
+    """Table of paired sequences from two sets (e.g: reciprocal best hits), stored as a numpy .npy file.
+    Columns: seqA, seqB, bitscoreAB, evalueAB, bitscoreBA, evalueBA"""
+
+    def __init__(self, filename=None, **kwargs):
+        size = kwargs.pop('size', None)
+        EMFile.__init__(self, filename=filename, **kwargs)
+        self._size = Integer(size)
+
+    def __str__(self):
+        return '{} ({} pairs)'.format(self.getClassName(), self.getSize())
+
+    def getSize(self):
+        return self._size.get()
+
+    def setSize(self, size):
+        self._size.set(size)
+
+    def getPairs(self, mmap=True):
+        '''Returns the pairs as a numpy structured array, memory-mapped by default'''
+        from .utils import loadHitTable
+        return loadHitTable(self.getFileName(), mmap=mmap)
+
+
+class BLASTSweepTable(EMFile):
+    """Comparison of the searches of a parameter sweep, stored in a .npz file: one row per combination of
+    parameters (label, evalue, word_size, matrix, gaps, matchMismatch, nHits, nPairs, nQueries, seconds) and the
+    Jaccard overlap matrix of the query-subject pairs found by each combination"""
+
+    def __init__(self, filename=None, **kwargs):
+        size = kwargs.pop('size', None)
+        EMFile.__init__(self, filename=filename, **kwargs)
+        self._size = Integer(size)
+
+    def __str__(self):
+        return '{} ({} combinations)'.format(self.getClassName(), self.getSize())
+
+    def getSize(self):
+        return self._size.get()
+
+    def setSize(self, size):
+        self._size.set(size)
+
+    def getTable(self):
+        from .utils import loadSweepTable
+        return loadSweepTable(self.getFileName())[0]
+
+    def getOverlaps(self):
+        from .utils import loadSweepTable
+        return loadSweepTable(self.getFileName())[1]
@@ -7,3 +7,6 @@
 from .protocol_ncbi_download import ProtChemNCBIDownload
 from .protocol_blast import ProtChemBLAST
 from .protocol_blast_database import ProtChemBLASTDatabase
+from .protocol_blast_all_vs_all import ProtChemBLASTAllVsAll
+from .protocol_blast_reciprocal import ProtChemBLASTReciprocal
+from .protocol_blast_sweep import ProtChemBLASTSweep
@@ -24,16 +24,23 @@
 # *
 # **************************************************************************
 
-import os
+import os, json, time
+import numpy as np
 
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.params import *
+from pyworkflow.protocol.constants import STATUS_NEW
 from pyworkflow import BETA
 from blast import Plugin
 from pwem.objects import Sequence, SetOfSequences
 
 from ..constants import *
-from pwchem.utils import getSequenceFastaName
+from ..objects import BLASTHitTable
+from ..utils import getHitTableOutfmt, parseHitTable, writeHitTable, loadHitTable, getBLASTProgramArgs, readFasta, \
+    writeFasta, groupIdenticalSequences, fanOutHits, getDatabaseMaskAlgorithms, getDatabaseVersion, getPSSMCacheKey, \
+    getCachedPSSMs, storePSSMCheckpoints, getWindowStarts, splitQueryWindows, mergeWindowHits, getAlignedStrings, \
+    getCachedSequences, rescoreTopHits, getDatabaseLetters, mergeDatabaseHits, buildHitIndex, isDone, markDone, \
+    mergeDoneFiles, getQueriesKey
 
 PROTEIN, NUCLEOTIDE = 0, 1
 
@@ -42,19 +49,39 @@ class ProtChemBLAST(EMProtocol):
     _label = 'BLAST search'
     _devStatus = BETA
 
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+        self.dbSnapshots = String()
+
     def _defineParams(self, form):
         form.addSection(label='Input')
         group = form.addGroup('Input')
-        group.addParam('inputSequence', PointerParam, pointerClass='Sequence',
-                      label='Input Sequence: ', allowsNull=False,
-                      help="Sequence to be used as query")
+        group.addParam('inputSequence', PointerParam, pointerClass='Sequence, SetOfSequences',
+                      label='Input Sequence(s): ', allowsNull=False,
+                      help="Sequence or set of sequences to be used as queries.\n"
+                           "Identical sequences in a set are searched only once and their results are copied "
+                           "to each of them")
 
         group.addParam('seqType', EnumParam, default=1,
                       choices=['Protein', 'Nucleotide'], display=EnumParam.DISPLAY_HLIST,
                       label='Type of sequence: ')
         
         group.addParam('exportFasta', BooleanParam, default=False,
-                       label='Create output fasta: ', expertLevel=LEVEL_ADVANCED)
+                       label='Export query-anchored alignments: ', expertLevel=LEVEL_ADVANCED,
+                       help='Write the multiple alignment of each query and its hits (extra/alignment_<query>), '
+                            'built from the compact alignments of the hit table')
+        group.addParam('alignmentFormat', EnumParam, default=0, choices=['FASTA', 'Clustal'],
+                       display=EnumParam.DISPLAY_HLIST, condition='exportFasta', expertLevel=LEVEL_ADVANCED,
+                       label='Alignment format: ')
+        group.addParam('storeSequences', BooleanParam, default=True,
+                       label='Store hit sequences: ', expertLevel=LEVEL_ADVANCED,
+                       help='Whether to store the aligned residues of each hit and the query sequences in the '
+                            'output set.\n'
+                            'The alignments are always stored compactly as coordinates and BTOP edit operations '
+                            '(btop attribute and outputHitTable). The gapped strings are only rebuilt on demand '
+                            '(outputHitTable.getAlignments) and the full subject sequences are fetched from the '
+                            'database in a single bulk call (outputHitTable.getSubjectSequences), then cached.')
         
 
         group = form.addGroup('Database')
@@ -69,13 +96,32 @@ class ProtChemBLAST(EMProtocol):
                       label='Nucleotide database to query on: ',
                       help='Nucleotide database to search on')
 
-        group.addParam('dbName', EnumParam,
-                       choices=Plugin.getLocalDatabases(),
+        group.addParam('dbName', StringParam, default='',
                        label='Local database name: ', condition='localSearch',
-                       help='Choose a database from those downloaded in {}'.format(Plugin.getDatabasesDir()))
+                       help='Name of a database from those downloaded in {}. Use the wizard to choose one of them'.
+                       format(Plugin.getDatabasesDir()))
+        group.addParam('extraDatabases', StringParam, default='',
+                       label='Additional local databases: ', condition='localSearch',
+                       help='Names of other local databases (separated by commas) searched at the same time as the '
+                            'main one, sharing the threads of the protocol according to their sizes.\n'
+                            'All the searches use the total size of the databases as search space (-dbsize), so '
+                            'that the evalues are comparable, and their hits are merged in a single ranking by '
+                            'evalue, recording the source database of each hit')
         group.addParam('updateDB', BooleanParam, default=False, expertLevel=LEVEL_ADVANCED,
                        label='Update database: ', condition='localSearch',
                        help='In the case of being an NCBI database, update it before using it')
+        group.addParam('useAdmission', BooleanParam, default=True, expertLevel=LEVEL_ADVANCED,
+                       label='Wait for host resources: ', condition='localSearch',
+                       help='Local searches of all the BLAST runs in this host go through a shared admission queue. '
+                            'The memory of each search is estimated from the size of the database volumes (shared '
+                            'by the searches of the same database) and its threads and queries, and it only starts '
+                            'when it fits in the host memory, with fewer threads if there are not enough free cores. '
+                            'This avoids swapping when several large searches (e.g: against nr) run at the same time')
+        group.addParam('dbMask', EnumParam, default=0, choices=['None', 'Soft', 'Hard'],
+                       display=EnumParam.DISPLAY_HLIST, label='Use database masks: ', condition='localSearch',
+                       help='Use the masks precomputed in the local database (e.g: low complexity or repeats). '
+                            'Soft masks are only used in the seeding phase (-db_soft_mask), hard masked regions '
+                            'are removed from the search (-db_hard_mask)')
 
         group = form.addGroup('Program')
         group.addParam('blastProtein', EnumParam, default=0,
@@ -97,11 +143,73 @@ class ProtChemBLAST(EMProtocol):
                       condition='seqType=={} and blastNucleotide==0'.format(NUCLEOTIDE),
                       label='Nucleotide BLAST program: ',
                       help='Nucleotide BLAST program to execute:\n{}'.format(blastnProgramsHelp))
+        group.addParam('autoTune', BooleanParam, default=False,
+                       condition='(seqType=={} and blastProtein==0 and blastProteinProgram<2) or '
+                                 '(seqType=={} and blastNucleotide==0)'.format(PROTEIN, NUCLEOTIDE),
+                       label='Choose the program automatically: ',
+                       help='The task (blastn, megablast, dc-megablast / blastp, blastp-fast), word size and threads '
+                            'of each search are chosen from the length of its queries, the batch size, the database '
+                            'size and the target identity. Among the tasks suited for them, the fastest in the '
+                            'timings recorded by previous local searches ({}) is used. Until all of them have '
+                            'been timed a few times, the one with fewest timings is used instead.\n'
+                            'The scoring parameters are the defaults of the chosen task. The decisions are logged '
+                            'in extra/autoTuning.jsonl'.format(Plugin.getTimingsFile()))
+        group.addParam('targetIdentity', IntParam, default=90, condition='autoTune',
+                       label='Lowest target identity (%): ',
+                       help='The searches are tuned to find hits with identities between this value and 100%')
+
+        group.addParam('numIterations', IntParam, default=1,
+                       condition='seqType=={} and blastProtein==0 and blastProteinProgram>=2'.format(PROTEIN),
+                       label='Number of iterations: ',
+                       help='Number of PSI-BLAST / DELTA-BLAST iterations (rounds) to build the PSSM and search')
+        group.addParam('usePSSMCache', BooleanParam, default=True,
+                       condition='seqType=={} and blastProtein==0 and blastProteinProgram>=2'.format(PROTEIN),
+                       label='Use PSSM cache: ', expertLevel=LEVEL_ADVANCED,
+                       help='Store the PSSM checkpoints of each iteration in a cache ({}) keyed by query, database '
+                            'version and parameters. Later runs start from the most advanced checkpoint with '
+                            '-in_pssm and only run the missing iterations'.format(Plugin.getPSSMCacheDir()))
+        group.addParam('profileDB', StringParam, default='',
+                       condition='seqType=={} and blastProtein==0 and blastProteinProgram>=2 and localSearch'.
+                       format(PROTEIN), label='Profile database: ', expertLevel=LEVEL_ADVANCED,
+                       help='Local database used to build the PSSM in the iterations previous to the last one. '
+                            'If empty, the searched database is used.\n'
+                            'Allows to reuse the same profile to search several databases')
 
         group.addParam('maxEntries', IntParam, default=20,
                        label='Maximum number of entries to keep: ',
                        help='Maximum number of entries to keep: -max_target_seqs. '
                             'Undefined with <0')
+        group.addParam('queryChunkSize', IntParam, default=10, expertLevel=LEVEL_ADVANCED,
+                       label='Queries per search step: ',
+                       help='Number of input queries searched in each step (batch). The results of each step are '
+                            'added to the output set as soon as it finishes, so protocols consuming it in streaming '
+                            'can start while the rest of queries are searched. If 0, all the available queries are '
+                            'searched in a single step')
+        group.addParam('windowSize', IntParam, default=0, expertLevel=LEVEL_ADVANCED,
+                       label='Query window size: ',
+                       help='Queries longer than this size (e.g: chromosomes or large contigs) are split in '
+                            'overlapping windows searched in parallel steps. The hits are mapped back to the query '
+                            'coordinates and the duplicates found in the overlaps are merged. Local searches of the '
+                            'windows use the search space of the whole query (-searchsp), so that the evalues of '
+                            'their hits are those of the unsplit search.\n'
+                            'If 0, the queries are not split')
+        group.addParam('windowOverlap', IntParam, default=5000, expertLevel=LEVEL_ADVANCED,
+                       label='Query window overlap: ', condition='windowSize>0',
+                       help='Length shared by consecutive windows. It should be longer than the longest expected '
+                            'hit, so that every hit is found whole in at least one window')
+        group.addParam('batchTime', IntParam, default=60, expertLevel=LEVEL_ADVANCED,
+                       label='Batch time window (s): ',
+                       help='When the input set is still being produced (streaming), new sequences are searched '
+                            'once they fill a batch or once this time has passed since the oldest of them arrived\n'
+                            'Sequences already searched (recorded in extra/doneQueries.jsonl) are not searched '
+                            'again when the protocol is continued')
+        group.addParam('searchChunkSize', IntParam, default=0, expertLevel=LEVEL_ADVANCED,
+                       label='Queries per checkpointed chunk: ',
+                       help='The queries of each search step are searched in chunks of this size. The hits of each '
+                            'chunk are written to their own file with a completion marker (.done, with its '
+                            'checksum), so if the step is interrupted (e.g: node preemption), continuing the '
+                            'protocol only searches the unfinished chunks.\n'
+                            'If 0, each search step is a single chunk')
 
 
         form.addSection(label='Parameters')
@@ -142,84 +250,361 @@ class ProtChemBLAST(EMProtocol):
                        label='Gap extend cost: ',
                        condition='not (seqType=={} and blastNucleotide==2)'.format(PROTEIN),
                        help='Cost to extend a gap.\nIf empty, default will be used')
-
+        group.addParam('rescoreTop', IntParam, default=0, expertLevel=LEVEL_ADVANCED,
+                       condition='(seqType=={} and blastProtein==0) or (seqType=={} and blastNucleotide==0)'.
+                       format(PROTEIN, NUCLEOTIDE),
+                       label='Re-score top hits (Smith-Waterman): ',
+                       help='Number of best subjects of each query re-aligned with an exact Smith-Waterman local '
+                            'alignment of the full query and subject sequences, using the same scoring parameters '
+                            '(BLAST defaults if empty). The exact score is stored as "swscore" in the output hits '
+                            'and hit table (NaN for the hits not re-scored).\n'
+                            'The subject sequences are retrieved from the database. If 0, hits are not re-scored')
+
+        form.addParallelSection(threads=4, mpi=1)
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
-        searchIds = []
-        searchIds.append(self._insertFunctionStep('BLASTSearchStep'))
-        self._insertFunctionStep('createOutputStep')
-
-    def BLASTSearchStep(self):
-        if not self.localSearch.get():
-            if self.seqType.get() == PROTEIN:
-                dbName = self.getDBName(self.getEnumText('dbProtein'))
-            else:
-                dbName = self.getDBName(self.getEnumText('dbNucleotide'))
+        # Queries already searched in a previous run (checkpoint) are not searched again
+        self.insertedIds, self.pendingIds, self.pendingSince = set(self.getDoneQueryIds()), [], None
+        self.initIds = []
+        if self.localSearch.get():
+            if self.updateDB.get():
+                self.initIds.append(self._insertFunctionStep('updateDatabaseStep', prerequisites=[]))
+            self.initIds.append(self._insertFunctionStep('pinDatabasesStep', prerequisites=self.initIds))
+
+        streaming = self.isInputStreaming()
+        searchIds = self._insertNewBatches(self.getNewQueryIds(), flush=not streaming)
+        self.closeId = self._insertFunctionStep('closeOutputStep', prerequisites=self.initIds + searchIds,
+                                                wait=streaming)
+
+    def _stepsCheck(self):
+        closeStep = self._steps[self.closeId - 1]
+        if not closeStep.isWaiting():
+            return
+
+        # New input sequences are grouped in batches until they fill one or the time window passes
+        inputClosed = not self.isInputStreaming()
+        newSteps = self._insertNewBatches(self.getNewQueryIds(), flush=inputClosed)
+        if newSteps:
+            closeStep.addPrerequisites(*newSteps)
+        if inputClosed and not self.pendingIds:
+            closeStep.setStatus(STATUS_NEW)
+        if newSteps or closeStep.isNew():
+            self.updateSteps()
+
+    def _insertNewBatches(self, newIds, flush=False):
+        '''Inserts a search step for each complete batch of pending queries. Incomplete batches are also inserted
+        if flush or after the batch time window since the oldest pending query. Returns the new step ids'''
+        pendingIds = set(self.pendingIds)
+        self.pendingIds += [objId for objId in newIds if objId not in self.insertedIds and objId not in pendingIds]
+        if self.pendingIds and self.pendingSince is None:
+            self.pendingSince = time.time()
+        timeUp = self.pendingSince is not None and time.time() - self.pendingSince >= self.batchTime.get()
+
+        stepIds, batchSize = [], self.queryChunkSize.get()
+        while self.pendingIds and (flush or timeUp or 0 < batchSize <= len(self.pendingIds)):
+            nBatch = batchSize if batchSize > 0 else len(self.pendingIds)
+            batchIds, self.pendingIds = self.pendingIds[:nBatch], self.pendingIds[nBatch:]
+            stepIds.append(self._insertBatchSteps(batchIds))
+            self.insertedIds.update(batchIds)
+
+        if not self.pendingIds:
+            self.pendingSince = None
+        return stepIds
+
+    def _insertBatchSteps(self, batchIds):
+        '''Inserts the steps searching a batch of queries. Returns the id of the step that adds its results'''
+        nWindows, nDatabases = self.getNumberOfWindows(batchIds), len(self.getSearchDatabases())
+        if nWindows == 1 and nDatabases == 1:
+            return self._insertFunctionStep('BLASTSearchStep', batchIds, prerequisites=self.initIds)
+
+        # Long queries are split in overlapping windows and each database is searched in parallel steps
+        windowIdxs = [None] if nWindows == 1 else range(nWindows)
+        prepId = self._insertFunctionStep('prepareBatchStep', batchIds, prerequisites=self.initIds)
+        searchIds = [self._insertFunctionStep('BLASTSearchStep', batchIds, windowIdx, dbIdx, prerequisites=[prepId])
+                     for windowIdx in windowIdxs for dbIdx in range(nDatabases)]
+        return self._insertFunctionStep('mergeBatchStep', batchIds, prerequisites=searchIds)
+
+    def updateDatabaseStep(self):
+        dbName, store = self.getDatabaseName(), Plugin.getDatabaseStore()
+        upArgs = ' --decompress {} -passive'.format(dbName)
+        stagingDir = store.createStaging(dbName)
+        Plugin.updateDatabase(self, upArgs, cwd=stagingDir)
+        store.commitSnapshot(dbName, stagingDir)
+        store.collectGarbage(Plugin.getStoreQuota())
+
+    def pinDatabasesStep(self):
+        '''Records the snapshots of the searched databases, which are the ones searched (and kept in the store)
+        even if the databases are updated later. A continued run keeps the snapshots it already used'''
+        store, snapshots = Plugin.getDatabaseStore(), self.getDatabaseSnapshots()
+        for dbName in self.getSearchDatabases():
+            snapshotId = snapshots.get(dbName) or store.getCurrentSnapshot(dbName)
+            if snapshotId is None:
+                print('Database {} is not in the versioned store, it is searched by name'.format(dbName))
+                continue
+            store.addReference(dbName, snapshotId, os.path.abspath(self.getWorkingDir()))
+            snapshots[dbName] = snapshotId
+        self.dbSnapshots.set(json.dumps(snapshots))
+        self._store(self.dbSnapshots)
+
+    def prepareBatchStep(self, queryIds):
+        batchName = self.getBatchName(queryIds)
+        uniqueSeqs = self.writeUniqueQueries(self.getInputQueries(queryIds),
+                                             self.getBLASTOutputFile(batchName, 'fasta'),
+                                             self.getBLASTOutputFile(batchName, 'json'))
+        if self.getNumberOfWindows(queryIds) == 1:
+            return
+        windows = splitQueryWindows(uniqueSeqs, self.windowSize.get(), self.windowOverlap.get())
+        for windowIdx, windowSeqs in enumerate(windows):
+            writeFasta(windowSeqs, self.getBLASTOutputFile(self.getBatchName(queryIds, windowIdx), 'fasta'))
+
+    def BLASTSearchStep(self, queryIds, windowIdx=None, dbIdx=None):
+        # Searches of a split batch (windows or several databases) read the queries written by prepareBatchStep
+        splitBatch = windowIdx is not None or dbIdx is not None
+        dbName = self.getSearchDatabases()[dbIdx or 0]
+        dbPath = self.getDBPath(dbName)
+        inFasta = self.getBLASTOutputFile(self.getBatchName(queryIds, windowIdx), 'fasta')
+        batchName = self.getBatchName(queryIds, windowIdx, dbIdx)
+        if not splitBatch:
+            uniqueSeqs = self.writeUniqueQueries(self.getInputQueries(queryIds), inFasta,
+                                                 self.getBLASTOutputFile(batchName, 'json'))
         else:
-            dbName = self.getEnumText('dbName')
-
-        outDir = self._getPath('sequences')
-        if not os.path.exists(outDir):
-            os.mkdir(outDir)
-
-        inSeq = self.inputSequence.get()
-        inFasta = os.path.abspath(self._getExtraPath(getSequenceFastaName(inSeq) + '.fasta'))
-        inSeq.exportToFile(inFasta)
-
-        outFile = os.path.abspath(self._getPath(getSequenceFastaName(inSeq) + '.txt'))
-
-        args = '-query {} -db {} -out {} -outfmt 4'.format(inFasta, dbName, outFile)
+            uniqueSeqs = readFasta(inFasta)
+        # PSSM iterations are only allowed for a single query, so it is the only one of the only batch
+        singleQuery = len(uniqueSeqs) == 1
+
+        queryArgs = '-query {}'.format(inFasta)
+        nWindows = 1 if windowIdx is None else self.getNumberOfWindows(queryIds)
+        task, nThreads, overrides = self.getSelectedBLASTProgram(), self.getBatchThreads(nWindows, dbName), {}
+        if self.usesAutoTuning():
+            tuning = self.getAutoTuning(uniqueSeqs, dbName, nThreads)
+            task, nThreads = tuning['task'], tuning['threads']
+            overrides = self.getTaskParameters(task, tuning['wordSize'])
+        program, taskArgs = getBLASTProgramArgs(task)
+        if self.usesPSSM() and singleQuery and self.numIterations.get() > 1:
+            # Only the last round is searched here, starting from the PSSM of the previous ones
+            pssmFile = self.getCheckpointPSSM(inFasta, self.numIterations.get() - 1)
+            if pssmFile is not None:
+                program, queryArgs, taskArgs = 'psiblast', '-in_pssm {}'.format(pssmFile), ''
+
+        args = ' -outfmt 11'
         if self.maxEntries.get() > 0:
             args += ' -max_target_seqs {}'.format(self.maxEntries.get())
         if not self.localSearch.get():
             args += ' -remote'
-        elif self.localSearch.get() and self.updateDB.get():
-            upArgs = ' --decompress {} -passive'.format(dbName)
-            Plugin.updateDatabase(self, upArgs)
-        args += self.parseParameters()
-
-        subprogram = self.getSelectedBLASTProgram()
-        if subprogram in ['blastx', 'tblastn', 'tblastx']:
-            program = subprogram
-        elif subprogram in ['psi-blast', 'delta-blast']:
-            program = subprogram.replace('-', '')
-        elif subprogram in ['blastp', 'blastp-fast']:
-            program = 'blastp'
-            args += ' -task {}'.format(subprogram)
-        elif subprogram in ['blastn', 'megablast', 'dc-megablast']:
-            program = 'blastn'
-            args += ' -task {}'.format(subprogram)
-
-        Plugin.runBLAST(self, program, args, cwd=Plugin.getDatabasesDir())
-
-    def createOutputStep(self):
-        seqDic = self.parseBLASTOutput()
-        outSeqs = SetOfSequences.create(self._getPath())
-        inSeq = self.inputSequence.get()
-
-        #Adding target sequences
-        for seqId in seqDic:
-            if seqId != 'Query_1':
-                newSequence = seqDic[seqId]['sequence']
-                isAmino = self.seqType.get() == 0
-                newSeq = Sequence(name=seqId, sequence=newSequence, id=seqId, isAminoacids=isAmino,
-                                  description=seqDic[seqId]['description'])
-                newSeq.evalue = Float(seqDic[seqId]['evalue'])
-                newSeq.score = Float(seqDic[seqId]['score'])
-                outSeqs.append(newSeq)
+        elif self.dbMask.get() != 0:
+            args += self.getMaskArgs(dbPath)
+        cachePSSM = self.usesPSSM() and singleQuery and self.getProfileDatabase() == dbName
+        if cachePSSM:
+            # The PSSM after the last round is also cached for later runs with more iterations
+            prefix = os.path.abspath(self._getTmpPath('lastRound'))
+            args += ' -out_pssm {} -out_ascii_pssm {}_ascii -save_each_pssm -save_pssm_after_last_round'.\
+                format(prefix, prefix)
+        # Windows are searched with the search space of their whole query, which replaces the database size
+        fullLengths = self.getFullQueryLengths(queryIds) if windowIdx is not None and self.localSearch.get() else None
+        args += self.parseParameters(overrides) + taskArgs + ('' if fullLengths else self.getDBSizeArgs())
+
+        # The queries are searched in chunks whose hits are marked as done once written, so that a continued run
+        # only searches the chunks that did not finish. The markers record the queries searched, since a continued
+        # run may group them in different batches with the same names
+        chunks, chunkFiles = self.getSearchChunks(uniqueSeqs, fullLengths), []
+        batchTsv, batchKey = self.getBLASTOutputFile(batchName, 'tsv'), getQueriesKey(queryIds, uniqueSeqs)
+        for chunkIdx, chunkSeqs in enumerate(chunks):
+            chunkName = batchName if len(chunks) == 1 else '{}_chunk_{}'.format(batchName, chunkIdx)
+            chunkFiles.append(self.getBLASTOutputFile(chunkName, 'tsv'))
+            chunkKey = getQueriesKey(queryIds, chunkSeqs)
+            if isDone(chunkFiles[-1], queries=chunkKey) or isDone(batchTsv, queries=batchKey):
+                print('Chunk {} was already searched'.format(chunkName))
+                continue
+            chunkQueryArgs = queryArgs
+            if len(chunks) > 1:
+                chunkQueryArgs = '-query {}'.format(writeFasta(chunkSeqs, self.getBLASTOutputFile(chunkName, 'fasta')))
+            if fullLengths:
+                chunkQueryArgs += self.getSearchSpaceArgs(fullLengths[next(iter(chunkSeqs))])
+            archiveFile = self.getBLASTOutputFile(chunkName, 'asn')
+
+            # Local databases are searched from their node-local copy in scratch, if configured
+            with Plugin.getStagedDatabase(dbPath, staging=self.localSearch.get()) as staged:
+                chunkArgs = '{} -db {} -out {}{}'.format(chunkQueryArgs, staged.path, archiveFile, args)
+                if not self.localSearch.get():
+                    Plugin.runBLAST(self, program, chunkArgs, cwd=Plugin.getDatabasesDir())
+                else:
+                    timing = {'task': task,
+                              'wordSize': int(float(overrides.get('word_size') or self.word_size.get() or 0)),
+                              'queryLetters': sum(len(seq) for seq in chunkSeqs.values()),
+                              'dbLetters': self.getDatabaseLetters()[dbName]}
+                    self.runLocalSearch(program, chunkArgs, dbPath, nThreads, len(chunkSeqs), timing,
+                                        blastDB=staged.dir)
+                if cachePSSM:
+                    storePSSMCheckpoints(prefix, self.getPSSMCacheDir(inFasta, dbName), self.numIterations.get() - 1)
+
+                # The alignments are stored as coordinates and BTOP edit operations in the tabular hit table
+                fmtArgs = '-archive {} -out {} -outfmt "{}"'.format(archiveFile, chunkFiles[-1],
+                                                                     getHitTableOutfmt(btop=True))
+                Plugin.runBLAST(self, 'blast_formatter', fmtArgs, cwd=staged.dir or Plugin.getDatabasesDir(),
+                                blastDB=staged.dir)
+            markDone(chunkFiles[-1], queries=chunkKey)
+
+        if len(chunks) > 1 and not isDone(batchTsv, queries=batchKey):
+            mergeDoneFiles(chunkFiles, batchTsv, queries=batchKey)
+        if not splitBatch:
+            self.updateOutputStep(queryIds, self.loadSearchHits(batchName, batchKey))
+
+    def runLocalSearch(self, program, args, dbName, nThreads, nQueries, timing=None, blastDB=None):
+        '''Runs a local search, waiting for the host admission if enabled, which may also reduce its threads.
+        The search time is recorded with the timing description to calibrate the automatic tuning.
+        If blastDB, the search runs in that directory (a staged copy of the database)'''
+        from ..tuning import recordTiming
+        cwd = blastDB or Plugin.getDatabasesDir()
+        if not self.useAdmission.get():
+            t0 = time.time()
+            Plugin.runBLAST(self, program, args + ' -num_threads {}'.format(nThreads), cwd=cwd, blastDB=blastDB)
+        else:
+            with Plugin.getSearchAdmission(dbName, nThreads, nQueries) as adm:
+                nThreads, t0 = adm.threads, time.time()
+                Plugin.runBLAST(self, program, args + ' -num_threads {}'.format(nThreads), cwd=cwd,
+                                blastDB=blastDB)
+        if timing is not None:
+            recordTiming(Plugin.getTimingsFile(), threads=nThreads, seconds=time.time() - t0, **timing)
+
+    def mergeBatchStep(self, queryIds):
+        '''Maps the hits of the query windows to the whole queries, merging the duplicates found in the overlaps,
+        and merges the hits of the searched databases in a single ranking'''
+        nWindows, dbNames = self.getNumberOfWindows(queryIds), self.getSearchDatabases()
+        starts = [windowIdx * (self.windowSize.get() - self.windowOverlap.get()) for windowIdx in range(nWindows)]
+        dbHits = []
+        for dbIdx in range(len(dbNames)):
+            if nWindows == 1:
+                dbHits.append(self.loadSearchHits(self.getBatchName(queryIds, dbIdx=dbIdx),
+                                                  self.getSearchKey(queryIds)))
             else:
-                inSeq.setSequence(seqDic[seqId]['sequence'])
+                windowHits = [self.loadSearchHits(self.getBatchName(queryIds, windowIdx, dbIdx),
+                                                  self.getSearchKey(queryIds, windowIdx))
+                              for windowIdx in range(nWindows)]
+                dbHits.append(mergeWindowHits(windowHits, starts))
+
+        hits = dbHits[0] if len(dbNames) == 1 else mergeDatabaseHits(dbHits, dbNames)
+        self.updateOutputStep(queryIds, hits)
+
+    def updateOutputStep(self, queryIds, hits):
+        '''Adds the results of a finished batch to the output set, which stays open until all batches are done,
+        and records its queries as done in the checkpoint'''
+        from pwchem.utils import getSequenceFastaName
+        batchName = self.getBatchName(queryIds)
+        queries, queryGroups = self.getInputQueries(queryIds), self.getQueryGroups(batchName)
+        groupNames = {label: [getSequenceFastaName(queries[objId]) for objId in objIds]
+                      for label, objIds in queryGroups.items()}
+        if self.rescoreTop.get() > 0:
+            hits = self.rescoreHits(batchName, hits)
+        hits = fanOutHits(hits, groupNames)
+        writeHitTable(hits, self.getBLASTOutputFile(batchName, 'npy'))
+
+        newSeqs = self.createHitsOutput(queries, hits)
+
+        # Batches finishing at the same time are appended one by one
+        with self._lock:
+            outSeqs = self.getOutputSequences()
+            for newSeq in newSeqs:
+                outSeqs.append(newSeq)
+            self._updateOutputSet('outputSequences', outSeqs, state=outSeqs.STREAM_OPEN)
+
+            with open(self.getCheckpointFile(), 'a') as f:
+                f.write(json.dumps({'batch': batchName, 'ids': queryIds, 'unique': len(queryGroups)}) + '\n')
+
+    def closeOutputStep(self):
+        from pwchem.utils import getSequenceFastaName
+        hitTables = [loadHitTable(self.getBLASTOutputFile(batch['batch'], 'npy'), btop=True)
+                     for batch in self.getDoneBatches()]
+        # With no finished batch, the stream is closed with an empty table
+        hits = np.concatenate(hitTables) if hitTables else np.zeros(0, dtype=HIT_TABLE_DTYPE + [('btop', 'O')])
+        # The table reads the subject sequences from the snapshots searched, not from the current databases
+        dbPaths = [self.getDBPath(dbName) for dbName in self.getSearchDatabases()]
+        hitTable = BLASTHitTable(filename=writeHitTable(hits, self._getPath('hitTable.npy')), size=len(hits),
+                                 database=','.join(dbPaths), remote=not self.localSearch.get(),
+                                 isAminoacids=self.isProteinDatabase(), translatedQueries=self.isTranslatedQuery())
+        # The query sequences are kept with the table to rebuild the alignments on demand
+        writeFasta({getSequenceFastaName(query): query.getSequence() for query in self.getInputQueries().values()},
+                   hitTable.getQueriesFile())
+        # Sorted index of the hits, so that the viewer reads pages of hits without loading the table
+        buildHitIndex(hitTable.getFileName(), hitTable.getQueriesFile())
+
+        with self._lock:
+            outSeqs = self.getOutputSequences()
+            self._updateOutputSet('outputSequences', outSeqs, state=outSeqs.STREAM_CLOSED)
+
+        if self.exportFasta.get():
+            fmt, ext = ('fasta', 'fasta') if self.alignmentFormat.get() == 0 else ('clustal', 'aln')
+            for queryId in dict.fromkeys(hits['qseqid']):
+                hitTable.exportAlignment(queryId, self._getExtraPath('alignment_{}.{}'.format(queryId, ext)), fmt)
+
+        self._defineOutputs(outputHitTable=hitTable)
+
+    def getOutputSequences(self):
+        '''Returns the output set ready to append new items, creating it for the first finished chunk'''
+        if hasattr(self, 'outputSequences'):
+            outSeqs = SetOfSequences(filename=self.outputSequences.getFileName())
+            outSeqs.loadAllProperties()
+            outSeqs.enableAppend()
+        else:
+            outSeqs = SetOfSequences.create(self._getPath())
+        return outSeqs
+
+    def rescoreHits(self, batchName, hits):
+        '''Adds the exact Smith-Waterman scores of the best subjects of each unique query of a batch'''
+        querySeqs = readFasta(self.getBLASTOutputFile(batchName, 'fasta'))
+        # Batches finishing at the same time share the cache of subject sequences
+        dbPaths = [self.getDBPath(dbName) for dbName in self.getSearchDatabases()]
+        with self._lock:
+            subjectSeqs = getCachedSequences(list(dict.fromkeys(hits['sseqid'])), self.getSubjectsCacheFile(),
+                                             dbPaths, remote=not self.localSearch.get(),
+                                             isAmino=self.isProteinDatabase())
+        t0 = time.time()
+        hits = rescoreTopHits(hits, querySeqs, subjectSeqs, self.rescoreTop.get(), **self.getRescoringParams())
+        print('{} hits of the best {} subjects of {} queries re-scored with Smith-Waterman in {:.2f} s'.
+              format(np.count_nonzero(~np.isnan(hits['swscore'])), self.rescoreTop.get(), len(querySeqs),
+                     time.time() - t0))
+        return hits
+
+    def createHitsOutput(self, queries, hits):
+        '''Output items of a batch: the best HSP of each query-subject pair, storing scores, coordinates and the
+        compact alignment (BTOP). If storeSequences, each query and the aligned residues of its hits are also stored'''
+        from pwchem.utils import getSequenceFastaName
+        outSeqs, isAmino = [], self.isProteinDatabase() or self.isTranslatedSearch()
+        # hits of each query are sorted by evalue, so the first row of a subject is its best HSP
+        pairs = np.char.add(np.char.add(hits['qseqid'], '\t'), hits['sseqid'])
+        _, firstIdxs = np.unique(pairs, return_index=True)
+        bestHits = hits[np.sort(firstIdxs)]
+
+        for query in queries.values():
+            queryId = getSequenceFastaName(query)
+            if self.storeSequences.get():
+                inSeq = query.clone()
+                inSeq.setObjId(None)
                 inSeq.evalue = Float(0.0)
                 inSeq.score = Float(0.0)
+                inSeq.queryId = String(queryId)
                 outSeqs.append(inSeq)
 
-        if self.exportFasta.get():
-            outPath = self._getExtraPath('viewSequences.fasta')
-            outSeqs.exportToFile(outPath)
-
-        self._defineOutputs(outputSequences=outSeqs)
-
+            for hit in bestHits[bestHits['qseqid'] == queryId]:
+                seqId, sequence = str(hit['sseqid']), ''
+                if self.storeSequences.get():
+                    _, subjectAligned = getAlignedStrings(query.getSequence(), hit['qstart'], hit['qend'],
+                                                          hit['btop'], translate=self.isTranslatedQuery())
+                    sequence = subjectAligned.replace('-', '')
+                newSeq = Sequence(name=seqId, sequence=sequence, id=seqId, isAminoacids=isAmino)
+                newSeq.evalue = Float(hit['evalue'])
+                newSeq.score = Float(hit['bitscore'])
+                newSeq.pident = Float(hit['pident'])
+                newSeq.queryId = String(queryId)
+                for coord in ['qstart', 'qend', 'sstart', 'send']:
+                    setattr(newSeq, coord, Integer(hit[coord]))
+                newSeq.btop = String(hit['btop'])
+                if 'swscore' in hits.dtype.names:
+                    newSeq.swscore = Float(hit['swscore'])
+                if 'database' in hits.dtype.names:
+                    newSeq.database = String(hit['database'])
+                outSeqs.append(newSeq)
+        return outSeqs
 
     def _validate(self):
         errors = []
@@ -234,8 +619,46 @@ class ProtChemBLAST(EMProtocol):
         if self.seqType.get() == 0 and int(self.word_size.get()) >= 8:
             errors.append('Word size must be < 8 when using blastp. Check the specified parameters.')
 
+        if self.usesPSSM() and self.numIterations.get() < 1:
+            errors.append('The number of iterations must be at least 1')
+        if self.usesPSSM() and self.numIterations.get() > 1 and len(self.getInputQueries()) > 1:
+            errors.append('Several PSI-BLAST / DELTA-BLAST iterations can only be run for a single query sequence')
+        if self.exportFasta.get() and self.isTranslatedQuery():
+            errors.append('Query-anchored alignments cannot be exported for translated queries (blastx, tblastx)')
+        if self.extraDatabases.get().strip() and not self.localSearch.get():
+            errors.append('Additional databases can only be searched in local searches')
+        if self.localSearch.get():
+            missing = [dbName for dbName in self.getSearchDatabases() if dbName not in Plugin.getLocalDatabases()]
+            if missing:
+                errors.append('Databases not found in {}: {}'.format(Plugin.getDatabasesDir(), ', '.join(missing)))
+        if self.rescoreTop.get() > 0 and self.isTranslatedSearch():
+            errors.append('Hits of translated searches (tblastn, blastx, tblastx) cannot be re-scored')
+        if self.windowSize.get() > 0:
+            if self.windowOverlap.get() < 0 or self.windowOverlap.get() >= self.windowSize.get():
+                errors.append('The query window overlap must be positive and smaller than the window size')
+            if self.usesPSSM():
+                errors.append('Query windows cannot be used with PSI-BLAST / DELTA-BLAST')
+
         return errors
 
+    def _summary(self):
+        summary = []
+        batches = self.getDoneBatches()
+        if batches:
+            nQueries, nUnique = sum(len(batch['ids']) for batch in batches), sum(batch['unique'] for batch in batches)
+            summary.append('{} queries searched as {} unique sequences: deduplication saved {} searches ({:.1f}%)'.
+                           format(nQueries, nUnique, nQueries - nUnique, 100 * (nQueries - nUnique) / nQueries))
+            if hasattr(self, 'outputSequences') and self.outputSequences.isStreamOpen():
+                summary.append('Searched {} batches so far, waiting for more input sequences'.format(len(batches)))
+        snapshots = self.getDatabaseSnapshots()
+        if snapshots:
+            summary.append('Database snapshots searched: {}'.
+                           format(', '.join('{}@{}'.format(dbName, snapId) for dbName, snapId in snapshots.items())))
+        if len(self.getSearchDatabases()) > 1 and os.path.exists(self._getExtraPath('databaseLetters.json')):
+            summary.append('Searched databases {}, sharing a search space of {} letters'.
+                           format(', '.join(self.getSearchDatabases()), sum(self.getDatabaseLetters().values())))
+        return summary
+
     def _warnings(self):
         warns = []
         # Check BLAST accepted parameter values
@@ -290,6 +713,304 @@ class ProtChemBLAST(EMProtocol):
     def getDBName(self, dbText):
         return dbText.split('(')[-1].split(')')[0]
 
+    def getDatabaseName(self):
+        if not self.localSearch.get():
+            if self.seqType.get() == PROTEIN:
+                return self.getDBName(self.getEnumText('dbProtein'))
+            else:
+                return self.getDBName(self.getEnumText('dbNucleotide'))
+        else:
+            return self.dbName.get().strip() if self.dbName.get() else ''
+
+    def getSearchDatabases(self):
+        '''Names of the searched databases: the main one and the additional local ones'''
+        dbNames = [self.getDatabaseName()]
+        if self.localSearch.get():
+            dbNames += [dbName.strip() for dbName in self.extraDatabases.get().split(',') if dbName.strip()]
+        return list(dict.fromkeys(dbNames))
+
+    def getDatabaseLetters(self):
+        '''Number of letters of each searched database, read once and stored in extra/databaseLetters.json'''
+        lettersFile = self._getExtraPath('databaseLetters.json')
+        with self._lock:
+            if not os.path.exists(lettersFile):
+                with open(lettersFile, 'w') as f:
+                    json.dump({dbName: getDatabaseLetters(self.getDBPath(dbName))
+                               for dbName in self.getSearchDatabases()}, f)
+            with open(lettersFile) as f:
+                return json.load(f)
+
+    def chooseAutoTuning(self, queryLengths, dbLetters, maxThreads):
+        '''Task, word size and threads for a search of queries with queryLengths (see tuning.chooseSearchParameters)'''
+        from ..tuning import chooseSearchParameters, readTimings
+        return chooseSearchParameters(self.isProteinDatabase(), self.targetIdentity.get(), queryLengths, dbLetters,
+                                      maxThreads, readTimings(Plugin.getTimingsFile()))
+
+    def getAutoTuning(self, querySeqs, dbName, maxThreads):
+        '''Chooses the task, word size and threads of a search and logs the decision'''
+        dbLetters = self.getDatabaseLetters()[dbName] if self.localSearch.get() else 0
+        tuning = self.chooseAutoTuning([len(seq) for seq in querySeqs.values()], dbLetters, maxThreads)
+        print('Automatic tuning: {} with word size {} and {} threads ({})'.
+              format(tuning['task'], tuning['wordSize'], tuning['threads'], tuning['reason']))
+        with self._lock:
+            with open(self._getExtraPath('autoTuning.jsonl'), 'a') as f:
+                f.write(json.dumps(dict(tuning, database=dbName)) + '\n')
+        return tuning
+
+    def getTaskParameters(self, task, wordSize):
+        '''Form parameters replaced by an automatically chosen task: its word size and default scoring'''
+        overrides = {parName: value for parName, value in DEF_BLAST_PARAMS[task].items() if parName != 'matrix'}
+        overrides['word_size'] = str(wordSize)
+        return overrides
+
+    def getDatabaseSnapshots(self):
+        '''Snapshots of the versioned store used by this protocol, as {dbName: snapshotId}'''
+        return json.loads(self.dbSnapshots.get()) if self.dbSnapshots.get() else {}
+
+    def getDBPath(self, dbName):
+        '''Path of the snapshot of the database used by this protocol, or its name if it is not in the store'''
+        snapshotId = self.getDatabaseSnapshots().get(dbName)
+        if snapshotId is None:
+            return dbName
+        return os.path.join(Plugin.getDatabaseStore().getSnapshotDir(dbName, snapshotId), dbName)
+
+    def getDBSizeArgs(self):
+        '''Searches of several databases share their total size as search space, so that evalues are comparable'''
+        if len(self.getSearchDatabases()) == 1:
+            return ''
+        return ' -dbsize {}'.format(sum(self.getDatabaseLetters().values()))
+
+    def getSearchSpaceArgs(self, queryLength):
+        '''Search space of a query of queryLength against the searched databases, for the searches of its windows'''
+        return ' -searchsp {}'.format(queryLength * sum(self.getDatabaseLetters().values()))
+
+    def isProteinDatabase(self):
+        return self.getSelectedBLASTProgram() in ['blastp', 'blastp-fast', 'psi-blast', 'delta-blast', 'blastx']
+
+    def getSubjectSequences(self, ids=None):
+        '''Full sequences of the hit subjects, retrieved in bulk from the searched database and cached'''
+        return self.outputHitTable.getSubjectSequences(ids)
+
+    def getMaskArgs(self, dbName):
+        algorithms = getDatabaseMaskAlgorithms(dbName)
+        if not algorithms:
+            print('No precomputed masks found in database {}. Searching without them'.format(dbName))
+            return ''
+        algName, algId = list(algorithms.items())[0]
+        print('Using {} mask ({}) of database {}'.format(algName, algId, dbName))
+        return ' -db_{}_mask {}'.format('soft' if self.dbMask.get() == 1 else 'hard', algId)
+
+    def isTranslatedSearch(self):
+        return self.getSelectedBLASTProgram() in ['tblastn', 'blastx', 'tblastx']
+
+    def isTranslatedQuery(self):
+        return self.getSelectedBLASTProgram() in ['blastx', 'tblastx']
+
+    def usesAutoTuning(self):
+        return self.autoTune.get() and self.getSelectedBLASTProgram() in ['blastn', 'megablast', 'dc-megablast',
+                                                                         'blastp', 'blastp-fast']
+
+    def usesPSSM(self):
+        return self.getSelectedBLASTProgram() in ['psi-blast', 'delta-blast']
+
+    def getProfileDatabase(self):
+        if self.localSearch.get() and self.profileDB.get() and self.profileDB.get().strip():
+            return self.profileDB.get().strip()
+        return self.getDatabaseName()
+
+    def getPSSMCacheDir(self, queryFasta, profileDB):
+        if not self.usePSSMCache.get():
+            return self._getTmpPath('pssmCheckpoints')
+
+        querySeq = ''.join(readFasta(queryFasta).values())
+        dbVersion = getDatabaseVersion(self.getDBPath(profileDB), Plugin.getDatabasesDir(),
+                                       remote=not self.localSearch.get())
+        params = '{} {} -max_target_seqs {}'.format(self.getSelectedBLASTProgram(), self.parseParameters(),
+                                                    self.maxEntries.get())
+        return os.path.join(Plugin.getPSSMCacheDir(), getPSSMCacheKey(querySeq, profileDB, dbVersion, params))
+
+    def getCheckpointPSSM(self, queryFasta, nRounds):
+        '''Returns a PSSM checkpoint built with nRounds iterations over the profile database.
+        The most advanced checkpoint in the cache is reused and only the missing iterations are run'''
+        profileDB = self.getProfileDatabase()
+        cacheDir = self.getPSSMCacheDir(queryFasta, profileDB)
+        cached = getCachedPSSMs(cacheDir)
+        prevRounds = max([k for k in cached if k <= nRounds], default=0)
+
+        if prevRounds < nRounds:
+            if prevRounds > 0:
+                program, args = 'psiblast', '-in_pssm {}'.format(cached[prevRounds])
+            else:
+                program, args = getBLASTProgramArgs(self.getSelectedBLASTProgram())
+                args = '-query {}{}'.format(queryFasta, args)
+
+            prefix = os.path.abspath(self._getTmpPath('checkpoint'))
+            args += ' -db {} -num_iterations {} -out {} -out_pssm {} -out_ascii_pssm {}_ascii ' \
+                    '-save_each_pssm -save_pssm_after_last_round'.\
+                format(self.getDBPath(profileDB), nRounds - prevRounds, prefix + '.out', prefix, prefix)
+            if self.maxEntries.get() > 0:
+                args += ' -max_target_seqs {}'.format(self.maxEntries.get())
+            if not self.localSearch.get():
+                args += ' -remote'
+            args += self.parseParameters()
+
+            Plugin.runBLAST(self, program, args, cwd=Plugin.getDatabasesDir())
+            storePSSMCheckpoints(prefix, cacheDir, prevRounds)
+            cached = getCachedPSSMs(cacheDir)
+        else:
+            print('Reusing PSSM checkpoint of {} rounds from cache: {}'.format(nRounds, cacheDir))
+
+        # The iterations may converge before the requested number of rounds
+        available = [k for k in cached if k <= nRounds]
+        return cached[max(available)] if available else None
+
+    def isInputStreaming(self):
+        '''Whether the input is a set still open to receive new sequences'''
+        inSeqs = self.inputSequence.get()
+        if isinstance(inSeqs, Sequence):
+            return False
+        inSeqs = SetOfSequences(filename=inSeqs.getFileName())
+        inSeqs.loadAllProperties()
+        streaming = inSeqs.isStreamOpen()
+        inSeqs.close()
+        return streaming
+
+    def getNewQueryIds(self):
+        '''Ids of the input queries not yet inserted in a search step'''
+        inSeqs = self.inputSequence.get()
+        if isinstance(inSeqs, Sequence):
+            objIds = [inSeqs.getObjId()]
+        else:
+            inSeqs = SetOfSequences(filename=inSeqs.getFileName())
+            objIds = sorted(inSeqs.getIdSet())
+            inSeqs.close()
+        return [objId for objId in objIds if objId not in self.insertedIds]
+
+    def getInputQueries(self, queryIds=None):
+        '''Returns the input queries as {objId: sequence}, optionally only those with the given ids'''
+        inSeqs = self.inputSequence.get()
+        if isinstance(inSeqs, Sequence):
+            return {inSeqs.getObjId(): inSeqs}
+        if queryIds is None:
+            return {seq.getObjId(): seq.clone() for seq in inSeqs}
+        inSeqs = SetOfSequences(filename=inSeqs.getFileName())
+        queries = {objId: inSeqs[objId].clone() for objId in queryIds}
+        inSeqs.close()
+        return queries
+
+    def writeUniqueQueries(self, queries, fastaFile, groupsFile):
+        '''Writes the unique query sequences (named Query_i) in a fasta file and stores which input queries each of
+        them represents. Returns the unique sequences as {label: sequence}'''
+        objIds = list(queries.keys())
+        uniqueSeqs, queryGroups = {}, {}
+        for i, (seq, queryIdxs) in enumerate(groupIdenticalSequences([queries[objId].getSequence()
+                                                                      for objId in objIds])):
+            label = 'Query_{}'.format(i + 1)
+            uniqueSeqs[label], queryGroups[label] = seq, [objIds[idx] for idx in queryIdxs]
+        writeFasta(uniqueSeqs, fastaFile)
+        with open(groupsFile, 'w') as f:
+            json.dump(queryGroups, f)
+
+        print('{} queries grouped into {} unique sequences'.format(len(queries), len(uniqueSeqs)))
+        return uniqueSeqs
+
+    def getQueryGroups(self, batchName):
+        with open(self.getBLASTOutputFile(batchName, 'json')) as f:
+            return json.load(f)
+
+    def getBatchName(self, queryIds, windowIdx=None, dbIdx=None):
+        batchName = 'batch_{}'.format(queryIds[0])
+        if windowIdx is not None:
+            batchName += '_window_{}'.format(windowIdx)
+        return batchName if dbIdx is None else '{}_db_{}'.format(batchName, dbIdx)
+
+    def getNumberOfWindows(self, queryIds):
+        if self.windowSize.get() <= 0:
+            return 1
+        maxLength = max(len(seq.getSequence()) for seq in self.getInputQueries(queryIds).values())
+        return len(getWindowStarts(maxLength, self.windowSize.get(), self.windowOverlap.get()))
+
+    def getBatchThreads(self, nWindows=1, dbName=None):
+        '''Threads of each local search, sharing the protocol threads among the searches run at the same time.
+        The threads of a batch searching several databases are split according to the database sizes'''
+        nThreads = max(1, self.numberOfThreads.get())
+        inSeqs, batchSize = self.inputSequence.get(), self.queryChunkSize.get()
+        nQueries = 1 if isinstance(inSeqs, Sequence) else inSeqs.getSize()
+        nBatches = -(-nQueries // batchSize) if batchSize > 0 else 1
+        batchThreads = max(1, nThreads // max(1, min(nThreads, nBatches * nWindows)))
+        if dbName is None or len(self.getSearchDatabases()) == 1:
+            return batchThreads
+        letters = self.getDatabaseLetters()
+        return max(1, int(round(batchThreads * letters[dbName] / max(1, sum(letters.values())))))
+
+    def getSearchChunks(self, uniqueSeqs, fullLengths=None):
+        '''Chunks of the unique queries of a search, each one checkpointed when its hits are written.
+        If fullLengths ({label: length of the whole query} of query windows), each chunk only has windows of queries
+        with the same length, since they are searched with the search space of the whole query'''
+        groups = [uniqueSeqs]
+        if fullLengths:
+            groups = {}
+            for label, seq in uniqueSeqs.items():
+                groups.setdefault(fullLengths[label], {})[label] = seq
+            groups = list(groups.values())
+
+        chunks, chunkSize = [], self.searchChunkSize.get()
+        for group in groups:
+            labels = list(group)
+            if chunkSize <= 0 or chunkSize >= len(labels):
+                chunks.append(group)
+                continue
+            chunks += [{label: group[label] for label in labels[i:i + chunkSize]}
+                       for i in range(0, len(labels), chunkSize)]
+        return chunks
+
+    def getFullQueryLengths(self, queryIds):
+        '''Lengths of the whole unique queries of a batch split in windows, written by prepareBatchStep'''
+        return {label: len(seq) for label, seq in
+                readFasta(self.getBLASTOutputFile(self.getBatchName(queryIds), 'fasta')).items()}
+
+    def getSearchKey(self, queryIds, windowIdx=None):
+        '''Key of the queries searched for a batch (or one of its windows), written by prepareBatchStep'''
+        return getQueriesKey(queryIds, readFasta(self.getBLASTOutputFile(self.getBatchName(queryIds, windowIdx),
+                                                                         'fasta')))
+
+    def loadSearchHits(self, batchName, queriesKey):
+        '''Hits of a finished search of the given queries, checking that all its chunks were completed'''
+        tsvFile = self.getBLASTOutputFile(batchName, 'tsv')
+        if not isDone(tsvFile, queries=queriesKey):
+            raise Exception('The search {} is not complete: {} is missing or does not match its completion marker'.
+                            format(batchName, os.path.basename(tsvFile)))
+        return parseHitTable(tsvFile, btop=True)
+
+    def getCheckpointFile(self):
+        return self._getExtraPath('doneQueries.jsonl')
+
+    def getDoneBatches(self):
+        '''Batches whose results are already in the output, as recorded in the checkpoint'''
+        if not os.path.exists(self.getCheckpointFile()):
+            return []
+        with open(self.getCheckpointFile()) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def getDoneQueryIds(self):
+        return [objId for batch in self.getDoneBatches() for objId in batch['ids']]
+
+    def getSubjectsCacheFile(self):
+        '''Cache of the subject sequences, the same used later by the output hit table'''
+        return os.path.splitext(self._getPath('hitTable.npy'))[0] + '_subjects.fasta'
+
+    def getRescoringParams(self):
+        '''Scoring of the Smith-Waterman re-scoring: the one of the search, or the BLAST defaults if empty'''
+        gapOpen, gapExtend = self.gapopen.get(), self.gapextend.get()
+        if self.checkMatchMismatchType() == MATCH:
+            return {'reward': int(float(self.reward.get() or 2)), 'penalty': int(float(self.penalty.get() or -3)),
+                    'gapOpen': int(float(gapOpen or 5)), 'gapExtend': int(float(gapExtend or 2))}
+        return {'matrixName': self.getEnumText('matrix'),
+                'gapOpen': int(float(gapOpen or 11)), 'gapExtend': int(float(gapExtend or 1))}
+
+    def getBLASTOutputFile(self, batchName, ext='txt'):
+        return os.path.abspath(self._getExtraPath('{}.{}'.format(batchName, ext)))
+
     def checkMatchMismatchType(self):
         if self.seqType.get() == NUCLEOTIDE and self.blastNucleotide.get() == 0:
             #Blastn: match/mismatch penalties and gap penalties
@@ -318,11 +1039,13 @@ class ProtChemBLAST(EMProtocol):
                 return self.getEnumText('blastNucleotide')
 
     #PARAMETERS PARSING
-    def parseParameters(self):
-        parArgs = ''
+    def parseParameters(self, overrides=None):
+        '''Arguments of the form parameters, some of them optionally replaced by overrides {parName: value}'''
+        parArgs, overrides = '', overrides or {}
         for parName in self.getConditionalParameters():
-            if getattr(self, parName).get() != '':
-                parArgs += ' -{} {}'.format(parName, getattr(self, parName).get())
+            value = overrides.get(parName, getattr(self, parName).get())
+            if value != '':
+                parArgs += ' -{} {}'.format(parName, value)
 
         if self.checkMatchMismatchType() != MATCH:
             parArgs += ' -matrix {}'.format(self.getEnumText('matrix'))
@@ -336,60 +1059,3 @@ class ProtChemBLAST(EMProtocol):
             return ['evalue', 'word_size', 'gapopen', 'gapextend']
         else:
             return ['evalue', 'word_size']
-
-
-    def parseBLASTOutput(self):
-        def goToNextLine(fIn, read=None):
-            line = ''
-            while line.strip() == '':
-                line = fIn.readline()
-            if read is not None:
-                read += 1
-            return line, read
-
-        inSeq = self.inputSequence.get()
-        outFile = os.path.abspath(self._getPath(getSequenceFastaName(inSeq) + '.txt'))
-        seqDic, read = {'Query_1': {'sequence': '', 'firstPosition': 1}}, 0
-        with open(outFile) as fIn:
-            for line in fIn:
-                if read == 0 and line.startswith('Sequences producing significant alignments'):
-
-                    read, line = 1, fIn.readline()
-                    while line.strip() == '':
-                        line = fIn.readline()
-
-                if read == 1:
-                    if line.strip() != '':
-                        line = line.strip().split()
-                        seqDic[line[0]] = {'description': ' '.join(line[1:-2]), 'score': line[-2], 'evalue': line[-1],
-                                           'sequence': ''}
-                    else:
-                        line, read = goToNextLine(fIn, read)
-
-                if read == 2:
-                    if line.strip() != '':
-                        sline = line.strip().split()
-                        if sline[0] in seqDic:
-                            seqDic[sline[0]]['sequence'] += line[15:75].replace(' ', '-')
-                            seqDic[sline[0]]['firstPosition'] = sline[1]
-                    else:
-                        line, read = goToNextLine(fIn, read)
-
-                if read == 3:
-                    if line.strip() != '':
-                        line = line.strip().split()
-                        if line[0] in seqDic:
-                            seqDic[line[0]]['sequence'] += line[2]
-        return seqDic
-
-
-
-
-
-
-
-
-
-
-
-
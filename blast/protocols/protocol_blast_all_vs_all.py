@@ -0,0 +1,189 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json
+import numpy as np
+
+from pwem.protocols import EMProtocol
+from pyworkflow.protocol.params import PointerParam, EnumParam, StringParam, BooleanParam, STEPS_PARALLEL, \
+    LEVEL_ADVANCED
+from pyworkflow import BETA
+from blast import Plugin
+
+from ..constants import blastpProgramsHelp, blastnProgramsHelp
+from ..objects import BLASTSimilarityMatrix
+from ..utils import getBLASTProgramArgs, getHitTableOutfmt, parseHitTable, exportIndexedFasta, readFasta, \
+    getTriangularChunks, buildSimilarityCoo, writeSimilarityMatrix
+
+PROTEIN, NUCLEOTIDE = 0, 1
+
+class ProtChemBLASTAllVsAll(EMProtocol):
+    """Performs an all vs all BLAST search of a set of sequences, producing a sparse similarity matrix
+    of bitscores and evalues"""
+    _label = 'BLAST all vs all'
+    _devStatus = BETA
+
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        group = form.addGroup('Input')
+        group.addParam('inputSequences', PointerParam, pointerClass='SetOfSequences',
+                       label='Input sequences: ', allowsNull=False,
+                       help="Set of sequences to compare all vs all")
+        group.addParam('seqType', EnumParam, default=0,
+                       choices=['Protein', 'Nucleotide'], display=EnumParam.DISPLAY_HLIST,
+                       label='Type of sequences: ')
+
+        group = form.addGroup('Program')
+        group.addParam('blastProteinProgram', EnumParam, default=0, choices=['blastp', 'blastp-fast'],
+                       condition='seqType=={}'.format(PROTEIN), label='Protein BLAST program: ',
+                       help='Protein BLAST program to execute:\n{}'.format(blastpProgramsHelp))
+        group.addParam('blastNucleotideProgram', EnumParam, default=0,
+                       choices=['blastn', 'megablast', 'dc-megablast'],
+                       condition='seqType=={}'.format(NUCLEOTIDE), label='Nucleotide BLAST program: ',
+                       help='Nucleotide BLAST program to execute:\n{}'.format(blastnProgramsHelp))
+        group.addParam('evalue', StringParam, default='1e-5',
+                       label='EValue for keep hits: ',
+                       help='Expectation value (E) threshold for saving hits.\nIf empty, default will be used')
+        group.addParam('symmetric', BooleanParam, default=False,
+                       label='Search each pair only once: ',
+                       help='Search each query only against the sequences after it in the set, skipping the '
+                            'mirrored half of the comparisons, and mirror the hits in the output matrix.\n'
+                            'Composition based statistics are disabled for protein searches in this mode so the '
+                            'scores are (almost) symmetric.')
+        group.addParam('extraArgs', StringParam, default='', expertLevel=LEVEL_ADVANCED,
+                       label='Extra BLAST arguments: ',
+                       help='Additional arguments for the BLAST program (e.g: -word_size 3)')
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        dbId = self._insertFunctionStep('createDatabaseStep', prerequisites=[])
+        searchIds = []
+        for chunkIdx in range(len(self.getChunks())):
+            searchIds.append(self._insertFunctionStep('searchChunkStep', chunkIdx, prerequisites=[dbId]))
+        self._insertFunctionStep('createOutputStep', prerequisites=searchIds)
+
+    def createDatabaseStep(self):
+        inFasta = self._getExtraPath('allSequences.fasta')
+        names = exportIndexedFasta(self.inputSequences.get(), inFasta)
+
+        seqs = list(readFasta(inFasta).values())
+        with open(self.getInfoFile(), 'w') as f:
+            json.dump({'names': names, 'nLetters': int(sum(len(seq) for seq in seqs))}, f)
+
+        dbClass = 'prot' if self.seqType.get() == PROTEIN else 'nucl'
+        args = ' -in {} -parse_seqids -dbtype {} -out {}'.format(os.path.abspath(inFasta), dbClass, self.getDBPath())
+        Plugin.runBLAST(self, 'makeblastdb', args, cwd=self._getExtraPath())
+
+        for chunkIdx, (start, end) in enumerate(self.getChunks()):
+            with open(self.getChunkFile(chunkIdx, 'fasta'), 'w') as f:
+                for i in range(start, end):
+                    f.write('>seq_{}\n{}\n'.format(i, seqs[i]))
+
+            if self.symmetric.get():
+                #Each query chunk only searched against the sequences from its first query
+                with open(self.getChunkFile(chunkIdx, 'ids'), 'w') as f:
+                    f.write('\n'.join(['seq_{}'.format(i) for i in range(start, len(seqs))]) + '\n')
+                args = ' -seqid_file_in {} -seqid_file_out {}'.format(self.getChunkFile(chunkIdx, 'ids'),
+                                                                       self.getChunkFile(chunkIdx, 'bsl'))
+                Plugin.runBLAST(self, 'blastdb_aliastool', args, cwd=self._getExtraPath())
+
+    def searchChunkStep(self, chunkIdx):
+        info = self.getDatabaseInfo()
+        nSeqs = len(info['names'])
+        program, args = getBLASTProgramArgs(self.getSelectedBLASTProgram())
+
+        # The database size is fixed so that evalues are comparable between chunks searching database subsets
+        args += ' -query {} -db {} -out {} -outfmt "{}" -max_target_seqs {} -dbsize {} -num_threads 1'.\
+            format(self.getChunkFile(chunkIdx, 'fasta'), self.getDBPath(), self.getChunkFile(chunkIdx, 'tsv'),
+                   getHitTableOutfmt(), nSeqs, info['nLetters'])
+        if self.evalue.get():
+            args += ' -evalue {}'.format(self.evalue.get())
+        if self.symmetric.get():
+            args += ' -seqidlist {}'.format(self.getChunkFile(chunkIdx, 'bsl'))
+            if self.seqType.get() == PROTEIN:
+                args += ' -comp_based_stats 0'
+        if self.extraArgs.get():
+            args += ' {}'.format(self.extraArgs.get())
+
+        Plugin.runBLAST(self, program, args, cwd=self._getExtraPath())
+
+    def createOutputStep(self):
+        names = self.getDatabaseInfo()['names']
+        hits = np.concatenate([parseHitTable(self.getChunkFile(chunkIdx, 'tsv'))
+                               for chunkIdx in range(len(self.getChunks()))])
+        rows, cols, bitscores, evalues = buildSimilarityCoo(hits, symmetric=self.symmetric.get())
+
+        outFile = writeSimilarityMatrix(self._getPath('similarityMatrix.npz'), rows, cols, bitscores, evalues, names)
+        outMatrix = BLASTSimilarityMatrix(filename=outFile, size=len(names))
+        self._defineOutputs(outputSimilarityMatrix=outMatrix)
+        self._defineSourceRelation(self.inputSequences, outMatrix)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+        if self.inputSequences.get() is not None and self.inputSequences.get().getSize() < 2:
+            errors.append('At least two sequences are needed for an all vs all search')
+        return errors
+
+    def _summary(self):
+        summary = []
+        if hasattr(self, 'outputSimilarityMatrix'):
+            nPairs = self.outputSimilarityMatrix.getMatrix().nnz
+            summary.append('{} hits found among {} sequences'.format(nPairs, self.outputSimilarityMatrix.getSize()))
+        return summary
+
+    # --------------------------- UTILS functions -----------------------------------
+    def getSelectedBLASTProgram(self):
+        if self.seqType.get() == PROTEIN:
+            return self.getEnumText('blastProteinProgram')
+        else:
+            return self.getEnumText('blastNucleotideProgram')
+
+    def getChunks(self):
+        nSeqs, nChunks = self.inputSequences.get().getSize(), max(1, self.numberOfThreads.get())
+        if self.symmetric.get():
+            return getTriangularChunks(nSeqs, nChunks)
+        limits = np.unique(np.linspace(0, nSeqs, min(nChunks, nSeqs) + 1).astype(int))
+        return [(int(start), int(end)) for start, end in zip(limits[:-1], limits[1:])]
+
+    def getDBPath(self):
+        return os.path.abspath(self._getExtraPath('allVsAllDB'))
+
+    def getInfoFile(self):
+        return self._getExtraPath('databaseInfo.json')
+
+    def getDatabaseInfo(self):
+        with open(self.getInfoFile()) as f:
+            return json.load(f)
+
+    def getChunkFile(self, chunkIdx, ext):
+        return os.path.abspath(self._getExtraPath('chunk_{}.{}'.format(chunkIdx, ext)))
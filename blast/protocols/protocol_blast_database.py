@@ -24,13 +24,15 @@
 # *
 # **************************************************************************
 
-import os
+import os, glob
 
 from pwem.protocols import EMProtocol
-from pyworkflow.protocol.params import PointerParam, BooleanParam, StringParam, EnumParam
+from pyworkflow.protocol.params import PointerParam, BooleanParam, StringParam, EnumParam, STEPS_PARALLEL
 from pyworkflow import BETA
+from pyworkflow.object import String
 from blast import Plugin, BLAST_DIC
-from ..constants import BLASTdbs
+from ..constants import BLASTdbs, maskChoices, LOW_COMPLEXITY, REPEATS
+from ..utils import splitFasta
 
 class ProtChemBLASTDatabase(EMProtocol):
     """Creates a BLAST database locally from a set of sequences or downloading from ncbi databases"""
@@ -39,6 +41,8 @@ class ProtChemBLASTDatabase(EMProtocol):
 
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+        self.dbSnapshot = String()
 
     def _defineParams(self, form):
         form.addSection(label='Input')
@@ -61,44 +65,115 @@ class ProtChemBLASTDatabase(EMProtocol):
         group.addParam('titleDB', StringParam,
                        label='New database name:', condition='not fromNCBI',
                        help="Name to designate the new database")
+        group.addParam('maskType', EnumParam, default=0, condition='not fromNCBI', choices=maskChoices,
+                       label='Precompute masks: ',
+                       help='Compute masks of the database sequences and store them in the database, so searches '
+                            'can use them with -db_soft_mask / -db_hard_mask instead of filtering on the fly.\n'
+                            'Low complexity regions are masked with dustmasker (nucleotides) or segmasker '
+                            '(proteins). Repeats are masked with windowmasker (only nucleotides).\n'
+                            'The masks are computed in parallel over chunks of the sequences.')
+
+        form.addParallelSection(threads=4, mpi=1)
 
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
         if self.fromNCBI:
             self._insertFunctionStep('downloadDatabaseStep')
-        else:
+        elif self.maskType.get() == 0:
             self._insertFunctionStep('createDatabaseStep')
+        else:
+            maskIds = []
+            nChunks = max(1, self.numberOfThreads.get())
+            exportId = self._insertFunctionStep('exportChunksStep', nChunks, prerequisites=[])
+            if self.maskType.get() == REPEATS:
+                exportId = self._insertFunctionStep('windowmaskerCountsStep', prerequisites=[exportId])
+            for chunkIdx in range(nChunks):
+                maskIds.append(self._insertFunctionStep('maskChunkStep', chunkIdx, prerequisites=[exportId]))
+            self._insertFunctionStep('createDatabaseStep', prerequisites=maskIds)
 
     def downloadDatabaseStep(self):
         dbName = self.getEnumText('inputID')
         args = ' --decompress {} -passive'.format(dbName)
-        outDir = Plugin.getDatabasesDir()
-        if not os.path.exists(outDir):
-            os.mkdir(outDir)
-
-        Plugin.updateDatabase(self, args, cwd=outDir)
-        print('Database has been downloaded into {} directory'.format(outDir))
+        # Downloaded next to the current version, so only the changed volumes are fetched
+        stagingDir = Plugin.getDatabaseStore().createStaging(dbName)
+        Plugin.updateDatabase(self, args, cwd=stagingDir)
+        self.commitSnapshot(dbName, stagingDir)
+        print('Database has been downloaded into {} directory'.format(Plugin.getDatabasesDir()))
+
+    def exportChunksStep(self, nChunks):
+        inFasta = self.exportDatabaseFasta()
+        chunkFiles = splitFasta(inFasta, nChunks, self._getExtraPath('chunk_{}.fasta'))
+        print('Sequences split into {} chunks for masking'.format(len(chunkFiles)))
+
+    def windowmaskerCountsStep(self):
+        args = ' -in {} -infmt fasta -mk_counts -parse_seqids -out {}'.\
+            format(os.path.abspath(self._getPath('database.fasta')), os.path.abspath(self.getCountsFile()))
+        Plugin.runBLAST(self, 'windowmasker', args, cwd=self._getExtraPath())
+
+    def maskChunkStep(self, chunkIdx):
+        chunkFile = os.path.abspath(self._getExtraPath('chunk_{}.fasta'.format(chunkIdx)))
+        if not os.path.exists(chunkFile):
+            # Less sequences than chunks
+            return
+        args = ' -in {} -infmt fasta -parse_seqids -outfmt maskinfo_asn1_bin -out {}'.\
+            format(chunkFile, os.path.abspath(self._getExtraPath('chunk_{}.asnb'.format(chunkIdx))))
+        if self.maskType.get() == REPEATS:
+            program = 'windowmasker'
+            args += ' -ustat {}'.format(os.path.abspath(self.getCountsFile()))
+        else:
+            program = 'segmasker' if self.dbType.get() == 0 else 'dustmasker'
+        Plugin.runBLAST(self, program, args, cwd=self._getExtraPath())
 
     def createDatabaseStep(self):
-        inSeqs = self.inputSequences.get()
         inFasta = self._getPath('database.fasta')
-
-        inSeqs.exportToFile(seqFileName=inFasta)
+        if not os.path.exists(inFasta):
+            self.exportDatabaseFasta()
         dbClass = 'prot' if self.dbType.get() == 0 else 'nucl'
-        outDir = Plugin.getDatabasesDir()
+        outDir = Plugin.getDatabaseStore().createStaging(self.titleDB.get(), seed=False)
 
         args = ' -in {} -parse_seqids -title "{}" -dbtype {} -out {}'.\
           format(os.path.abspath(inFasta), self.titleDB.get(), dbClass, os.path.join(outDir, self.titleDB.get()))
+        if self.maskType.get() != 0:
+            maskFiles = sorted(glob.glob(os.path.abspath(self._getExtraPath('chunk_*.asnb'))))
+            args += ' -mask_data {}'.format(','.join(maskFiles))
 
         Plugin.runBLAST(self, 'makeblastdb', args, cwd=outDir)
-        print('Database has been created as {} into {} directory'.format(self.titleDB.get(), outDir))
-
+        self.commitSnapshot(self.titleDB.get(), outDir)
+        print('Database has been created as {} into {} directory'.format(self.titleDB.get(), Plugin.getDatabasesDir()))
+
+    def commitSnapshot(self, dbName, stagingDir):
+        '''Stores the new version of the database as a snapshot referenced by this protocol and collects the
+        unreferenced old ones'''
+        store = Plugin.getDatabaseStore()
+        snapshotId = store.commitSnapshot(dbName, stagingDir)
+        store.addReference(dbName, snapshotId, os.path.abspath(self.getWorkingDir()))
+        self.dbSnapshot.set(snapshotId)
+        self._store(self.dbSnapshot)
+        store.collectGarbage(Plugin.getStoreQuota())
+
+
+    def _summary(self):
+        summary = []
+        if self.dbSnapshot.get():
+            dbName = self.getEnumText('inputID') if self.fromNCBI else self.titleDB.get()
+            summary.append('Database {} stored as snapshot {}'.format(dbName, self.dbSnapshot.get()))
+        return summary
 
     def _validate(self):
         errors=[]
+        if not self.fromNCBI and self.maskType.get() == REPEATS and self.dbType.get() == 0:
+            errors.append('Repeats can only be masked with windowmasker in nucleotide databases')
         return errors
 
+    def exportDatabaseFasta(self):
+        inFasta = self._getPath('database.fasta')
+        self.inputSequences.get().exportToFile(seqFileName=inFasta)
+        return inFasta
+
+    def getCountsFile(self):
+        return self._getExtraPath('windowmasker.counts')
+
     def _warnings(self):
         warns = []
         if not self.fromNCBI:
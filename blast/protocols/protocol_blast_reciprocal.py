@@ -0,0 +1,164 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json
+import numpy as np
+
+from pwem.protocols import EMProtocol
+from pyworkflow.protocol.params import PointerParam, EnumParam, StringParam, IntParam, STEPS_PARALLEL, \
+    LEVEL_ADVANCED
+from pyworkflow import BETA
+from blast import Plugin
+
+from ..constants import blastpProgramsHelp, blastnProgramsHelp, PAIR_TABLE_DTYPE
+from ..objects import BLASTPairTable
+from ..utils import getBLASTProgramArgs, getHitTableOutfmt, parseHitTable, exportIndexedFasta, writeHitTable, \
+    getReciprocalBestHits, getIndexedIds, getFittedDtype
+
+PROTEIN, NUCLEOTIDE = 0, 1
+SET_A, SET_B = 'A', 'B'
+
+class ProtChemBLASTReciprocal(EMProtocol):
+    """Finds the reciprocal best hits (putative orthologs) between two sets of sequences, running the forward
+    and reverse BLAST searches concurrently"""
+    _label = 'BLAST reciprocal best hits'
+    _devStatus = BETA
+
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        group = form.addGroup('Input')
+        group.addParam('inputSequencesA', PointerParam, pointerClass='SetOfSequences',
+                       label='First set of sequences: ', allowsNull=False,
+                       help="First set of sequences (e.g: proteome of the first organism)")
+        group.addParam('inputSequencesB', PointerParam, pointerClass='SetOfSequences',
+                       label='Second set of sequences: ', allowsNull=False,
+                       help="Second set of sequences (e.g: proteome of the second organism)")
+        group.addParam('seqType', EnumParam, default=0,
+                       choices=['Protein', 'Nucleotide'], display=EnumParam.DISPLAY_HLIST,
+                       label='Type of sequences: ')
+
+        group = form.addGroup('Program')
+        group.addParam('blastProteinProgram', EnumParam, default=0, choices=['blastp', 'blastp-fast'],
+                       condition='seqType=={}'.format(PROTEIN), label='Protein BLAST program: ',
+                       help='Protein BLAST program to execute:\n{}'.format(blastpProgramsHelp))
+        group.addParam('blastNucleotideProgram', EnumParam, default=0,
+                       choices=['blastn', 'megablast', 'dc-megablast'],
+                       condition='seqType=={}'.format(NUCLEOTIDE), label='Nucleotide BLAST program: ',
+                       help='Nucleotide BLAST program to execute:\n{}'.format(blastnProgramsHelp))
+        group.addParam('evalue', StringParam, default='1e-5',
+                       label='EValue for keep hits: ',
+                       help='Expectation value (E) threshold for saving hits.\nIf empty, default will be used')
+        group.addParam('maxEntries', IntParam, default=5, expertLevel=LEVEL_ADVANCED,
+                       label='Hits per query: ',
+                       help='Number of hits kept per query (-max_target_seqs) to choose the best one from')
+        group.addParam('extraArgs', StringParam, default='', expertLevel=LEVEL_ADVANCED,
+                       label='Extra BLAST arguments: ',
+                       help='Additional arguments for the BLAST program (e.g: -word_size 3)')
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        dbIds = [self._insertFunctionStep('createDatabaseStep', setKey, prerequisites=[])
+                 for setKey in [SET_A, SET_B]]
+        searchIds = [self._insertFunctionStep('searchStep', SET_A, SET_B, prerequisites=dbIds),
+                     self._insertFunctionStep('searchStep', SET_B, SET_A, prerequisites=dbIds)]
+        self._insertFunctionStep('createOutputStep', prerequisites=searchIds)
+
+    def createDatabaseStep(self, setKey):
+        inFasta = self.getSetFile(setKey, 'fasta')
+        names = exportIndexedFasta(self.getInputSet(setKey), inFasta, prefix=setKey + '_')
+        with open(self.getSetFile(setKey, 'json'), 'w') as f:
+            json.dump(names, f)
+
+        dbClass = 'prot' if self.seqType.get() == PROTEIN else 'nucl'
+        args = ' -in {} -parse_seqids -dbtype {} -out {}'.format(inFasta, dbClass, self.getSetFile(setKey, 'db'))
+        Plugin.runBLAST(self, 'makeblastdb', args, cwd=self._getExtraPath())
+
+    def searchStep(self, querySet, dbSet):
+        # Both directions run at the same time, each with half of the threads
+        nThreads = max(1, self.numberOfThreads.get() // 2)
+        program, args = getBLASTProgramArgs(self.getSelectedBLASTProgram())
+        args += ' -query {} -db {} -out {} -outfmt "{}" -max_target_seqs {} -max_hsps 1 -num_threads {}'.\
+            format(self.getSetFile(querySet, 'fasta'), self.getSetFile(dbSet, 'db'),
+                   self.getSearchFile(querySet, dbSet), getHitTableOutfmt(), self.maxEntries.get(), nThreads)
+        if self.evalue.get():
+            args += ' -evalue {}'.format(self.evalue.get())
+        if self.extraArgs.get():
+            args += ' {}'.format(self.extraArgs.get())
+
+        Plugin.runBLAST(self, program, args, cwd=self._getExtraPath())
+
+    def createOutputStep(self):
+        forwardHits = parseHitTable(self.getSearchFile(SET_A, SET_B))
+        reverseHits = parseHitTable(self.getSearchFile(SET_B, SET_A))
+        pairs = getReciprocalBestHits(forwardHits, reverseHits)
+
+        pairNames = {}
+        for setKey, field in [(SET_A, 'seqA'), (SET_B, 'seqB')]:
+            names = np.asarray(self.getSetNames(setKey), dtype=str)
+            pairNames[field] = names[getIndexedIds(pairs[field], prefix=setKey + '_')]
+        # The columns are widened to fit the sequence names, longer than the indexed ids
+        pairs = pairs.astype(getFittedDtype(PAIR_TABLE_DTYPE, pairNames))
+        for field, names in pairNames.items():
+            pairs[field] = names
+
+        outFile = writeHitTable(pairs, self._getPath('reciprocalBestHits.npy'))
+        outPairs = BLASTPairTable(filename=outFile, size=len(pairs))
+        self._defineOutputs(outputPairs=outPairs)
+        self._defineSourceRelation(self.inputSequencesA, outPairs)
+        self._defineSourceRelation(self.inputSequencesB, outPairs)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        if hasattr(self, 'outputPairs'):
+            summary.append('{} reciprocal best hit pairs found'.format(self.outputPairs.getSize()))
+        return summary
+
+    # --------------------------- UTILS functions -----------------------------------
+    def getSelectedBLASTProgram(self):
+        if self.seqType.get() == PROTEIN:
+            return self.getEnumText('blastProteinProgram')
+        else:
+            return self.getEnumText('blastNucleotideProgram')
+
+    def getInputSet(self, setKey):
+        return self.inputSequencesA.get() if setKey == SET_A else self.inputSequencesB.get()
+
+    def getSetFile(self, setKey, ext):
+        return os.path.abspath(self._getExtraPath('set{}.{}'.format(setKey, ext)))
+
+    def getSetNames(self, setKey):
+        with open(self.getSetFile(setKey, 'json')) as f:
+            return json.load(f)
+
+    def getSearchFile(self, querySet, dbSet):
+        return os.path.abspath(self._getExtraPath('search{}vs{}.tsv'.format(querySet, dbSet)))
@@ -0,0 +1,265 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json, time
+import numpy as np
+
+from pwem.protocols import EMProtocol
+from pyworkflow.protocol.params import PointerParam, EnumParam, StringParam, IntParam, STEPS_PARALLEL, \
+    LEVEL_ADVANCED
+from pyworkflow.object import String
+from pyworkflow import BETA
+from blast import Plugin
+
+from ..constants import blastpProgramsHelp, blastnProgramsHelp, SWEEP_TABLE_DTYPE
+from ..objects import BLASTSweepTable
+from ..staging import getSourceFiles
+from ..utils import getBLASTProgramArgs, getHitTableOutfmt, parseHitTable, exportIndexedFasta, splitGridValues, \
+    getParameterGrid, getCombinationErrors, getCombinationArgs, getPairOverlaps, writeSweepTable, getFittedDtype
+
+PROTEIN, NUCLEOTIDE = 0, 1
+SWEEP_PARAMS = ['evalue', 'word_size', 'matrix', 'gaps', 'matchMismatch']
+
+class ProtChemBLASTSweep(EMProtocol):
+    """Runs a BLAST search of a set of sequences against a local database for every combination of a grid of
+    parameters, comparing the number of hits, runtimes and overlap of the hits found by each combination"""
+    _label = 'BLAST parameter sweep'
+    _devStatus = BETA
+
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+        self.dbSnapshot = String()
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        group = form.addGroup('Input')
+        group.addParam('inputSequences', PointerParam, pointerClass='SetOfSequences',
+                       label='Input sequences: ', allowsNull=False,
+                       help="Set of query sequences searched with every combination of parameters")
+        group.addParam('seqType', EnumParam, default=0,
+                       choices=['Protein', 'Nucleotide'], display=EnumParam.DISPLAY_HLIST,
+                       label='Type of sequences: ')
+        group.addParam('dbName', StringParam, default='',
+                       label='Local database name: ',
+                       help='Name of a database from those downloaded in {}. Use the wizard to choose one of them'.
+                       format(Plugin.getDatabasesDir()))
+
+        group = form.addGroup('Program')
+        group.addParam('blastProteinProgram', EnumParam, default=0, choices=['blastp', 'blastp-fast'],
+                       condition='seqType=={}'.format(PROTEIN), label='Protein BLAST program: ',
+                       help='Protein BLAST program to execute:\n{}'.format(blastpProgramsHelp))
+        group.addParam('blastNucleotideProgram', EnumParam, default=0,
+                       choices=['blastn', 'megablast', 'dc-megablast'],
+                       condition='seqType=={}'.format(NUCLEOTIDE), label='Nucleotide BLAST program: ',
+                       help='Nucleotide BLAST program to execute:\n{}'.format(blastnProgramsHelp))
+        group.addParam('maxEntries', IntParam, default=50, expertLevel=LEVEL_ADVANCED,
+                       label='Hits per query: ',
+                       help='Number of hits kept per query (-max_target_seqs)')
+        group.addParam('extraArgs', StringParam, default='', expertLevel=LEVEL_ADVANCED,
+                       label='Extra BLAST arguments: ',
+                       help='Additional arguments for the BLAST program, shared by all the combinations')
+
+        group = form.addGroup('Parameter grid')
+        group.addParam('evalues', StringParam, default='1e-5, 1e-3',
+                       label='EValues: ',
+                       help='Expectation value thresholds to try, separated by commas.\n'
+                            'Empty values keep the BLAST default in all the grid parameters')
+        group.addParam('wordSizes', StringParam, default='',
+                       label='Word sizes: ',
+                       help='Word sizes to try, separated by commas')
+        group.addParam('matrices', StringParam, default='BLOSUM62', condition='seqType=={}'.format(PROTEIN),
+                       label='Scoring matrices: ',
+                       help='Protein scoring matrices to try, separated by commas (e.g: BLOSUM62, BLOSUM45)')
+        group.addParam('matchMismatch', StringParam, default='', condition='seqType=={}'.format(NUCLEOTIDE),
+                       label='Match/mismatch scores: ',
+                       help='Nucleotide match/mismatch scores to try, separated by commas (e.g: 1/-2, 2/-3)')
+        group.addParam('gapCosts', StringParam, default='',
+                       label='Gap costs: ',
+                       help='Gap open/extend costs to try, separated by commas (e.g: 11/1, 10/1).\n'
+                            'Every combination must be accepted by BLAST for its scoring matrix or '
+                            'match/mismatch scores, which is checked before running any search')
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        # The queries are prepared and the database read once, shared by all the combinations
+        prepId = self._insertFunctionStep('prepareQueriesStep', prerequisites=[])
+        pinId = self._insertFunctionStep('pinDatabaseStep', prerequisites=[])
+        loadId = self._insertFunctionStep('loadDatabaseStep', prerequisites=[pinId])
+        searchIds = []
+        for comboIdx in range(len(self.getCombinations())):
+            searchIds.append(self._insertFunctionStep('searchStep', comboIdx, prerequisites=[prepId, loadId]))
+        self._insertFunctionStep('createOutputStep', prerequisites=searchIds)
+
+    def prepareQueriesStep(self):
+        names = exportIndexedFasta(self.inputSequences.get(), self.getQueriesFile())
+        with open(self._getExtraPath('queryNames.json'), 'w') as f:
+            json.dump(names, f)
+
+    def pinDatabaseStep(self):
+        '''Records the snapshot of the database searched by all the combinations, even if it is updated later'''
+        dbName, store = self.getDatabaseName(), Plugin.getDatabaseStore()
+        snapshotId = self.dbSnapshot.get() or store.getCurrentSnapshot(dbName)
+        if snapshotId is None:
+            print('Database {} is not in the versioned store, it is searched by name'.format(dbName))
+            return
+        store.addReference(dbName, snapshotId, os.path.abspath(self.getWorkingDir()))
+        self.dbSnapshot.set(snapshotId)
+        self._store(self.dbSnapshot)
+
+    def loadDatabaseStep(self):
+        '''Stages the database (if a scratch directory is configured) and reads its volumes once, so that they are
+        in the page cache for the concurrent searches'''
+        nBytes = 0
+        with Plugin.getStagedDatabase(self.getDBPath()) as staged:
+            for dbFile in getSourceFiles(staged.path, Plugin.getDatabasesDir())[2]:
+                with open(dbFile, 'rb') as f:
+                    while True:
+                        block = f.read(1 << 24)
+                        if not block:
+                            break
+                        nBytes += len(block)
+        print('{:.1f} MB of database {} loaded'.format(nBytes / 1e6, self.getDatabaseName()))
+
+    def searchStep(self, comboIdx):
+        combo = self.getCombinations()[comboIdx]
+        program, args = getBLASTProgramArgs(self.getSelectedBLASTProgram())
+        args += ' -query {} -out {} -outfmt "{}" -max_target_seqs {}'.\
+            format(self.getQueriesFile(), self.getComboFile(comboIdx, 'tsv'), getHitTableOutfmt(),
+                   self.maxEntries.get())
+        args += getCombinationArgs(combo)
+        if self.extraArgs.get():
+            args += ' {}'.format(self.extraArgs.get())
+
+        # The combinations go through the host admission, which may run them with fewer threads
+        dbPath = self.getDBPath()
+        with Plugin.getStagedDatabase(dbPath) as staged, \
+                Plugin.getSearchAdmission(dbPath, self.getComboThreads(), self.inputSequences.get().getSize()) as adm:
+            start = time.time()
+            Plugin.runBLAST(self, program, args + ' -db {} -num_threads {}'.format(staged.path, adm.threads),
+                            cwd=staged.dir or Plugin.getDatabasesDir(), blastDB=staged.dir)
+            seconds = time.time() - start
+        with open(self.getComboFile(comboIdx, 'json'), 'w') as f:
+            json.dump({'seconds': seconds, 'threads': adm.threads}, f)
+
+    def createOutputStep(self):
+        combos = self.getCombinations()
+        hitTables = [parseHitTable(self.getComboFile(comboIdx, 'tsv')) for comboIdx in range(len(combos))]
+
+        rows = []
+        for comboIdx, (combo, hits) in enumerate(zip(combos, hitTables)):
+            with open(self.getComboFile(comboIdx, 'json')) as f:
+                seconds = json.load(f)['seconds']
+            rows.append((self.getComboLabel(combo), *[combo[parName] for parName in SWEEP_PARAMS],
+                         len(hits), len(set(zip(hits['qseqid'], hits['sseqid']))),
+                         len(np.unique(hits['qseqid'])), seconds))
+        strFields = ['label'] + SWEEP_PARAMS
+        table = np.array(rows, dtype=getFittedDtype(SWEEP_TABLE_DTYPE, {name: [str(row[i]) for row in rows]
+                                                                         for i, name in enumerate(strFields)}))
+        overlaps = getPairOverlaps(hitTables)
+        self.writeComparisonTsv(table, overlaps)
+
+        outFile = writeSweepTable(self._getPath('parameterSweep.npz'), table, overlaps)
+        outTable = BLASTSweepTable(filename=outFile, size=len(combos))
+        self._defineOutputs(outputSweep=outTable)
+        self._defineSourceRelation(self.inputSequences, outTable)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+        if not self.getDatabaseName():
+            errors.append('Choose the local database to search')
+        elif self.getDatabaseName() not in Plugin.getLocalDatabases():
+            errors.append('Database {} not found in {}'.format(self.getDatabaseName(), Plugin.getDatabasesDir()))
+        program = self.getSelectedBLASTProgram()
+        for combo in self.getCombinations():
+            for error in getCombinationErrors(combo, program):
+                errors.append('{}: {}'.format(self.getComboLabel(combo), error))
+        return errors
+
+    def _summary(self):
+        summary = []
+        if hasattr(self, 'outputSweep'):
+            table = self.outputSweep.getTable()
+            summary.append('{} combinations of parameters searched against {}'.
+                           format(len(table), self.getDatabaseName()))
+            for row in table:
+                summary.append('{}: {} hits ({} pairs) in {:.1f} s'.
+                               format(row['label'], row['nHits'], row['nPairs'], row['seconds']))
+        return summary
+
+    # --------------------------- UTILS functions -----------------------------------
+    def getSelectedBLASTProgram(self):
+        if self.seqType.get() == PROTEIN:
+            return self.getEnumText('blastProteinProgram')
+        else:
+            return self.getEnumText('blastNucleotideProgram')
+
+    def getDatabaseName(self):
+        return self.dbName.get().strip() if self.dbName.get() else ''
+
+    def getDBPath(self):
+        '''Path of the snapshot of the database searched, or its name if it is not in the store'''
+        if not self.dbSnapshot.get():
+            return self.getDatabaseName()
+        dbName = self.getDatabaseName()
+        return os.path.join(Plugin.getDatabaseStore().getSnapshotDir(dbName, self.dbSnapshot.get()), dbName)
+
+    def getCombinations(self):
+        '''Combinations of the grid parameters, the scoring of the other type of sequences left empty'''
+        isProtein = self.seqType.get() == PROTEIN
+        matrices = self.matrices.get() or '' if isProtein else ''
+        matchMismatch = '' if isProtein else self.matchMismatch.get() or ''
+        return getParameterGrid({'evalue': splitGridValues(self.evalues.get() or ''),
+                                 'word_size': splitGridValues(self.wordSizes.get() or ''),
+                                 'matrix': splitGridValues(matrices),
+                                 'gaps': splitGridValues(self.gapCosts.get() or ''),
+                                 'matchMismatch': splitGridValues(matchMismatch)})
+
+    def getComboLabel(self, combo):
+        label = ', '.join(['{}={}'.format(parName, combo[parName]) for parName in SWEEP_PARAMS if combo[parName]])
+        return label or 'defaults'
+
+    def getComboThreads(self):
+        '''The combinations run at the same time, sharing the threads of the protocol'''
+        return max(1, self.numberOfThreads.get() // len(self.getCombinations()))
+
+    def getQueriesFile(self):
+        return os.path.abspath(self._getExtraPath('queries.fasta'))
+
+    def getComboFile(self, comboIdx, ext):
+        return os.path.abspath(self._getExtraPath('combination_{}.{}'.format(comboIdx, ext)))
+
+    def writeComparisonTsv(self, table, overlaps):
+        with open(self._getPath('parameterSweep.tsv'), 'w') as f:
+            f.write('\t'.join(['combination', 'nHits', 'nPairs', 'nQueries', 'seconds'] +
+                              ['overlap_{}'.format(i) for i in range(len(table))]) + '\n')
+            for i, row in enumerate(table):
+                f.write('\t'.join([row['label'], str(row['nHits']), str(row['nPairs']), str(row['nQueries']),
+                                   '{:.2f}'.format(row['seconds'])] +
+                                  ['{:.3f}'.format(overlap) for overlap in overlaps[i]]) + '\n')
@@ -25,15 +25,19 @@
 # **************************************************************************
 
 import os, json
-from Bio import Entrez
+from concurrent.futures import ThreadPoolExecutor
 
 from pwem.protocols import EMProtocol
 from pwem.objects import Sequence, SetOfSequences
-from pwchem.objects import SmallMolecule, SetOfSmallMolecules
-from pyworkflow.protocol.params import TextParam, StringParam, EnumParam, STEPS_PARALLEL, IntParam, LabelParam
+from pyworkflow.protocol.params import TextParam, StringParam, EnumParam, STEPS_PARALLEL, IntParam, LabelParam, \
+    BooleanParam, LEVEL_ADVANCED
 from pyworkflow import BETA
 
+from blast import Plugin
+from ..utils import fetchLocalSequences, writeFasta, esearchPages, efetchFastaRecords, fetchPubChemSDF
+
 IDS, KEYS = 0, 1
+LOCAL_PROT_DBS, LOCAL_NUC_DBS = ['swissprot', 'refseq_protein', 'nr'], ['refseq_rna', 'nt']
 
 class ProtChemNCBIDownload(EMProtocol):
     """Download the Fasta file(s) from NCBI databases"""
@@ -59,37 +63,73 @@ class ProtChemNCBIDownload(EMProtocol):
         group.addParam('inputID', StringParam, label='NCBI ID / keyword: ', help="NCBI ID / keyword for the query")
         group.addParam('maxEntries', IntParam, label='Maximum number of entries: ', condition="searchMode==1",
                        default=5, help="maximum number of entries to take into account in the search")
+        group.addParam('pageSize', IntParam, label='Entries per page: ', condition="searchMode==1",
+                       default=500, expertLevel=LEVEL_ADVANCED,
+                       help="The keyword searches are stored in the NCBI history server and their results are "
+                            "retrieved in pages of this size. Each page is fetched while the next one is searched")
         group.addParam('addEntry', LabelParam, label='Add ID / keyword: ', help='Add ID / keyword to the list')
 
         group.addParam('listIDs', TextParam, width=60, label='List of IDs / keywords:',
                        help='List of IDs /keywords to be searched in NCBI databases')
 
+        group = form.addGroup('Local resolution', condition='searchMode==0 and dbType!=2')
+        group.addParam('localFirst', BooleanParam, default=False, label='Look up IDs in local databases first: ',
+                       help='Resolve the IDs with a single batched blastdbcmd lookup in the local BLAST databases '
+                            '(stored in {}). Only the IDs not found locally are fetched from NCBI'.
+                       format(Plugin.getDatabasesDir()))
+        group.addParam('localDBs', StringParam, default='', condition='localFirst',
+                       expertLevel=LEVEL_ADVANCED, label='Local databases: ',
+                       help='Space separated names of the local BLAST databases to look up, in order.\n'
+                            'If empty, the available ones among {} (protein) or {} (nucleotide) are used'.
+                       format(LOCAL_PROT_DBS, LOCAL_NUC_DBS))
+
         form.addParallelSection(threads=4, mpi=1)
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
-        searchIds = []
+        searchIds, localDeps = [], []
         inputIds = self.getInputIds()
 
+        if self.useLocalResolution():
+            localDeps = [self._insertFunctionStep('localResolveStep', prerequisites=[])]
+
         for key in inputIds:
-            searchIds.append(self._insertFunctionStep('searchStep', key, inputIds[key], prerequisites=[]))
+            searchIds.append(self._insertFunctionStep('searchStep', key, inputIds[key], prerequisites=localDeps))
 
         self._insertFunctionStep('createOutputStep', prerequisites=searchIds)
 
+    def localResolveStep(self):
+        ncbiIDs = list(self.getInputIds())
+        localDBs = self.getLocalDatabases()
+        found = fetchLocalSequences(localDBs, ncbiIDs, self._getTmpPath('localIds.txt'))
+
+        outDir = self._getPath('sequences')
+        if not os.path.exists(outDir):
+            os.mkdir(outDir)
+        for ncbiId, seq in found.items():
+            writeFasta({ncbiId: seq}, os.path.join(outDir, ncbiId + '.fa'))
+        print('{} out of {} IDs resolved in local databases {}. The rest will be fetched from NCBI'.
+              format(len(found), len(ncbiIDs), localDBs))
+
     def searchStep(self, key, maxEntries):
         dbName = self.getEnumText('dbType').lower()
 
         if self.searchMode.get() == IDS:
-            ncbiIDs = [key]
+            if os.path.exists(self._getPath('sequences', key + '.fa')):
+                # Already resolved from a local database
+                return
+            self.fetchPage([key], dbName)
         else:
-            with Entrez.esearch(db=dbName, term=key, retmax=maxEntries, retmode='json') as handle:
-                jDic = json.loads(handle.read())
-                ncbiIDs = jDic['esearchresult']['idlist']
-
-        if self.dbType.get() != 2:
-            self.fetchSequences(ncbiIDs, dbName)
-        else:
-            self.fetchCompounds(ncbiIDs)
+            # The pages are fetched while the next ones are searched, with a bounded number of pages in memory
+            nThreads = self.getFetchThreads()
+            with ThreadPoolExecutor(nThreads) as executor:
+                pending = []
+                for ncbiIDs in esearchPages(dbName, key, int(maxEntries), pageSize=self.pageSize.get()):
+                    pending.append(executor.submit(self.fetchPage, ncbiIDs, dbName))
+                    if len(pending) >= 2 * nThreads:
+                        pending.pop(0).result()
+                for future in pending:
+                    future.result()
 
     def createOutputStep(self):
         if self.dbType.get() != 2:
@@ -97,11 +137,14 @@ class ProtChemNCBIDownload(EMProtocol):
             outDir = self._getPath('sequences')
             for outFile in os.listdir(outDir):
                 newSeq, outFile = Sequence(), os.path.abspath(os.path.join(outDir, outFile))
+                if os.path.getsize(outFile) == 0:
+                    continue
                 newSeq.importFromFile(outFile, isAmino=self.dbType.get() == 0)
                 outputSet.append(newSeq)
             self._defineOutputs(outputSequences=outputSet)
 
         else:
+            from pwchem.objects import SmallMolecule, SetOfSmallMolecules
             outputSet = SetOfSmallMolecules(filename=self._getPath('outputSmallMolecules.sqlite'))
             outDir = self._getPath('compounds')
             for outFile in os.listdir(outDir):
@@ -114,35 +157,54 @@ class ProtChemNCBIDownload(EMProtocol):
 
 
 
+    def _warnings(self):
+        warns = []
+        if self.useLocalResolution() and not self.getLocalDatabases():
+            warns.append('No local database found to resolve the IDs. All of them will be fetched from NCBI')
+        return warns
+
+    def fetchPage(self, ncbiIDs, dbName):
+        if self.dbType.get() != 2:
+            self.fetchSequences(ncbiIDs, dbName)
+        else:
+            self.fetchCompounds(ncbiIDs)
+
     def fetchSequences(self, ncbiIDs, dbName):
         outDir = self._getPath('sequences')
-        if not os.path.exists(outDir):
-            os.mkdir(outDir)
-        for ncbiId in ncbiIDs:
-            with Entrez.efetch(db=dbName, id=ncbiId, rettype='FASTA') as handle:
-                with open(os.path.join(outDir, ncbiId+'.fa'), 'w') as f:
-                    f.write(handle.read())
+        os.makedirs(outDir, exist_ok=True)
+        records = efetchFastaRecords(ncbiIDs, dbName)
+        for ncbiId, record in records.items():
+            with open(os.path.join(outDir, ncbiId+'.fa'), 'w') as f:
+                f.write(record)
+        missingIDs = [ncbiId for ncbiId in ncbiIDs if ncbiId not in records]
+        if missingIDs:
+            print('NCBI returned no record for the IDs: {}'.format(', '.join(missingIDs)))
 
     def fetchCompounds(self, ncbiIDs):
         outDir = self._getPath('compounds')
-        if not os.path.exists(outDir):
-            os.mkdir(outDir)
+        os.makedirs(outDir, exist_ok=True)
         for pID in ncbiIDs:
             outFile = os.path.abspath(os.path.join(outDir, '{}.sdf'.format(pID)))
             try:
-                self.runJob('wget', '"{}" -O {}'.format(self.getPubChemURL(pID), outFile),
-                            cwd=self._getTmpPath())
-            except:
-                try:
-                    self.runJob('wget', '"{}" -O {}'.format(self.getPubChemURL(pID, dim=2), outFile),
-                                cwd=self._getTmpPath())
-                except:
-                    print('Pubchem Compound with ID: {} could not be downloaded'.format(pID))
-
-
-    def getPubChemURL(self, pID, dim=3):
-        return "https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/CID/{}/record/SDF/?record_type={}d&response_type=save&response_basename=Conformer{}D_CID_{}".\
-            format(pID, dim, dim, pID)
+                downloaded = fetchPubChemSDF(pID, outFile)
+            except Exception:
+                downloaded = None
+            if downloaded is None:
+                print('Pubchem Compound with ID: {} could not be downloaded'.format(pID))
+
+
+    def useLocalResolution(self):
+        return self.searchMode.get() == IDS and self.dbType.get() != 2 and self.localFirst.get()
+
+    def getLocalDatabases(self):
+        if self.localDBs.get() and self.localDBs.get().strip():
+            return self.localDBs.get().split()
+        defaults = LOCAL_PROT_DBS if self.dbType.get() == 0 else LOCAL_NUC_DBS
+        return [dbName for dbName in defaults if dbName in Plugin.getLocalDatabases()]
+
+    def getFetchThreads(self):
+        '''The keyword searches run at the same time, sharing the threads of the protocol to fetch their pages'''
+        return max(1, self.numberOfThreads.get() // max(1, len(self.getInputIds())))
 
     def getInputIds(self):
         ids = {}
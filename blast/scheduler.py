@@ -0,0 +1,214 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, json, time, fcntl, glob, socket
+
+# Memory of a BLAST process besides the database (which is memory-mapped and shared by the runs searching it)
+BASE_RUN_MEMORY = 256 * 1024 ** 2
+THREAD_MEMORY = 64 * 1024 ** 2
+QUERY_MEMORY = 4 * 1024 ** 2
+# Fraction of the memory available to the searches (free plus committed to them) that the admitted runs may use,
+# leaving room for the rest of processes
+MEMORY_FRACTION = 0.8
+# Disk reads of the databases not yet resident in memory: bandwidth (bytes/s) used to estimate how long a run takes
+# to load its database, and maximum number of runs loading a database at the same time
+IO_BANDWIDTH = 200 * 1024 ** 2
+MAX_COLD_LOADS = 2
+POLL_SECONDS = 10
+
+def getDatabaseBytes(dbName, dbDir):
+    '''Size of the files of a local database, including all its volumes (dbName.NN.*)'''
+    files = set(glob.glob(os.path.join(dbDir, dbName + '.*')))
+    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+
+def getHostMemory():
+    '''Returns the (total, available) memory of the host in bytes, from /proc/meminfo'''
+    memInfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':')
+            memInfo[key] = int(value.split()[0]) * 1024
+    return memInfo['MemTotal'], memInfo.get('MemAvailable', memInfo['MemFree'])
+
+def estimateRunMemory(nThreads, nQueries):
+    return BASE_RUN_MEMORY + nThreads * THREAD_MEMORY + nQueries * QUERY_MEMORY
+
+def isProcessAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SearchAdmission:
+    """Host level admission of local BLAST searches, shared by all the processes using the same BLAST
+    installation. Used as a context manager around a search, it waits until the run fits in the host memory and
+    cores and sets the number of threads it can use (self.threads):
+
+        with SearchAdmission(dbName, dbDir, stateDir, nThreads, nQueries) as admission:
+            runSearch(threads=admission.threads)
+
+    The memory of a run is estimated from the size of its database volumes, counted once for all the runs searching
+    the same database since its pages are shared, plus the working memory of its threads and queries. Runs are
+    admitted in arrival order; they get fewer threads when there are not enough free cores and wait in the queue
+    when there are none or the memory would be exceeded. A run is always admitted if nothing else is running.
+
+    The memory limit is checked against the available memory of the host plus the memory committed to the running
+    searches, which is already in use. A database not searched by any running search is not resident in memory and
+    is read from disk while the run starts (coldBytes, for coldBytes / ioBandwidth seconds): at most maxColdLoads
+    runs load a database at the same time, so that they do not compete for the disk bandwidth"""
+
+    def __init__(self, dbName, dbDir, stateDir, nThreads=1, nQueries=1, pollSeconds=POLL_SECONDS,
+                 ioBandwidth=None, maxColdLoads=None):
+        self.dbName, self.nQueries, self.pollSeconds = dbName, nQueries, pollSeconds
+        self.ioBandwidth, self.maxColdLoads = ioBandwidth or IO_BANDWIDTH, maxColdLoads or MAX_COLD_LOADS
+        self.dbBytes = getDatabaseBytes(dbName, dbDir)
+        self.requestedThreads, self.threads = max(1, nThreads), None
+        self.stateDir, self.host = stateDir, socket.gethostname()
+        self.ticketId = '{}_{}_{}_{}'.format(self.host, os.getpid(), time.time(), id(self))
+
+    def __enter__(self):
+        try:
+            self.waitAdmission()
+        except BaseException:
+            self.release()
+            raise
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.release()
+        return False
+
+    # ---------------------------------- State  -----------------------
+    def _getStateFile(self):
+        return os.path.join(self.stateDir, 'admission.json')
+
+    def _updateState(self, func):
+        '''Runs func(state) with the host state locked, saving the modified state. Returns the func result'''
+        os.makedirs(self.stateDir, exist_ok=True)
+        with open(os.path.join(self.stateDir, 'admission.lock'), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            state = {'running': {}, 'waiting': []}
+            if os.path.exists(self._getStateFile()):
+                with open(self._getStateFile()) as f:
+                    state = json.load(f)
+            self._removeStaleTickets(state)
+            result = func(state)
+            with open(self._getStateFile() + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self._getStateFile() + '.tmp', self._getStateFile())
+            return result
+
+    def _removeStaleTickets(self, state):
+        '''Tickets of processes that finished without releasing them (e.g: killed) are dropped. The process of a
+        ticket can only be checked in its own host: tickets of other hosts (a state directory shared by several
+        nodes) do not belong to this host admission and are dropped too'''
+        state['running'] = {ticketId: ticket for ticketId, ticket in state['running'].items()
+                            if self.isTicketAlive(ticket)}
+        state['waiting'] = [ticket for ticket in state['waiting'] if self.isTicketAlive(ticket)]
+
+    def isTicketAlive(self, ticket):
+        return ticket.get('host', self.host) == self.host and isProcessAlive(ticket['pid'])
+
+    # ---------------------------------- Admission  -----------------------
+    def getCommittedResources(self, running):
+        '''Returns the (memory, threads) already committed to the running searches'''
+        dbBytes = {ticket['db']: ticket['dbBytes'] for ticket in running.values()}
+        memory = sum(dbBytes.values()) + sum(ticket['memory'] for ticket in running.values())
+        return memory, sum(ticket['threads'] for ticket in running.values())
+
+    def getColdBytes(self, running):
+        '''Bytes of the database that the run would read from disk: all of them unless a running search shares it'''
+        return 0 if any(ticket['db'] == self.dbName for ticket in running.values()) else self.dbBytes
+
+    def getColdLoads(self, running):
+        '''Number of running searches still reading their non-resident database from disk'''
+        now = time.time()
+        return len([ticket for ticket in running.values() if ticket.get('coldBytes', 0) > 0 and
+                    now - ticket['time'] < ticket['coldBytes'] / ticket.get('ioBandwidth', self.ioBandwidth)])
+
+    def getAdmittedThreads(self, running):
+        '''Number of threads the run would get now, or 0 if it does not fit in the host'''
+        nCores = os.cpu_count() or 1
+        if not running:
+            return min(self.requestedThreads, nCores)
+
+        committedMemory, committedThreads = self.getCommittedResources(running)
+        freeCores = nCores - committedThreads
+        threads = min(self.requestedThreads, freeCores)
+        if threads < 1:
+            return 0
+
+        coldBytes = self.getColdBytes(running)
+        if coldBytes > 0 and self.getColdLoads(running) >= self.maxColdLoads:
+            return 0
+
+        totalMemory, availableMemory = getHostMemory()
+        searchMemory = min(totalMemory, availableMemory + committedMemory)
+        runMemory = estimateRunMemory(threads, self.nQueries) + coldBytes
+        return threads if committedMemory + runMemory <= MEMORY_FRACTION * searchMemory else 0
+
+    def tryAdmission(self, state):
+        if not any(ticket['id'] == self.ticketId for ticket in state['waiting']):
+            state['waiting'].append({'id': self.ticketId, 'host': self.host, 'pid': os.getpid(),
+                                    'time': time.time()})
+        # First come, first served: only the oldest waiting run can be admitted
+        if state['waiting'][0]['id'] != self.ticketId:
+            return 0
+
+        threads = self.getAdmittedThreads(state['running'])
+        if threads > 0:
+            state['waiting'].pop(0)
+            state['running'][self.ticketId] = {'host': self.host, 'pid': os.getpid(), 'db': self.dbName,
+                                               'dbBytes': self.dbBytes,
+                                               'coldBytes': self.getColdBytes(state['running']),
+                                               'ioBandwidth': self.ioBandwidth, 'threads': threads,
+                                               'time': time.time(),
+                                               'memory': estimateRunMemory(threads, self.nQueries)}
+        return threads
+
+    def waitAdmission(self):
+        waitStart = time.time()
+        self.threads = self._updateState(self.tryAdmission)
+        while self.threads == 0:
+            time.sleep(self.pollSeconds)
+            self.threads = self._updateState(self.tryAdmission)
+        if time.time() - waitStart > 1:
+            print('BLAST search admitted after waiting {:.0f} s in the host queue'.format(time.time() - waitStart))
+        if self.threads < self.requestedThreads:
+            print('BLAST search admitted with {} of the {} requested threads'.format(self.threads,
+                                                                                   self.requestedThreads))
+        return self.threads
+
+    def release(self):
+        def removeTicket(state):
+            state['running'].pop(self.ticketId, None)
+            state['waiting'] = [ticket for ticket in state['waiting'] if ticket['id'] != self.ticketId]
+        self._updateState(removeTicket)
@@ -0,0 +1,232 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json, glob, fcntl, hashlib, shutil
+
+from .store import getFileHash, HASH_BLOCK
+
+MANIFEST = '.staged.json'
+# Index and alias files of the databases, small enough to verify their checksums each time a copy is used
+CHECKSUM_EXTENSIONS = ['pin', 'nin', 'pal', 'nal']
+# Free space left in the scratch disk besides the staged copies
+SCRATCH_RESERVE = 0.05
+
+def getSourceFiles(dbPath, databasesDir):
+    '''Returns the directory, name and files of a database (all its volumes and the taxonomy database next to it),
+    given by its name in the databases directory or its full path (e.g: a snapshot of the store)'''
+    srcDir, dbName = (os.path.dirname(dbPath), os.path.basename(dbPath)) if os.path.isabs(dbPath) \
+        else (databasesDir, dbPath)
+    files = sorted(glob.glob(os.path.join(srcDir, glob.escape(dbName) + '.*'))) + \
+        sorted(glob.glob(os.path.join(srcDir, 'taxdb.*')))
+    return srcDir, dbName, [f for f in files if os.path.isfile(f)]
+
+def getFilesVersion(files):
+    '''Version of a set of database files from their names, sizes and modification times'''
+    stats = [(os.path.basename(f), os.path.getsize(f), os.stat(f).st_mtime_ns) for f in files]
+    return hashlib.sha1(json.dumps(stats).encode()).hexdigest()[:12]
+
+def copyWithHash(srcFile, dstFile):
+    '''Copies a file, returning the sha256 of the content read'''
+    sha = hashlib.sha256()
+    with open(srcFile, 'rb') as fIn, open(dstFile, 'wb') as fOut:
+        for block in iter(lambda: fIn.read(HASH_BLOCK), b''):
+            sha.update(block)
+            fOut.write(block)
+        fOut.flush()
+        os.fsync(fOut.fileno())
+    return sha.hexdigest()
+
+def readManifest(stagedDir):
+    try:
+        with open(os.path.join(stagedDir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def getStagedDatabases(scratchDir):
+    '''Returns {stagedDir: manifest} of the complete copies in a scratch directory'''
+    staged = {}
+    for stagedDir in glob.glob(os.path.join(scratchDir, '*@*')):
+        # Copies being staged or replaced (key.tmpPID, key.oldPID)
+        if '.' in os.path.basename(stagedDir).split('@')[-1]:
+            continue
+        manifest = readManifest(stagedDir)
+        if manifest is not None:
+            staged[stagedDir] = manifest
+    return staged
+
+
+class StagedDatabase:
+    """Node-local copy of a database in scratch, shared by all the processes of the node. Used as a context
+    manager around a search, it stages the database volumes if there is no valid copy yet and keeps the copy from
+    being evicted while in use:
+
+        with StagedDatabase(dbPath, databasesDir, scratchDir) as staged:
+            runSearch(db=staged.path, BLASTDB=staged.dir)
+
+    Each copy is identified by the database name and version (names, sizes and modification times of its files),
+    so an updated database is staged again. The files are checked against the checksums of the content read from
+    the source, and each time the copy is used its index and alias files are checked again (the volumes by size).
+    A single process copies a database while the rest wait for it (exclusive lock), and the processes using a copy
+    hold a shared lock on it: a copy is only replaced or evicted under the exclusive lock, so it must not be read
+    without holding the lock of its key (.locks/<key>.lock). The copies are kept across jobs and the least recently
+    used ones not in use are evicted when the scratch disk (or its quota) is full. If the database cannot be staged
+    (or scratchDir is None), the original one is used (staged.path = dbPath, staged.dir = None)"""
+
+    def __init__(self, dbPath, databasesDir, scratchDir, quotaBytes=None):
+        self.dbPath, self.scratchDir, self.quotaBytes = dbPath, scratchDir, quotaBytes
+        self.srcDir, self.dbName, self.srcFiles = getSourceFiles(dbPath, databasesDir)
+        self.key = '{}@{}'.format(self.dbName, getFilesVersion(self.srcFiles))
+        self.path, self.dir, self._lockFile = dbPath, None, None
+
+    def __enter__(self):
+        if self.scratchDir is None or not self.srcFiles:
+            return self
+        os.makedirs(os.path.join(self.scratchDir, '.locks'), exist_ok=True)
+        self._lockFile = open(self.getLockFile(self.key), 'a')
+        try:
+            if self.acquire():
+                self.dir = self.getStagedDir()
+                self.path = os.path.join(self.dir, self.dbName)
+                # Last use of the copy, for the LRU eviction
+                os.utime(os.path.join(self.dir, MANIFEST))
+            else:
+                self.release()
+        except BaseException:
+            self.release()
+            raise
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.release()
+        return False
+
+    def release(self):
+        if self._lockFile is not None:
+            fcntl.flock(self._lockFile, fcntl.LOCK_UN)
+            self._lockFile.close()
+            self._lockFile = None
+
+    def getStagedDir(self, key=None):
+        return os.path.join(self.scratchDir, key or self.key)
+
+    def getLockFile(self, key):
+        return os.path.join(self.scratchDir, '.locks', key + '.lock')
+
+    def isStaged(self):
+        '''Whether there is a complete copy: all the files of the manifest with their sizes, and the checksums of the
+        index and alias files. Called with the lock of the key held'''
+        manifest = readManifest(self.getStagedDir())
+        if manifest is None:
+            return False
+        for name, fileInfo in manifest['files'].items():
+            stagedFile = os.path.join(self.getStagedDir(), name)
+            if not os.path.exists(stagedFile) or os.path.getsize(stagedFile) != fileInfo['size']:
+                return False
+            if name.split('.')[-1] in CHECKSUM_EXTENSIONS and getFileHash(stagedFile) != fileInfo['sha256']:
+                print('The staged copy of {} is corrupted, it is staged again'.format(name))
+                return False
+        return True
+
+    def acquire(self):
+        '''Holds a shared lock on a valid copy of the database, staging it first if needed.
+        Returns False if it could not be staged'''
+        while True:
+            fcntl.flock(self._lockFile, fcntl.LOCK_SH)
+            if self.isStaged():
+                return True
+            # The lock is upgraded to stage the copy: the processes arriving meanwhile wait for it
+            fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+            if not self.isStaged() and not self.stage():
+                return False
+
+    def stage(self):
+        '''Copies the database files to the scratch directory, verifying their checksums. Called with the exclusive
+        lock of the key held, so no other process is using or staging the copy. Returns False if there is no room'''
+        nBytes = sum(os.path.getsize(f) for f in self.srcFiles)
+        if not self.makeRoom(nBytes):
+            print('No room in {} to stage {} ({:.1f} GB), the shared database is used'.
+                  format(self.scratchDir, self.dbName, nBytes / 1024 ** 3))
+            return False
+
+        stagedDir = self.getStagedDir()
+        # Leftovers of interrupted stagings of this copy
+        for leftDir in glob.glob(glob.escape(stagedDir) + '.tmp*') + glob.glob(glob.escape(stagedDir) + '.old*'):
+            shutil.rmtree(leftDir, ignore_errors=True)
+        tmpDir = '{}.tmp{}'.format(stagedDir, os.getpid())
+        os.makedirs(tmpDir)
+        files = {}
+        for srcFile in self.srcFiles:
+            dstFile = os.path.join(tmpDir, os.path.basename(srcFile))
+            checksum = copyWithHash(srcFile, dstFile)
+            if getFileHash(dstFile) != checksum:
+                shutil.rmtree(tmpDir, ignore_errors=True)
+                raise IOError('The staged copy of {} does not match its source checksum'.format(srcFile))
+            files[os.path.basename(srcFile)] = {'size': os.path.getsize(dstFile), 'sha256': checksum}
+        if self.key != '{}@{}'.format(self.dbName, getFilesVersion(self.srcFiles)):
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise IOError('Database {} changed while being staged'.format(self.dbName))
+
+        with open(os.path.join(tmpDir, MANIFEST), 'w') as f:
+            json.dump({'source': self.srcDir, 'dbName': self.dbName, 'files': files, 'bytes': nBytes}, f)
+        # An invalid previous copy is moved aside before the new one takes its place, and only then removed
+        oldDir = '{}.old{}'.format(stagedDir, os.getpid())
+        if os.path.exists(stagedDir):
+            os.rename(stagedDir, oldDir)
+        os.rename(tmpDir, stagedDir)
+        shutil.rmtree(oldDir, ignore_errors=True)
+        print('Database {} staged in {} ({:.1f} GB)'.format(self.dbName, stagedDir, nBytes / 1024 ** 3))
+        return True
+
+    def hasRoom(self, nBytes):
+        usage = shutil.disk_usage(self.scratchDir)
+        if usage.free - nBytes < SCRATCH_RESERVE * usage.total:
+            return False
+        if self.quotaBytes is None:
+            return True
+        usedBytes = sum(manifest['bytes'] for manifest in getStagedDatabases(self.scratchDir).values())
+        return usedBytes + nBytes <= self.quotaBytes
+
+    def makeRoom(self, nBytes):
+        '''Evicts the least recently used copies not in use until there is room for nBytes'''
+        staged = getStagedDatabases(self.scratchDir)
+        for stagedDir in sorted(staged, key=lambda d: os.path.getmtime(os.path.join(d, MANIFEST))):
+            if self.hasRoom(nBytes):
+                return True
+            if stagedDir != self.getStagedDir():
+                self.evict(os.path.basename(stagedDir))
+        return self.hasRoom(nBytes)
+
+    def evict(self, key):
+        '''Removes a staged copy if no process is using it. Returns whether it was removed'''
+        with open(self.getLockFile(key), 'a') as lockFile:
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            shutil.rmtree(self.getStagedDir(key), ignore_errors=True)
+            print('Staged database {} evicted from {}'.format(key, self.scratchDir))
+            return True
@@ -0,0 +1,225 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json, time, fcntl, hashlib, shutil
+
+HASH_BLOCK = 16 * 1024 ** 2
+
+def getFileHash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def isSameContent(pathA, pathB):
+    '''Files are the same if they are links to the same inode or have the same size and hash'''
+    if os.path.samefile(pathA, pathB):
+        return True
+    return os.path.getsize(pathA) == os.path.getsize(pathB) and getFileHash(pathA) == getFileHash(pathB)
+
+def linkFile(source, target):
+    '''Hardlinks source as target, copying it if they are in different filesystems'''
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class DatabaseStore:
+    """Versioned store of the local BLAST databases. Each download or build of a database is done in a staging
+    directory and committed as a new snapshot:
+
+        store = DatabaseStore(storeDir, databasesDir)
+        stagingDir = store.createStaging(dbName)
+        ... download or build the database files in stagingDir ...
+        snapshotId = store.commitSnapshot(dbName, stagingDir)
+
+    Snapshots (storeDir/snapshots/<dbName>/<snapshotId>) are read-only and the files unchanged since the previous
+    snapshot are hardlinks to the same inodes, so a new version only takes the space of its changed volumes.
+    The current snapshot of each database is published (also as hardlinks) in the flat databases directory, where
+    searches find it by name. Protocols register references to the snapshots they use; the garbage collector
+    deletes the unreferenced snapshots that are not current, least recently used first, until the store fits in
+    its quota"""
+
+    def __init__(self, storeDir, databasesDir):
+        self.storeDir, self.databasesDir = storeDir, databasesDir
+
+    # ---------------------------------- Index  -----------------------
+    def _getIndexFile(self):
+        return os.path.join(self.storeDir, 'index.json')
+
+    def _updateIndex(self, func):
+        '''Runs func(index) with the store index locked, saving the modified index. Returns the func result'''
+        os.makedirs(self.storeDir, exist_ok=True)
+        with open(os.path.join(self.storeDir, 'index.lock'), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            index = {}
+            if os.path.exists(self._getIndexFile()):
+                with open(self._getIndexFile()) as f:
+                    index = json.load(f)
+            result = func(index)
+            with open(self._getIndexFile() + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(self._getIndexFile() + '.tmp', self._getIndexFile())
+            return result
+
+    def getSnapshots(self, dbName):
+        '''Returns {snapshotId: {created, lastUsed, files, references}} of a database'''
+        return self._updateIndex(lambda index: index.get(dbName, {}).get('snapshots', {}))
+
+    def getCurrentSnapshot(self, dbName):
+        return self._updateIndex(lambda index: index.get(dbName, {}).get('current'))
+
+    def getSnapshotDir(self, dbName, snapshotId):
+        return os.path.join(self.storeDir, 'snapshots', dbName, snapshotId)
+
+    # ---------------------------------- Snapshots  -----------------------
+    def createStaging(self, dbName, seed=True):
+        '''Returns a new directory to download or build a new version of a database. If seed, it starts with links
+        to the files of the current snapshot, so incremental downloads (update_blastdb.pl) only fetch the changed
+        volumes. The snapshot files are read-only, so tools must replace them (as tar does) instead of writing them'''
+        stagingDir = os.path.join(self.storeDir, 'staging', '{}_{}_{}'.format(dbName, os.getpid(), int(time.time())))
+        os.makedirs(stagingDir)
+        current = self.getCurrentSnapshot(dbName)
+        if seed and current is not None:
+            snapshotDir = self.getSnapshotDir(dbName, current)
+            for fileName in os.listdir(snapshotDir):
+                linkFile(os.path.join(snapshotDir, fileName), os.path.join(stagingDir, fileName))
+        return stagingDir
+
+    def commitSnapshot(self, dbName, stagingDir):
+        '''Stores the files of a staging directory as a new snapshot of the database, linking the unchanged files of
+        the current snapshot, and publishes it. The staging directory is removed. Returns the snapshot id, which is
+        the current one if nothing changed'''
+        current = self.getCurrentSnapshot(dbName)
+        prevDir = self.getSnapshotDir(dbName, current) if current else None
+        prevFiles = set(os.listdir(prevDir)) if prevDir else set()
+
+        baseId = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        snapshotId, nTries = baseId, 1
+        while os.path.exists(self.getSnapshotDir(dbName, snapshotId)):
+            snapshotId, nTries = '{}.{}'.format(baseId, nTries), nTries + 1
+        snapshotDir = self.getSnapshotDir(dbName, snapshotId)
+        tmpDir = snapshotDir + '.tmp'
+        os.makedirs(tmpDir)
+        fileNames, nUnchanged = sorted(os.listdir(stagingDir)), 0
+        for fileName in fileNames:
+            stagedFile, outFile = os.path.join(stagingDir, fileName), os.path.join(tmpDir, fileName)
+            if fileName in prevFiles and isSameContent(stagedFile, os.path.join(prevDir, fileName)):
+                linkFile(os.path.join(prevDir, fileName), outFile)
+                nUnchanged += 1
+            else:
+                os.rename(stagedFile, outFile)
+                os.chmod(outFile, 0o444)
+        shutil.rmtree(stagingDir)
+
+        if current is not None and nUnchanged == len(fileNames) == len(prevFiles):
+            shutil.rmtree(tmpDir)
+            print('Database {} did not change: keeping snapshot {}'.format(dbName, current))
+            return current
+
+        os.rename(tmpDir, snapshotDir)
+        def addSnapshot(index):
+            dbIndex = index.setdefault(dbName, {'current': None, 'snapshots': {}})
+            dbIndex['snapshots'][snapshotId] = {'created': time.time(), 'lastUsed': time.time(),
+                                                'files': fileNames, 'references': {}}
+            self._publish(dbName, dbIndex['snapshots'].get(dbIndex['current']), snapshotDir, fileNames)
+            dbIndex['current'] = snapshotId
+        self._updateIndex(addSnapshot)
+        print('Database {} stored as snapshot {}: {} new files, {} linked from the previous one'.
+              format(dbName, snapshotId, len(fileNames) - nUnchanged, nUnchanged))
+        return snapshotId
+
+    def _publish(self, dbName, prevSnapshot, snapshotDir, fileNames):
+        '''Replaces the files of the previous snapshot in the databases directory by links to the new ones'''
+        os.makedirs(self.databasesDir, exist_ok=True)
+        for fileName in set(prevSnapshot['files'] if prevSnapshot else []) - set(fileNames):
+            if os.path.exists(os.path.join(self.databasesDir, fileName)):
+                os.remove(os.path.join(self.databasesDir, fileName))
+        for fileName in fileNames:
+            tmpFile = os.path.join(self.databasesDir, '.{}.tmp'.format(fileName))
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            linkFile(os.path.join(snapshotDir, fileName), tmpFile)
+            os.replace(tmpFile, os.path.join(self.databasesDir, fileName))
+
+    # ---------------------------------- References  -----------------------
+    def addReference(self, dbName, snapshotId, reference):
+        '''Records that a protocol (reference: its working directory) uses a snapshot, which is kept while the
+        reference directory exists'''
+        def addRef(index):
+            snapshot = index[dbName]['snapshots'][snapshotId]
+            snapshot['references'][reference] = snapshot['lastUsed'] = time.time()
+        self._updateIndex(addRef)
+
+    def removeReference(self, dbName, snapshotId, reference):
+        def removeRef(index):
+            index[dbName]['snapshots'][snapshotId]['references'].pop(reference, None)
+        self._updateIndex(removeRef)
+
+    # ---------------------------------- Garbage collection  -----------------------
+    def getStoreBytes(self):
+        '''Disk space used by the snapshots, counting each inode once'''
+        inodes = {}
+        for root, _, fileNames in os.walk(os.path.join(self.storeDir, 'snapshots')):
+            for fileName in fileNames:
+                stat = os.stat(os.path.join(root, fileName))
+                inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+        return sum(inodes.values())
+
+    def collectGarbage(self, quotaBytes=None):
+        '''Deletes the snapshots without (existing) references that are not the current version of their database,
+        least recently used first, until the store fits in quotaBytes (all of them if None).
+        Returns the deleted snapshots as (dbName, snapshotId)'''
+        def collect(index):
+            candidates = []
+            for dbName, dbIndex in index.items():
+                for snapshotId, snapshot in dbIndex['snapshots'].items():
+                    snapshot['references'] = {ref: refTime for ref, refTime in snapshot['references'].items()
+                                              if os.path.exists(ref)}
+                    if snapshotId != dbIndex['current'] and not snapshot['references']:
+                        candidates.append((snapshot['lastUsed'], dbName, snapshotId))
+
+            deleted, storeBytes = [], self.getStoreBytes()
+            for _, dbName, snapshotId in sorted(candidates):
+                if quotaBytes is not None and storeBytes <= quotaBytes:
+                    break
+                snapshotDir = self.getSnapshotDir(dbName, snapshotId)
+                # Only the files not linked from other snapshots (or the databases directory) free space
+                for fileName in os.listdir(snapshotDir):
+                    stat = os.stat(os.path.join(snapshotDir, fileName))
+                    storeBytes -= stat.st_size if stat.st_nlink == 1 else 0
+                shutil.rmtree(snapshotDir)
+                del index[dbName]['snapshots'][snapshotId]
+                deleted.append((dbName, snapshotId))
+            return deleted
+
+        deleted = self._updateIndex(collect)
+        if deleted:
+            print('Deleted unreferenced database snapshots: {}'.
+                  format(', '.join('{}@{}'.format(dbName, snapshotId) for dbName, snapshotId in deleted)))
+        return deleted
@@ -0,0 +1,213 @@
+# ***************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (daniel.delhoyo.gomez@alumnos.upm.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************
+
+import json, time, threading, zlib, argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+RESIDUES = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+class MockNCBIServer:
+  """Local stand-in of the NCBI E-utilities (esearch, efetch, epost) and PubChem PUG REST (compound SDF records)
+  with configurable latency, throttling and payload size, to test and benchmark downloads offline.
+
+      with MockNCBIServer(latency=0.05, throttleEvery=10) as server:
+          # point the plugin at server.eutilsURL / server.pubchemURL (NCBI_EUTILS_URL, PUBCHEM_URL)
+
+  latency: seconds added to each response
+  throttleEvery: every n-th request is answered with 429 Too Many Requests (0: never)
+  retryAfter: Retry-After seconds sent with the 429 responses
+  dropEvery: every n-th request the connection is closed without response (0: never)
+  payloadSize: residues of each fasta record
+  searchCount: number of entries matching any esearch term
+  missingIds: ids for which efetch returns no record
+  stats: number of requests, throttled and dropped requests, fetched records and searches (esearch calls)"""
+
+  def __init__(self, latency=0.0, throttleEvery=0, retryAfter=0, payloadSize=300, searchCount=1000, port=0,
+               dropEvery=0, missingIds=()):
+    self.missingIds = set(missingIds)
+    self.latency, self.throttleEvery, self.retryAfter, self.dropEvery = latency, throttleEvery, retryAfter, dropEvery
+    self.payloadSize, self.searchCount, self.port = payloadSize, searchCount, port
+    self.stats = {'requests': 0, 'throttled': 0, 'dropped': 0, 'records': 0, 'searches': 0}
+    self.histories, self._lock, self._server = {}, threading.Lock(), None
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+  @property
+  def eutilsURL(self):
+    return self.url + '/entrez/eutils'
+
+  @property
+  def pubchemURL(self):
+    return self.url + '/rest/pug'
+
+  def start(self):
+    self._server = ThreadingHTTPServer(('127.0.0.1', self.port), self._getHandler())
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, excType, excValue, tb):
+    self.stop()
+    return False
+
+  # ---------------------------------- Responses  -----------------------
+  def getSearchIds(self, term, retstart, retmax):
+    prefix = 'MOCK{}_'.format(zlib.crc32(term.encode()) % 10000)
+    return [prefix + str(i) for i in range(retstart, min(retstart + retmax, self.searchCount))]
+
+  def getRecord(self, recordId):
+    seed = zlib.crc32(str(recordId).encode())
+    seq = ''.join(RESIDUES[(seed + i * 7) % len(RESIDUES)] for i in range(self.payloadSize))
+    lines = [seq[i:i + 70] for i in range(0, len(seq), 70)]
+    return '>{} mock record {}\n{}\n'.format(recordId, recordId, '\n'.join(lines))
+
+  def esearch(self, params):
+    term = params.get('term', '')
+    with self._lock:
+      self.stats['searches'] += 1
+    retstart, retmax = int(params.get('retstart', 0)), int(params.get('retmax', 20))
+    result = {'count': str(self.searchCount), 'retstart': str(retstart), 'retmax': str(retmax),
+              'idlist': self.getSearchIds(term, retstart, retmax)}
+    if params.get('usehistory') == 'y':
+      result['webenv'] = self.storeHistory(self.getSearchIds(term, 0, self.searchCount))
+      result['querykey'] = '1'
+    return 'application/json', json.dumps({'esearchresult': result})
+
+  def storeHistory(self, ids):
+    with self._lock:
+      webEnv = 'MOCK_WEBENV_{}'.format(len(self.histories))
+      self.histories[webEnv] = ids
+    return webEnv
+
+  def epost(self, params):
+    webEnv = self.storeHistory([i for i in params.get('id', '').split(',') if i])
+    return 'text/xml', '<?xml version="1.0"?>\n<ePostResult><QueryKey>1</QueryKey><WebEnv>{}</WebEnv>' \
+                       '</ePostResult>\n'.format(webEnv)
+
+  def efetch(self, params):
+    if 'WebEnv' in params:
+      retstart, retmax = int(params.get('retstart', 0)), int(params.get('retmax', 20))
+      ids = self.histories.get(params['WebEnv'], [])[retstart:retstart + retmax]
+    else:
+      ids = [i for i in params.get('id', '').split(',') if i]
+    ids = [i for i in ids if i not in self.missingIds]
+    if params.get('rettype') == 'uilist':
+      return 'text/plain', ''.join(i + '\n' for i in ids)
+    with self._lock:
+      self.stats['records'] += len(ids)
+    return 'text/plain', ''.join(self.getRecord(i) for i in ids)
+
+  def compoundSDF(self, cid):
+    with self._lock:
+      self.stats['records'] += 1
+    return 'chemical/x-mdl-sdfile', '{}\n  mock\n\n  1  0  0  0  0  0  0  0  0  0999 V2000\n' \
+                                    '    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0\n' \
+                                    'M  END\n$$$$\n'.format(cid)
+
+  def respond(self, path, params):
+    '''Returns (status, contentType, body) of a request, status being None if the connection is dropped'''
+    with self._lock:
+      self.stats['requests'] += 1
+      throttle = self.throttleEvery > 0 and self.stats['requests'] % self.throttleEvery == 0
+      drop = not throttle and self.dropEvery > 0 and self.stats['requests'] % self.dropEvery == 0
+      if throttle:
+        self.stats['throttled'] += 1
+      if drop:
+        self.stats['dropped'] += 1
+    if self.latency > 0:
+      time.sleep(self.latency)
+    if drop:
+      return None, None, None
+    if throttle:
+      return 429, 'text/plain', 'Too Many Requests'
+
+    tool = path.rstrip('/').split('/')[-1]
+    if path.startswith('/entrez/eutils/') and tool in ['esearch.fcgi', 'efetch.fcgi', 'epost.fcgi']:
+      return (200,) + getattr(self, tool.split('.')[0])(params)
+    if path.startswith('/rest/pug/compound/CID/'):
+      return (200,) + self.compoundSDF(path.split('/')[5])
+    return 404, 'text/plain', 'Not found'
+
+  def _getHandler(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def _handle(self, body=''):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        params.update({key: values[-1] for key, values in parse_qs(body).items()})
+        status, contentType, content = server.respond(url.path, params)
+        if status is None:
+          self.close_connection = True
+          return
+        content = content.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(content)))
+        if status == 429:
+          self.send_header('Retry-After', str(server.retryAfter))
+        self.end_headers()
+        self.wfile.write(content)
+
+      def do_GET(self):
+        self._handle()
+
+      def do_POST(self):
+        self._handle(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+
+      def log_message(self, format, *args):
+        pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Runs a mock NCBI / PubChem server. Point the plugin to it with '
+                                               'NCBI_EUTILS_URL=<url>/entrez/eutils and PUBCHEM_URL=<url>/rest/pug')
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument('--latency', type=float, default=0.0)
+  parser.add_argument('--throttleEvery', type=int, default=0)
+  parser.add_argument('--retryAfter', type=float, default=0)
+  parser.add_argument('--payloadSize', type=int, default=300)
+  parser.add_argument('--dropEvery', type=int, default=0)
+  args = parser.parse_args()
+
+  mockServer = MockNCBIServer(latency=args.latency, throttleEvery=args.throttleEvery, retryAfter=args.retryAfter,
+                              payloadSize=args.payloadSize, port=args.port, dropEvery=args.dropEvery).start()
+  print('Mock NCBI server running at {}'.format(mockServer.url))
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    mockServer.stop()
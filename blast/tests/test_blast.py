@@ -21,6 +21,10 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # ***************************************************************************
 
+import os, sys, json, socket, subprocess, unittest, tempfile, shutil, time, random
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 from pyworkflow.tests import BaseTest
 import pyworkflow.tests as tests
@@ -28,9 +32,22 @@ import pyworkflow.tests as tests
 from pwem.protocols import ProtImportSequence
 
 from blast import Plugin
-from blast.constants import BLASTdbs
-
-from ..protocols import ProtChemBLAST, ProtChemBLASTDatabase, ProtChemNCBIDownload
+from blast.constants import BLASTdbs, HIT_TABLE_DTYPE
+from blast.objects import BLASTHitTable
+from blast.scheduler import SearchAdmission, estimateRunMemory
+from blast.staging import StagedDatabase, getStagedDatabases
+from blast.store import DatabaseStore
+from blast.tuning import chooseSearchParameters, recordTiming, readTimings
+from blast.utils import writeHitTable, loadHitTable, readBtops, parseHitTable, writeFasta, buildHitIndex, \
+  getHitPage, markDone, isDone, mergeDoneFiles, getQueriesKey, getParameterGrid, getCombinationErrors, \
+  getCombinationArgs, getPairOverlaps, getWindowStarts, mergeWindowHits, mergeDatabaseHits, fanOutHits, \
+  getReciprocalBestHits, getAlignedStrings, buildQueryAnchoredMSA, rescoreTopHits, reverseComplement, \
+  getSubstitutionMatrix, smithWatermanScores, requestURL, esearchIds, esearchPages, efetchFasta, efetchFastaRecords, \
+  parseFastaText, splitFastaRecords, fetchPubChemSDF
+from blast.tests.mock_ncbi import MockNCBIServer
+
+from ..protocols import ProtChemBLAST, ProtChemBLASTDatabase, ProtChemNCBIDownload, ProtChemBLASTAllVsAll, \
+  ProtChemBLASTReciprocal, ProtChemBLASTSweep
 
 idsDic = {0: '{"ID": "P0DTC2"}\n{"ID": "P59594"}\n',
           1: '{"ID": "nr_025000"}\n{"ID": "nr_025001"}\n',
@@ -43,6 +60,42 @@ keysDic = {0: '{"ID": "hemoglobin", "maxEntries": "2"}\n',
 dbLabels = ['Protein', 'Nucleotide', 'Compounds']
 
 
+def isBLASTInstalled():
+  try:
+    return os.path.exists(Plugin.getProgramPath('makeblastdb'))
+  except TypeError:
+    return False
+
+def makeHitTable(nHits, **columns):
+  '''Hit table of nHits rows with the given columns {name: values}, the rest being zeros.
+  The BTOP column is only included if given, as in the tables parsed with btop'''
+  hits = np.zeros(nHits, dtype=HIT_TABLE_DTYPE + ([('btop', 'O')] if 'btop' in columns else []))
+  for name, values in columns.items():
+    hits[name] = values
+  return hits
+
+def writeFakeDatabase(dbDir, dbName, size, extensions=('pin', 'psq', 'phr')):
+  '''Writes database files of random content (dbName.ext), for the tests that do not run BLAST on them'''
+  for ext in extensions:
+    with open(os.path.join(dbDir, '{}.{}'.format(dbName, ext)), 'wb') as f:
+      f.write(os.urandom(size))
+
+
+class TmpDirTest(BaseTest):
+  '''Tests working in temporary directories, removed once the tests of the class finish'''
+  @classmethod
+  def setUpClass(cls):
+    cls.tmpDir = tempfile.mkdtemp()
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.tmpDir, ignore_errors=True)
+
+  def getTmpDir(self):
+    '''New empty directory for a test'''
+    return tempfile.mkdtemp(dir=self.tmpDir)
+
+
 class TestNCBIDownload(BaseTest):
   @classmethod
   def setUpClass(cls):
@@ -155,10 +208,9 @@ class TestBLAST(BaseTest):
 
   @classmethod
   def _runBLASTn(cls, protSeq):
-      dbIndex = cls.getDatabaseIndex(cls.dbName, fromNCBI=False)
       protBLAST = cls.newProtocol(
         ProtChemBLAST,
-        inputSequence=protSeq.outputSequence, seqType=1, localSearch=True, dbName=dbIndex,
+        inputSequence=protSeq.outputSequence, seqType=1, localSearch=True, dbName=cls.dbName,
         word_size='11', gapopen='5', gapextend='2'
         )
 
@@ -173,7 +225,632 @@ class TestBLAST(BaseTest):
     protSeq = self._runImportSeq()
     protBLAST = self._runBLASTn(protSeq)
     self.assertIsNotNone(protBLAST.outputSequences)
+    self.assertTrue(protBLAST.outputSequences.isStreamClosed())
+    self.assertIsNotNone(protBLAST.outputHitTable)
+    hits = protBLAST.outputHitTable.getHits()
+    self.assertEqual(len(hits), protBLAST.outputHitTable.getSize())
+
+
+class TestBLASTAllVsAll(BaseTest):
+  @classmethod
+  def setUpClass(cls):
+    tests.setupTestProject(cls)
 
+  @classmethod
+  def _runImportSeqs(cls):
+    protImportNCBI = cls.newProtocol(
+      ProtChemNCBIDownload,
+      listIDs='{"ID": "P0DTC2"}\n{"ID": "P59594"}\n{"ID": "P69905"}\n', dbType=0)
+    cls.launchProtocol(protImportNCBI)
+    return protImportNCBI
 
+  @classmethod
+  def _runAllVsAll(cls, protSeqs, symmetric=False):
+    protAll = cls.newProtocol(
+      ProtChemBLASTAllVsAll,
+      inputSequences=protSeqs.outputSequences, seqType=0, symmetric=symmetric, numberOfThreads=2)
+    protAll.setObjLabel('All vs all' + (' symmetric' if symmetric else ''))
+    cls.launchProtocol(protAll)
+    return protAll
+
+  def testAllVsAll(self):
+    protSeqs = self._runImportSeqs()
+    for symmetric in [False, True]:
+      protAll = self._runAllVsAll(protSeqs, symmetric=symmetric)
+      self.assertIsNotNone(protAll.outputSimilarityMatrix)
+      matrix = protAll.outputSimilarityMatrix.getMatrix()
+      self.assertEqual(matrix.shape, (3, 3))
+      self.assertEqual(matrix.diagonal().sum(), 0)
+
+
+class TestBLASTReciprocal(BaseTest):
+  @classmethod
+  def setUpClass(cls):
+    tests.setupTestProject(cls)
 
+  @classmethod
+  def _runImportSeqs(cls, listIDs, label):
+    protImportNCBI = cls.newProtocol(ProtChemNCBIDownload, listIDs=listIDs, dbType=0)
+    protImportNCBI.setObjLabel(label)
+    cls.launchProtocol(protImportNCBI)
+    return protImportNCBI
+
+  def testReciprocalBestHits(self):
+    #Human and mouse hemoglobin alpha and beta
+    protA = self._runImportSeqs('{"ID": "P69905"}\n{"ID": "P68871"}\n', 'Human hemoglobin')
+    protB = self._runImportSeqs('{"ID": "P01942"}\n{"ID": "P02088"}\n', 'Mouse hemoglobin')
+    protRBH = self.newProtocol(ProtChemBLASTReciprocal, inputSequencesA=protA.outputSequences,
+                               inputSequencesB=protB.outputSequences, seqType=0, numberOfThreads=2)
+    self.launchProtocol(protRBH)
+    self.assertIsNotNone(protRBH.outputPairs)
+    self.assertEqual(protRBH.outputPairs.getSize(), 2)
+
+
+class TestBLASTSweep(BaseTest):
+  dbName = '16S_ribosomal_RNA'
+  @classmethod
+  def setUpClass(cls):
+    tests.setupTestProject(cls)
 
+  def testSweep(self):
+    if self.dbName not in Plugin.getLocalDatabases():
+      self.launchProtocol(self.newProtocol(ProtChemBLASTDatabase, fromNCBI=True,
+                                           inputID=BLASTdbs.index(self.dbName)))
+
+    protSeq = self.newProtocol(ProtImportSequence, inputSequence=1, inputNucleotideSequence=3,
+                               geneBankSequence='nr_025000')
+    self.launchProtocol(protSeq)
+    protSweep = self.newProtocol(ProtChemBLASTSweep, inputSequences=protSeq.outputSequence, seqType=1,
+                                 dbName=self.dbName, evalues='1e-5, 10', matchMismatch='1/-2, 2/-3', gapCosts='2/2',
+                                 numberOfThreads=4)
+    self.launchProtocol(protSweep)
+    self.assertIsNotNone(protSweep.outputSweep)
+    self.assertEqual(protSweep.outputSweep.getSize(), 4)
+    self.assertEqual(protSweep.outputSweep.getOverlaps().shape, (4, 4))
+
+
+class TestHitIndex(TmpDirTest):
+  def testHitPages(self):
+    nHits, outDir = 100000, self.getTmpDir()
+    rng = np.random.default_rng(0)
+    hits = makeHitTable(nHits, qseqid=rng.choice(['q1', 'q2'], nHits),
+                        sseqid=['s{}'.format(i) for i in range(nHits)], evalue=rng.random(nHits),
+                        bitscore=rng.random(nHits) * 100, pident=rng.random(nHits) * 100, qstart=1,
+                        qend=rng.integers(1, 200, nHits), btop='')
+    npyFile = writeHitTable(hits, os.path.join(outDir, 'hitTable.npy'))
+    queriesFile = writeFasta({'q1': 'A' * 200, 'q2': 'A' * 100}, os.path.join(outDir, 'hitTable_queries.fasta'))
+    buildHitIndex(npyFile, queriesFile)
+
+    t0 = time.time()
+    page, coverages, nFiltered = getHitPage(npyFile, page=2, pageSize=50, minIdentity=50, minCoverage=20)
+    print('Page of {} hits out of {} read in {:.3f} s'.format(len(page), nFiltered, time.time() - t0))
+    self.assertEqual(len(page), 50)
+    self.assertTrue(np.all(np.diff(page['evalue']) >= 0))
+    self.assertTrue(np.all(page['pident'] >= 50) and np.all(coverages >= 20))
+    lengths = np.where(hits['qseqid'] == 'q1', 200, 100)
+    expected = hits[(hits['pident'] >= 50) & (np.minimum(100 * hits['qend'] / lengths, 100) >= 20)]
+    self.assertEqual(nFiltered, len(expected))
+    self.assertEqual(list(page['sseqid']), list(np.sort(expected, order='evalue')['sseqid'][100:150]))
+
+    page, _, _ = getHitPage(npyFile, page=0, pageSize=10, sortBy='bitscore')
+    self.assertEqual(list(page['bitscore']), sorted(hits['bitscore'], reverse=True)[:10])
+
+
+class TestChunkCheckpoints(TmpDirTest):
+  def testDoneMarkers(self):
+    outDir = self.getTmpDir()
+    chunkFiles = [os.path.join(outDir, 'batch_1_chunk_{}.tsv'.format(i)) for i in range(3)]
+    for i, chunkFile in enumerate(chunkFiles):
+      with open(chunkFile, 'w') as f:
+        f.write('Query_{}\tsubject\n'.format(i))
+    markDone(chunkFiles[0])
+    markDone(chunkFiles[1])
+    self.assertTrue(isDone(chunkFiles[0]))
+    self.assertFalse(isDone(chunkFiles[2]))
+
+    # A chunk modified after its marker (e.g: by an interrupted rerun) is not complete
+    with open(chunkFiles[1], 'a') as f:
+      f.write('Query_1\tsubject2\n')
+    self.assertFalse(isDone(chunkFiles[1]))
+    mergedFile = os.path.join(outDir, 'batch_1.tsv')
+    with self.assertRaises(ValueError):
+      mergeDoneFiles(chunkFiles, mergedFile)
+
+    for chunkFile in chunkFiles[1:]:
+      markDone(chunkFile)
+    mergeDoneFiles(chunkFiles, mergedFile)
+    self.assertTrue(isDone(mergedFile))
+    with open(mergedFile) as f:
+      self.assertEqual(len(f.readlines()), 4)
+
+  def testRegroupedBatches(self):
+    # A first run searched the batch of query 1 alone (e.g: flushed by the batch time window)
+    outDir = self.getTmpDir()
+    batchTsv, querySeqs = os.path.join(outDir, 'batch_1.tsv'), {'Query_1': 'MKTAYIAKQR', 'Query_2': 'MVLSPADKTN'}
+    with open(batchTsv, 'w') as f:
+      f.write('Query_1\tsubject\n')
+    markDone(batchTsv, queries=getQueriesKey([1], {'Query_1': querySeqs['Query_1']}))
+    self.assertTrue(isDone(batchTsv, queries=getQueriesKey([1], {'Query_1': querySeqs['Query_1']})))
+
+    # The continued run groups queries 1 and 2 in a batch with the same name, which must be searched again
+    self.assertFalse(isDone(batchTsv, queries=getQueriesKey([1, 2], querySeqs)))
+    self.assertFalse(isDone(batchTsv, queries=getQueriesKey([1], {'Query_1': querySeqs['Query_2']})))
+
+
+class TestDatabaseStaging(TmpDirTest):
+  def testStaging(self):
+    dbDir, scratchDir = self.getTmpDir(), self.getTmpDir()
+    for dbName in ['dbA', 'dbB']:
+      writeFakeDatabase(dbDir, dbName, 1000)
+
+    with StagedDatabase('dbA', dbDir, scratchDir) as staged:
+      self.assertEqual(os.path.dirname(staged.path), staged.dir)
+      self.assertTrue(staged.dir.startswith(scratchDir))
+      with open(os.path.join(dbDir, 'dbA.psq'), 'rb') as fSrc, open(staged.path + '.psq', 'rb') as fDst:
+        self.assertEqual(fSrc.read(), fDst.read())
+      stagedA = staged.dir
+
+      # A copy in use is shared and not evicted to make room for another database
+      with StagedDatabase('dbA', dbDir, scratchDir) as sharedA:
+        self.assertEqual(sharedA.dir, stagedA)
+      with StagedDatabase('dbB', dbDir, scratchDir, quotaBytes=4000) as stagedB:
+        self.assertIsNone(stagedB.dir)
+        self.assertEqual(stagedB.path, 'dbB')
+
+    # Once released, the least recently used copy is evicted
+    with StagedDatabase('dbB', dbDir, scratchDir, quotaBytes=4000) as stagedB:
+      self.assertIsNotNone(stagedB.dir)
+    self.assertEqual([os.path.basename(d) for d in getStagedDatabases(scratchDir)],
+                     [os.path.basename(stagedB.dir)])
+
+    # A corrupted index is detected by its checksum and staged again
+    with open(stagedB.path + '.pin', 'r+b') as f:
+      f.write(b'\0' * 10)
+    with StagedDatabase('dbB', dbDir, scratchDir) as restagedB:
+      self.assertEqual(restagedB.dir, stagedB.dir)
+      with open(os.path.join(dbDir, 'dbB.pin'), 'rb') as fSrc, open(restagedB.path + '.pin', 'rb') as fDst:
+        self.assertEqual(fSrc.read(), fDst.read())
+    self.assertEqual(sorted(os.listdir(scratchDir)), ['.locks', os.path.basename(stagedB.dir)])
+
+    # An updated database is a new version, staged again
+    writeFakeDatabase(dbDir, 'dbB', 1200)
+    with StagedDatabase('dbB', dbDir, scratchDir) as newB:
+      self.assertNotEqual(newB.dir, stagedB.dir)
+      self.assertEqual(os.path.getsize(newB.path + '.pin'), 1200)
+
+    with StagedDatabase('dbA', dbDir, None) as unstaged:
+      self.assertEqual(unstaged.path, 'dbA')
+
+
+class TestParameterGrid(BaseTest):
+  def testCombinationErrors(self):
+    grid = getParameterGrid({'evalue': ['1e-5'], 'word_size': ['3', '9'], 'matrix': ['BLOSUM62', 'PAM30'],
+                             'gaps': ['11/1'], 'matchMismatch': ['']})
+    self.assertEqual(len(grid), 4)
+    errors = [getCombinationErrors(combo, 'blastp') for combo in grid]
+    self.assertEqual([len(comboErrors) for comboErrors in errors], [0, 1, 1, 1])
+    self.assertEqual(getCombinationArgs(grid[0]),
+                     ' -evalue 1e-5 -word_size 3 -matrix BLOSUM62 -gapopen 11 -gapextend 1')
+
+    combo = {'evalue': '', 'word_size': '', 'matrix': '', 'gaps': '5/2', 'matchMismatch': ''}
+    self.assertEqual(getCombinationErrors(combo, 'megablast'), [])
+    self.assertEqual(len(getCombinationErrors(dict(combo, matchMismatch='3/-2'), 'blastn')), 1)
+    self.assertEqual(len(getCombinationErrors(dict(combo, gaps='11/1'), 'blastn')), 1)
+
+  def testPairOverlaps(self):
+    hitsA = makeHitTable(3, qseqid=['q1', 'q1', 'q2'], sseqid=['s1', 's2', 's1'])
+    hitsB = makeHitTable(2, qseqid=['q1', 'q2'], sseqid=['s1', 's3'])
+    overlaps = getPairOverlaps([hitsA, hitsB, hitsB[:0]])
+    self.assertAlmostEqual(overlaps[0, 1], 1 / 4)
+    self.assertEqual(list(overlaps[2]), [0, 0, 1])
+
+
+class TestPluginImport(BaseTest):
+  #Modules that must only be imported when a BLAST protocol is executed, not by the plugin discovery
+  lazyPackages = ['Bio', 'pwchem', 'scipy']
+  maxImportTime = 1.0
+
+  def testImportTime(self):
+    code = 'import sys, time\n' \
+           'import pwem.protocols, pwem.objects, pyworkflow.protocol\n' \
+           'before = set(sys.modules)\n' \
+           't0 = time.time()\n' \
+           'import blast, blast.protocols, blast.wizards, blast.viewers\n' \
+           'print(time.time() - t0)\n' \
+           'print(",".join(sorted(m for m in set(sys.modules) - before if m.split(".")[0] in {})))'.\
+      format(self.lazyPackages)
+    # The package is found from its root, whatever the working directory left by other tests
+    packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(sys.modules['blast'].__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([packageRoot, os.environ.get('PYTHONPATH', '')]))
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True,
+                         check=True, cwd=packageRoot, env=env).stdout.split('\n')
+    importTime, heavyModules = float(out[0]), out[1]
+    print('BLAST plugin, protocols, wizards and viewers imported in {:.3f} s'.format(importTime))
+    self.assertEqual(heavyModules, '', 'Modules imported eagerly: {}'.format(heavyModules))
+    self.assertLess(importTime, self.maxImportTime)
+
+  def testMissingDatabasesDir(self):
+    with mock.patch.object(Plugin, 'getDatabasesDir', return_value='/nonexistent/blast/databases'):
+      Plugin._localDatabases = None
+      self.assertEqual(Plugin.getLocalDatabases(), [])
+    Plugin._localDatabases = None
+
+  def testFormWithoutDatabaseDiscovery(self):
+    # Building the protocol forms must not list the databases directory
+    with mock.patch.object(Plugin, 'getVar', return_value='/nonexistent/blast'), \
+         mock.patch.object(Plugin, 'getLocalDatabases', side_effect=AssertionError('databases listed')), \
+         mock.patch('os.listdir', side_effect=AssertionError('directory listed')):
+      for protClass in [ProtChemBLAST, ProtChemBLASTSweep]:
+        prot = protClass()
+        self.assertEqual(prot.dbName.get(), '')
+
+
+class TestQueryWindows(BaseTest):
+  def testWindowHitsMerge(self):
+    starts = getWindowStarts(2500, windowSize=1000, overlap=100)
+    self.assertEqual(starts, [0, 900, 1800])
+    # The same HSP found truncated in the first window and whole in the second one
+    hitsW0 = np.array([('Query_1', 'subj1', 100, 150, 0, 0, 850, 999, 10, 159, 1e-10, 80, ''),
+                       ('Query_1', 'subj2', 100, 50, 0, 0, 10, 59, 1, 50, 1e-5, 40, '')], dtype=HIT_TABLE_DTYPE)
+    hitsW1 = np.array([('Query_1', 'subj1', 100, 200, 0, 0, 51, 250, 111, 310, 1e-30, 200, '')],
+                      dtype=HIT_TABLE_DTYPE)
+    hits = mergeWindowHits([hitsW0, hitsW1], starts[:2])
+    self.assertEqual(list(hits['sseqid']), ['subj1', 'subj2'])
+    self.assertEqual((hits[0]['qstart'], hits[0]['qend']), (951, 1150))
+
+  def testWindowChunks(self):
+    # Windows are searched in chunks of queries with the same whole length, which sets their search space
+    protocol = mock.Mock(searchChunkSize=mock.Mock(get=mock.Mock(return_value=2)))
+    windowSeqs = {'Query_{}'.format(i): 'ACGT' for i in range(1, 5)}
+    fullLengths = {'Query_1': 5000, 'Query_2': 3000, 'Query_3': 5000, 'Query_4': 5000}
+    chunks = ProtChemBLAST.getSearchChunks(protocol, windowSeqs, fullLengths)
+    self.assertEqual([list(chunk) for chunk in chunks], [['Query_1', 'Query_3'], ['Query_4'], ['Query_2']])
+    self.assertEqual(len(ProtChemBLAST.getSearchChunks(protocol, windowSeqs)), 2)
+
+
+class TestMultiDatabase(BaseTest):
+  def testMergedRanking(self):
+    hitsA = makeHitTable(3, qseqid=['Query_2', 'Query_2', 'Query_1'], sseqid=['a1', 'a2', 'a3'],
+                         evalue=[1e-30, 1e-5, 1e-8])
+    hitsB = makeHitTable(2, qseqid=['Query_2', 'Query_1'], sseqid=['b1', 'b2'], evalue=[1e-10, 1e-20])
+
+    hits = mergeDatabaseHits([hitsA, hitsB], ['swissprot', 'inHouse'])
+    self.assertEqual(list(hits['sseqid']), ['a1', 'b1', 'a2', 'b2', 'a3'])
+    self.assertEqual(list(hits['database']), ['swissprot', 'inHouse', 'swissprot', 'inHouse', 'swissprot'])
+
+class TestCompactAlignments(TmpDirTest):
+  def testBtopAlignments(self):
+    # 4 identities, A/G substitution, 3 identities, insertion of T in the subject, 2 identities
+    self.assertEqual(getAlignedStrings('CCACGTACGTAAGG', 3, 12, '4AG3-T2'), ('ACGTACGT-AA', 'ACGTGCGTTAA'))
+
+    hits = makeHitTable(2, qseqid=['q1', 'q2'], btop=['4AG3-T2', '120'])
+    npyFile = os.path.join(self.getTmpDir(), 'hits.npy')
+    writeHitTable(hits, npyFile)
+    self.assertEqual(readBtops(npyFile, loadHitTable(npyFile)[1:]), ['120'])
+    self.assertEqual(list(loadHitTable(npyFile, btop=True)['btop']), ['4AG3-T2', '120'])
+
+  def testLongSequenceIds(self):
+    longA, longB = 'sp|P69905|HBA_HUMAN_' + 'a' * 80, 'tr|A0A024R161|' + 'b' * 90
+    tsvFile, reverseFile = [os.path.join(self.getTmpDir(), name) for name in ['hits.tsv', 'reverse.tsv']]
+    for outFile, (qId, sId) in zip([tsvFile, reverseFile], [('Query_1', longB), (longB, longA)]):
+      with open(outFile, 'w') as f:
+        f.write('{}\t{}\t90\t50\t5\t0\t1\t50\t1\t50\t1e-20\t100\t9606\n'.format(qId, sId))
+    hits = parseHitTable(tsvFile)
+    self.assertEqual(hits['sseqid'][0], longB)
+
+    hits = fanOutHits(hits, {'Query_1': [longA, 'shortQuery']})
+    self.assertEqual(list(hits['qseqid']), [longA, 'shortQuery'])
+    merged = mergeDatabaseHits([hits, hits[:1]], ['db' * 40, 'inHouse'])
+    self.assertEqual(merged['database'][0], 'db' * 40)
+
+    pairs = getReciprocalBestHits(hits[:1], parseHitTable(reverseFile))
+    self.assertEqual((pairs['seqA'][0], pairs['seqB'][0]), (longA, longB))
+
+  def testQueryAnchoredMSA(self):
+    query, qstarts, qends = 'CCACGTACGTAAGG', [3, 1, 5], [12, 9, 5]
+    btops = ['4AG3-T2', '3-A-C2TC3', '1']
+    msa = buildQueryAnchoredMSA(query, qstarts, btops)
+    rows = [row.decode() for row in msa.view('S{}'.format(msa.shape[1])).ravel()]
+    self.assertEqual(rows, ['CCA--CGTACGT-AAGG', '--A--CGTGCGTTAA--', 'CCAACCGCACG------', '------G----------'])
+
+    # Within its span, each hit row is its pairwise alignment once the columns gapped in both rows are removed
+    for row, qstart, qend, btop in zip(rows[1:], qstarts, qends, btops):
+      residueCols = [i for i, char in enumerate(row) if char != '-']
+      pairCols = [i for i in range(residueCols[0], residueCols[-1] + 1) if (rows[0][i], row[i]) != ('-', '-')]
+      self.assertEqual(getAlignedStrings(query, qstart, qend, btop),
+                       (''.join(rows[0][i] for i in pairCols), ''.join(row[i] for i in pairCols)))
+
+
+class TestSearchAdmission(TmpDirTest):
+  def testQueueAndRelease(self):
+    dbDir, stateDir = self.getTmpDir(), self.getTmpDir()
+    writeFakeDatabase(dbDir, 'testDB', 1024, extensions=['00.psq'])
+    nCores = os.cpu_count()
+
+    with SearchAdmission('testDB', dbDir, stateDir, nThreads=nCores) as first:
+      self.assertEqual(first.threads, nCores)
+      self.assertEqual(first.dbBytes, 1024)
+      # No free cores left: the second search waits in the queue
+      second = SearchAdmission('testDB', dbDir, stateDir, nThreads=2)
+      self.assertEqual(second._updateState(second.tryAdmission), 0)
+
+    self.assertEqual(second._updateState(second.tryAdmission), min(2, nCores))
+    second.release()
+
+  def testMemoryAndColdLoads(self):
+    dbDir, stateDir = self.getTmpDir(), self.getTmpDir()
+    for dbName in ['dbA', 'dbB']:
+      writeFakeDatabase(dbDir, dbName, 1024, extensions=['00.psq'])
+
+    def tryAdmission(dbName, available):
+      admission = SearchAdmission(dbName, dbDir, stateDir, ioBandwidth=1, maxColdLoads=1)
+      with mock.patch('blast.scheduler.getHostMemory', return_value=(64 * 1024 ** 3, available)):
+        threads = admission._updateState(admission.tryAdmission)
+      admission.release()
+      return threads
+
+    runMemory = estimateRunMemory(1, 1)
+    with mock.patch('os.cpu_count', return_value=8), \
+         SearchAdmission('dbA', dbDir, stateDir, ioBandwidth=1, maxColdLoads=1) as first:
+      # dbA is still being read from disk (1024 bytes at 1 byte/s): a second cold database waits
+      self.assertEqual(tryAdmission('dbB', 64 * 1024 ** 3), 0)
+      # The memory committed to the first run is already in use, so it is added back to the available memory
+      self.assertEqual(tryAdmission('dbA', 2 * runMemory), 1)
+      self.assertEqual(tryAdmission('dbA', 0), 0)
+    self.assertEqual(first.threads, 1)
+
+  def testOtherHostTickets(self):
+    dbDir, stateDir = self.getTmpDir(), self.getTmpDir()
+    writeFakeDatabase(dbDir, 'testDB', 1024, extensions=['00.psq'])
+    # A ticket left by another node sharing the state directory, whose pid is alive in this host
+    otherTicket = {'host': 'otherNode', 'pid': os.getpid(), 'db': 'testDB', 'dbBytes': 1024, 'coldBytes': 0,
+                   'threads': os.cpu_count(), 'time': time.time(), 'memory': 0}
+    with open(os.path.join(stateDir, 'admission.json'), 'w') as f:
+      json.dump({'running': {'other': otherTicket}, 'waiting': []}, f)
+
+    with SearchAdmission('testDB', dbDir, stateDir) as admission:
+      self.assertEqual(admission.threads, 1)
+      with open(os.path.join(stateDir, 'admission.json')) as f:
+        running = json.load(f)['running']
+      self.assertEqual([ticket['host'] for ticket in running.values()], [socket.gethostname()])
+
+
+class TestDatabaseStore(TmpDirTest):
+  def _stage(self, store, files, seed=True):
+    stagingDir = store.createStaging('testDB', seed=seed)
+    for fileName, content in files.items():
+      if os.path.exists(os.path.join(stagingDir, fileName)):
+        os.remove(os.path.join(stagingDir, fileName))
+      with open(os.path.join(stagingDir, fileName), 'w') as f:
+        f.write(content)
+    return stagingDir
+
+  def testSnapshotsAndGarbageCollection(self):
+    rootDir = self.getTmpDir()
+    store = DatabaseStore(os.path.join(rootDir, 'store'), os.path.join(rootDir, 'databases'))
+
+    first = store.commitSnapshot('testDB', self._stage(store, {'testDB.00.psq': 'A' * 1000, 'testDB.pal': 'v1'}))
+    store.addReference('testDB', first, rootDir)
+    # Only the alias changes: the volume is linked from the previous snapshot
+    second = store.commitSnapshot('testDB', self._stage(store, {'testDB.pal': 'v2'}))
+    firstDir, secondDir = store.getSnapshotDir('testDB', first), store.getSnapshotDir('testDB', second)
+    self.assertNotEqual(first, second)
+    self.assertTrue(os.path.samefile(os.path.join(firstDir, 'testDB.00.psq'), os.path.join(secondDir, 'testDB.00.psq')))
+    self.assertEqual(store.getStoreBytes(), 1004)
+    # The current snapshot is published in the databases directory
+    with open(os.path.join(rootDir, 'databases', 'testDB.pal')) as f:
+      self.assertEqual(f.read(), 'v2')
+    self.assertEqual(store.commitSnapshot('testDB', self._stage(store, {})), second)
+
+    # Referenced and current snapshots are kept
+    self.assertEqual(store.collectGarbage(), [])
+    store.removeReference('testDB', first, rootDir)
+    self.assertEqual(store.collectGarbage(quotaBytes=2000), [])
+    self.assertEqual(store.collectGarbage(quotaBytes=0), [('testDB', first)])
+    self.assertFalse(os.path.exists(firstDir))
+    self.assertEqual(store.getStoreBytes(), 1002)
+
+  def _commitFastaDatabase(self, store, dbName, sequences):
+    stagingDir = store.createStaging(dbName, seed=False)
+    fastaFile = os.path.join(stagingDir, 'input.fasta')
+    with open(fastaFile, 'w') as f:
+      f.write(''.join('>{}\n{}\n'.format(seqId, seq) for seqId, seq in sequences.items()))
+    subprocess.check_call([Plugin.getProgramPath('makeblastdb'), '-in', fastaFile, '-dbtype', 'prot',
+                           '-parse_seqids', '-out', os.path.join(stagingDir, dbName)], stdout=subprocess.DEVNULL)
+    os.remove(fastaFile)
+    return store.commitSnapshot(dbName, stagingDir)
+
+  @unittest.skipUnless(isBLASTInstalled(), 'BLAST programs not installed')
+  def testPinnedSubjectSequences(self):
+    rootDir = self.getTmpDir()
+    store = DatabaseStore(os.path.join(rootDir, 'store'), os.path.join(rootDir, 'databases'))
+    searched = self._commitFastaDatabase(store, 'pinDB', {'P1': 'MKTAYIAKQR', 'P2': 'MVLSPADKTN'})
+    # The search records the path of the snapshot it searched
+    hitTable = BLASTHitTable(filename=os.path.join(rootDir, 'hitTable.npy'),
+                             database=os.path.join(store.getSnapshotDir('pinDB', searched), 'pinDB'))
+
+    # The database is updated after the search
+    self._commitFastaDatabase(store, 'pinDB', {'P1': 'GGGGGGGGGG', 'P2': 'MVLSPADKTN'})
+    self.assertNotEqual(store.getCurrentSnapshot('pinDB'), searched)
+    self.assertEqual(hitTable.getSubjectSequences(['P1', 'P2']), {'P1': 'MKTAYIAKQR', 'P2': 'MVLSPADKTN'})
+
+
+class TestAutoTuning(TmpDirTest):
+  def testCalibratedChoice(self):
+    queryLengths, dbLetters = [1500] * 4, 10 ** 9
+    # Near identical queries: megablast with long words, and its shorter word fallback
+    tuning = chooseSearchParameters(False, 97, queryLengths, dbLetters, maxThreads=8, timings=[])
+    self.assertEqual((tuning['task'], tuning['wordSize'], tuning['threads']), ('megablast', 28, 8))
+    self.assertEqual(chooseSearchParameters(False, 97, [20], dbLetters, 8, [])['task'], 'blastn')
+    self.assertEqual(chooseSearchParameters(True, 40, [300], 10 ** 6, 8, [])['threads'], 1)
+
+    # The candidates without enough recorded timings are explored, fewest timings first
+    timingsFile = os.path.join(self.getTmpDir(), 'timings.jsonl')
+    chosenWords = []
+    for task, wordSize, seconds in [('megablast', 28, 50), ('megablast', 20, 10)] * 3:
+      recordTiming(timingsFile, task=task, wordSize=wordSize, threads=1, queryLetters=6000, dbLetters=dbLetters,
+                   seconds=seconds)
+      chosenWords.append(chooseSearchParameters(False, 97, queryLengths, dbLetters, 8,
+                                                readTimings(timingsFile))['wordSize'])
+    self.assertEqual(chosenWords[:5], [20, 28, 20, 28, 20])
+
+    # With enough recorded timings, the fastest candidate is chosen
+    tuning = chooseSearchParameters(False, 97, queryLengths, dbLetters, 8, readTimings(timingsFile))
+    self.assertEqual((tuning['task'], tuning['wordSize']), ('megablast', 20))
+    self.assertAlmostEqual(tuning['predictedSeconds'][1], 10 / 8)
+
+class TestNCBIDownloadBenchmark(TmpDirTest):
+  '''Download throughput and retry behavior against a local mock of NCBI / PubChem, fully offline'''
+  nRecords, nThreads = 200, 4
+
+  def _benchmark(self, server, label, fetchFunc, keys):
+    with mock.patch.object(Plugin, 'getEutilsURL', return_value=server.eutilsURL), \
+         mock.patch.object(Plugin, 'getPubChemURL', return_value=server.pubchemURL), \
+         mock.patch.object(Plugin, 'getNCBIApiKey', return_value=''):
+      t0 = time.time()
+      with ThreadPoolExecutor(self.nThreads) as executor:
+        nFetched = sum(executor.map(fetchFunc, keys))
+      elapsed = time.time() - t0
+    print('{}: {} records in {:.2f} s ({:.1f} records/s), {} requests, {} throttled (429) and retried'.
+          format(label, nFetched, elapsed, nFetched / elapsed, server.stats['requests'], server.stats['throttled']))
+    return nFetched
+
+  def testIDMode(self):
+    ids = ['MOCK_{}'.format(i) for i in range(self.nRecords)]
+    with MockNCBIServer(latency=0.005, throttleEvery=7) as server:
+      nFetched = self._benchmark(server, 'ID mode',
+                                 lambda ncbiId: len(parseFastaText(efetchFasta([ncbiId], 'protein'))), ids)
+    self.assertEqual(nFetched, self.nRecords)
+    self.assertGreater(server.stats['throttled'], 0)
+    self.assertEqual(server.stats['requests'], self.nRecords + server.stats['throttled'])
+
+  def testConnectionRetries(self):
+    # Connections closed without response are retried
+    with MockNCBIServer(dropEvery=2) as server:
+      fastaTexts = [requestURL(server.eutilsURL + '/efetch.fcgi', data={'id': 'MOCK_{}'.format(i)}, backoff=0.01)
+                    for i in range(5)]
+    self.assertEqual(sum(len(parseFastaText(text.decode())) for text in fastaTexts), 5)
+    self.assertEqual(server.stats['requests'], 5 + server.stats['dropped'])
+    self.assertGreater(server.stats['dropped'], 0)
+
+    # Timed out requests are retried, raising once the retries are exhausted
+    with MockNCBIServer(latency=0.5) as server:
+      with self.assertRaises(OSError):
+        requestURL(server.eutilsURL + '/efetch.fcgi', data={'id': 'MOCK_1'}, retries=2, backoff=0.01, timeout=0.1)
+    self.assertEqual(server.stats['requests'], 3)
+
+  def testMissingRecords(self):
+    ids = ['MOCK_{}'.format(i) for i in range(5)]
+    with MockNCBIServer(missingIds=['MOCK_1', 'MOCK_3']) as server, \
+         mock.patch.object(Plugin, 'getEutilsURL', return_value=server.eutilsURL), \
+         mock.patch.object(Plugin, 'getNCBIApiKey', return_value=''):
+      records = efetchFastaRecords(ids, 'protein')
+    # The ids without record are left out instead of getting an empty one
+    self.assertEqual(sorted(records), ['MOCK_0', 'MOCK_2', 'MOCK_4'])
+    self.assertTrue(all(record.startswith('>' + ncbiId) for ncbiId, record in records.items()))
+    self.assertEqual(server.stats['requests'], 1 + len(ids))
+
+  def testKeywordMode(self):
+    def searchAndFetch(keyword):
+      return len(parseFastaText(efetchFasta(esearchIds('protein', keyword, retmax=20), 'protein')))
+
+    keywords = ['keyword{}'.format(i) for i in range(self.nRecords // 20)]
+    with MockNCBIServer(latency=0.005, throttleEvery=5) as server:
+      nFetched = self._benchmark(server, 'Keyword mode', searchAndFetch, keywords)
+    self.assertEqual(nFetched, self.nRecords)
+
+  def testPagedKeywordMode(self):
+    with MockNCBIServer(latency=0.005, searchCount=1050) as server, \
+         mock.patch.object(Plugin, 'getEutilsURL', return_value=server.eutilsURL), \
+         mock.patch.object(Plugin, 'getNCBIApiKey', return_value=''):
+      pages = list(esearchPages('protein', 'hemoglobin', 1000, pageSize=300))
+      # The term is searched once, the next pages are read from the history server
+      self.assertEqual(server.stats['searches'], 1)
+      with ThreadPoolExecutor(self.nThreads) as executor:
+        nFetched = sum(executor.map(lambda ids: len(splitFastaRecords(efetchFasta(ids, 'protein'))), pages))
+      self.assertEqual(len(list(esearchPages('protein', 'hemoglobin', 5000, pageSize=500))), 3)
+      self.assertEqual(server.stats['searches'], 2)
+
+    self.assertEqual([len(page) for page in pages], [300, 300, 300, 100])
+    self.assertEqual(len(set(sum(pages, []))), 1000)
+    self.assertEqual(nFetched, 1000)
+
+  def testCompounds(self):
+    outDir = self.getTmpDir()
+    with MockNCBIServer(throttleEvery=3) as server:
+      self._benchmark(server, 'PubChem compounds',
+                      lambda cid: fetchPubChemSDF(cid, os.path.join(outDir, cid + '.sdf')) is not None,
+                      [str(cid) for cid in range(2244, 2244 + 30)])
+    self.assertEqual(len(os.listdir(outDir)), 30)
+
+
+class TestSmithWaterman(BaseTest):
+  '''Exact re-scoring of the hits, checked against a plain Smith-Waterman-Gotoh implementation'''
+  nPairs, seqLength = 128, 300
+
+  def _naiveScore(self, seqA, seqB, scores, alphabet, gapOpen, gapExtend):
+    minScore, best = -10 ** 9, 0
+    h = [[0] * (len(seqB) + 1) for _ in range(len(seqA) + 1)]
+    e = [[minScore] * (len(seqB) + 1) for _ in range(len(seqA) + 1)]
+    f = [[minScore] * (len(seqB) + 1) for _ in range(len(seqA) + 1)]
+    for i in range(1, len(seqA) + 1):
+      for j in range(1, len(seqB) + 1):
+        e[i][j] = max(h[i][j - 1] - gapOpen - gapExtend, e[i][j - 1] - gapExtend)
+        f[i][j] = max(h[i - 1][j] - gapOpen - gapExtend, f[i - 1][j] - gapExtend)
+        match = scores[alphabet.index(seqA[i - 1]), alphabet.index(seqB[j - 1])]
+        h[i][j] = max(0, h[i - 1][j - 1] + match, e[i][j], f[i][j])
+        best = max(best, h[i][j])
+    return best
+
+  def _randomPairs(self, letters, nPairs, maxLength):
+    rand = random.Random(0)
+    queries = [''.join(rand.choice(letters) for _ in range(rand.randint(1, maxLength))) for _ in range(nPairs)]
+    # Half of the subjects are mutated copies of their query, with an insertion
+    subjects = []
+    for i, query in enumerate(queries):
+      if i % 2:
+        subjects.append(''.join(rand.choice(letters) for _ in range(rand.randint(1, maxLength))))
+      else:
+        mutated = ''.join(char if rand.random() < 0.8 else rand.choice(letters) for char in query)
+        cut = len(mutated) // 2
+        subjects.append(mutated[:cut] + 'A' * rand.randint(1, 5) + mutated[cut:])
+    return queries, subjects
+
+  def testScores(self):
+    for matrixName, letters, gapOpen, gapExtend in [('BLOSUM62', 'ACDEFGHIKLMNPQRSTVWY', 11, 1),
+                                                    (None, 'ACGT', 5, 2)]:
+      alphabet, scores = getSubstitutionMatrix(matrixName)
+      queries, subjects = self._randomPairs(letters, 40, 40)
+      swScores = smithWatermanScores(queries, subjects, scores, alphabet, gapOpen, gapExtend)
+      self.assertEqual(list(swScores), [self._naiveScore(query, subject, scores, alphabet, gapOpen, gapExtend)
+                                        for query, subject in zip(queries, subjects)])
+
+  def testRescoreTopHits(self):
+    hits = makeHitTable(4, qseqid=['q1', 'q1', 'q1', 'q2'], sseqid=['s1', 's1', 's2', 's1'], bitscore=[30, 20, 10, 5])
+    querySeqs, subjectSeqs = {'q1': 'ACGTACGTAC', 'q2': 'TTTT'}, {'s1': 'ACGTACGTAC', 's2': 'ACGT'}
+    hits = rescoreTopHits(hits, querySeqs, subjectSeqs, nTop=1)
+    # Both HSPs of the best pair of q1 get its score, the second subject of q1 is not re-scored
+    self.assertEqual(list(hits['swscore'][:2]), [20, 20])
+    self.assertTrue(np.isnan(hits['swscore'][2]))
+    # Only a single T/T match (reward 2) for q2
+    self.assertEqual(hits['swscore'][3], 2)
+
+  def testRescoreMinusStrand(self):
+    query = 'ACGTTGCAAGGCTTACCGATGCAAGT'
+    subject = 'GGGG' + reverseComplement(query) + 'CCCC'
+    # Perfect hit on the minus strand of the subject: its coordinates run backwards
+    hits = makeHitTable(2, qseqid=['q1', 'q1'], sseqid=['s1', 's1'], bitscore=[50, 10], sstart=[30, 1],
+                        send=[5, 10])
+    hits = rescoreTopHits(hits, {'q1': query}, {'s1': subject}, nTop=2, reward=2, penalty=-3)
+    self.assertEqual(hits['swscore'][0], 2 * len(query))
+    self.assertLess(hits['swscore'][1], 2 * len(query))
+
+  def testThroughput(self):
+    alphabet, scores = getSubstitutionMatrix('BLOSUM62')
+    queries, subjects = self._randomPairs('ACDEFGHIKLMNPQRSTVWY', self.nPairs, self.seqLength)
+    t0 = time.time()
+    smithWatermanScores(queries, subjects, scores, alphabet, 11, 1)
+    elapsed = time.time() - t0
+    nCells = sum(len(query) * len(subject) for query, subject in zip(queries, subjects))
+    print('Smith-Waterman: {} pairs in {:.2f} s ({:.1f} pairs/s, {:.1f} M cells/s)'.
+          format(self.nPairs, elapsed, self.nPairs / elapsed, nCells / elapsed / 1e6))
@@ -0,0 +1,114 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json, time, fcntl
+import numpy as np
+
+# Timings of a task / word size needed before they are used to compare it with the other candidates
+MIN_TIMINGS = 3
+# Database letters searched by each thread: smaller databases do not benefit from more threads
+LETTERS_PER_THREAD = 100 * 1000 ** 2
+SHORT_NUCLEOTIDE, SHORT_PROTEIN, LONG_NUCLEOTIDE = 50, 30, 10000
+
+def getCandidateTasks(isProtein, minIdentity, queryLength):
+    '''Tasks and word sizes able to find the hits down to minIdentity (%) for queries of queryLength,
+    in order of preference. Shorter words are more sensitive, longer ones faster'''
+    if isProtein:
+        if queryLength < SHORT_PROTEIN:
+            return [('blastp', 2)]
+        if minIdentity >= 50:
+            return [('blastp-fast', 6), ('blastp', 5)]
+        return [('blastp', 3)]
+
+    if queryLength < SHORT_NUCLEOTIDE:
+        return [('blastn', 7)]
+    if minIdentity >= 95:
+        return [('megablast', 32 if queryLength >= LONG_NUCLEOTIDE else 28), ('megablast', 20)]
+    if minIdentity >= 85:
+        return [('megablast', 16), ('dc-megablast', 11)]
+    if minIdentity >= 70:
+        return [('dc-megablast', 11), ('blastn', 11)]
+    return [('blastn', 11), ('blastn', 7)]
+
+def getSearchThreads(maxThreads, dbLetters, nQueries):
+    '''Threads worth using: BLAST threads split the queries and the database, so small searches get fewer'''
+    return max(1, min(maxThreads, max(nQueries, dbLetters // LETTERS_PER_THREAD)))
+
+def readTimings(timingsFile):
+    if not os.path.exists(timingsFile):
+        return []
+    with open(timingsFile) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def recordTiming(timingsFile, **timing):
+    '''Appends the timing of a search (task, wordSize, threads, queryLetters, dbLetters, seconds) to the records
+    shared by all the runs'''
+    os.makedirs(os.path.dirname(timingsFile), exist_ok=True)
+    with open(timingsFile, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(dict(timing, time=time.time())) + '\n')
+
+def getTimingRates(timings, task, wordSize):
+    '''Seconds per thread-normalized search space of the recorded searches with the task and word size'''
+    return [t['seconds'] * t['threads'] / (t['queryLetters'] * t['dbLetters']) for t in timings
+            if t['task'] == task and t['wordSize'] == wordSize and t['queryLetters'] > 0 and t['dbLetters'] > 0]
+
+def predictSeconds(timings, task, wordSize, queryLetters, dbLetters):
+    '''Search time predicted from the recorded searches with the same task and word size, as the median of their
+    seconds per thread-normalized search space. None if there are not enough records'''
+    rates = getTimingRates(timings, task, wordSize)
+    if len(rates) < MIN_TIMINGS:
+        return None
+    return float(np.median(rates)) * queryLetters * dbLetters
+
+def chooseSearchParameters(isProtein, minIdentity, queryLengths, dbLetters, maxThreads, timings):
+    '''Chooses the task, word size and threads of a search. The candidates come from the target identity and the
+    shortest query; if all of them have enough recorded timings, the fastest predicted is chosen. Otherwise the
+    candidate with fewest timings is explored (the preferred one on ties), so that every candidate gets timed and
+    can be compared. Returns the decision as a dictionary, including its reason and predictions for review'''
+    queryLength = min(queryLengths) if queryLengths else 0
+    candidates = getCandidateTasks(isProtein, minIdentity, queryLength)
+    threads = getSearchThreads(maxThreads, dbLetters, len(queryLengths))
+    predictions = []
+    for task, wordSize in candidates:
+        seconds = predictSeconds(timings, task, wordSize, sum(queryLengths), dbLetters)
+        predictions.append(None if seconds is None else seconds / threads)
+
+    if len(candidates) > 1 and None not in predictions:
+        bestIdx = int(np.argmin(predictions))
+        reason = 'fastest of the candidates in the recorded timings'
+    elif len(candidates) > 1:
+        nTimings = [len(getTimingRates(timings, task, wordSize)) for task, wordSize in candidates]
+        bestIdx = int(np.argmin(nTimings))
+        reason = 'exploring the candidate with fewest recorded timings ({} of the {} needed to compare)'.\
+            format(nTimings[bestIdx], MIN_TIMINGS)
+    else:
+        bestIdx, reason = 0, 'only candidate'
+    task, wordSize = candidates[bestIdx]
+    return {'task': task, 'wordSize': wordSize, 'threads': threads, 'reason': reason,
+            'minIdentity': minIdentity, 'shortestQuery': queryLength, 'nQueries': len(queryLengths),
+            'dbLetters': dbLetters, 'candidates': ['{} (word {})'.format(*c) for c in candidates],
+            'predictedSeconds': predictions}
@@ -23,3 +23,990 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+
+import os, re, subprocess, hashlib, json, shutil, time, glob, itertools
+import numpy as np
+
+from .constants import HIT_TABLE_DTYPE, HIT_TABLE_FIELDS, BTOP_DTYPE, PAIR_TABLE_DTYPE, SW_SCORE_DTYPE, \
+    DATABASE_DTYPE, HIT_INDEX_DTYPE, ALLOWED_BLAST_GAPS, blastnMM
+
+
+# ---------------------------------- BLAST programs  -----------------------
+def getBLASTProgramArgs(subprogram):
+    '''Returns the BLAST executable and the task arguments for a BLAST subprogram (e.g: megablast, psi-blast)'''
+    args = ''
+    if subprogram in ['blastx', 'tblastn', 'tblastx']:
+        program = subprogram
+    elif subprogram in ['psi-blast', 'delta-blast']:
+        program = subprogram.replace('-', '')
+    elif subprogram in ['blastp', 'blastp-fast']:
+        program = 'blastp'
+        args += ' -task {}'.format(subprogram)
+    elif subprogram in ['blastn', 'megablast', 'dc-megablast']:
+        program = 'blastn'
+        args += ' -task {}'.format(subprogram)
+    else:
+        raise ValueError('Unknown BLAST program: {}'.format(subprogram))
+    return program, args
+
+
+# ---------------------------------- Hit tables  -----------------------
+def getHitTableOutfmt(btop=False):
+    '''Returns the BLAST -outfmt value that writes the columns of the hit table, optionally with the BTOP
+    (blast traceback operations) of each alignment as last column'''
+    return '6 {}'.format(' '.join(HIT_TABLE_FIELDS + (['btop'] if btop else [])))
+
+def getFittedDtype(dtype, values):
+    '''Returns the fields [(name, type)] of a structured dtype with its unicode fields widened to fit the given
+    strings {fieldName: strings}, so that long sequence ids or labels are not truncated to the default width'''
+    dtype, fields = np.dtype(dtype), []
+    for name in dtype.names:
+        fieldType = dtype[name]
+        if fieldType.kind == 'U' and name in values:
+            width = max([len(value) for value in values[name]], default=0)
+            fieldType = np.dtype('U{}'.format(max(fieldType.itemsize // 4, width)))
+        fields.append((name, fieldType))
+    return fields
+
+def parseHitTable(tabFile, btop=False):
+    '''Parses a BLAST tabular output (written with getHitTableOutfmt) into a numpy structured array.
+    The string columns are as wide as the longest value. If btop, the BTOP strings are kept in an object column'''
+    dtype = HIT_TABLE_DTYPE + ([('btop', 'O')] if btop else [])
+    if not os.path.exists(tabFile) or os.path.getsize(tabFile) == 0:
+        return np.zeros(0, dtype=dtype)
+    with open(tabFile) as f:
+        lines = [line for line in f if line.strip() and not line.startswith('#')]
+    if not lines:
+        return np.zeros(0, dtype=dtype)
+    rows = [line.rstrip('\n').split('\t') for line in lines]
+    dtype = getFittedDtype(dtype, {name: [row[i] for row in rows if len(row) > i]
+                                   for i, (name, _) in enumerate(dtype)})
+    return np.loadtxt(lines, dtype=dtype, delimiter='\t', ndmin=1)
+
+def getHitTableSideFile(npyFile, ext):
+    return os.path.splitext(npyFile)[0] + '.' + ext
+
+def writeHitTable(hits, npyFile):
+    '''Saves a hit table as a .npy file, which can be memory-mapped when loaded.
+    The BTOP strings of a "btop" column are concatenated in a side .btop file and replaced by their positions'''
+    if hits.dtype.names and 'btop' in hits.dtype.names:
+        btops = [btop.encode() for btop in hits['btop']]
+        lengths = np.array([len(btop) for btop in btops], dtype='i4')
+        with open(getHitTableSideFile(npyFile, 'btop'), 'wb') as f:
+            f.write(b''.join(btops))
+
+        names = [name for name in hits.dtype.names if name != 'btop']
+        outHits = np.zeros(len(hits), dtype=[(name, hits.dtype[name]) for name in names] + BTOP_DTYPE)
+        for name in names:
+            outHits[name] = hits[name]
+        outHits['btopStart'], outHits['btopLength'] = np.cumsum(lengths) - lengths, lengths
+        hits = outHits
+    np.save(npyFile, hits, allow_pickle=False)
+    return npyFile
+
+def loadHitTable(npyFile, mmap=True, btop=False):
+    '''Loads a hit table. If mmap, the columns are lazily read from disk when accessed.
+    If btop, the BTOP strings are read in memory as a "btop" column, as returned by parseHitTable'''
+    hits = np.load(npyFile, mmap_mode='r' if mmap and not btop else None, allow_pickle=False)
+    if btop and 'btopStart' in hits.dtype.names:
+        names = [name for name in hits.dtype.names if name not in ['btopStart', 'btopLength']]
+        outHits = np.zeros(len(hits), dtype=[(name, hits.dtype[name]) for name in names] + [('btop', 'O')])
+        for name in names:
+            outHits[name] = hits[name]
+        outHits['btop'] = readBtops(npyFile, hits)
+        hits = outHits
+    return hits
+
+def readBtops(npyFile, hits):
+    '''Reads the BTOP strings of the given hits (rows of the loaded table) from the side file of the hit table'''
+    btopFile = getHitTableSideFile(npyFile, 'btop')
+    if len(hits) == 0 or os.path.getsize(btopFile) == 0:
+        return [''] * len(hits)
+    blob = np.memmap(btopFile, dtype='u1', mode='r')
+    return [blob[start:start + length].tobytes().decode()
+            for start, length in zip(hits['btopStart'], hits['btopLength'])]
+
+def addHitColumn(hits, columnDtype, values):
+    '''Returns a copy of the hits with a new column (replacing it if already present). columnDtype: [(name, type)]'''
+    newName = columnDtype[0][0]
+    columnDtype = getFittedDtype(columnDtype, {newName: [values] if isinstance(values, str) else values})
+    names = [name for name in hits.dtype.names if name != newName]
+    outHits = np.zeros(len(hits), dtype=[(name, hits.dtype[name]) for name in names] + columnDtype)
+    for name in names:
+        outHits[name] = hits[name]
+    outHits[newName] = values
+    return outHits
+
+def filterHits(hits, maxEvalue=None, minIdentity=None, minBitscore=None, minLength=None, queryId=None):
+    '''Returns the hits passing all the specified thresholds, using vectorized masks over the table columns'''
+    mask = np.ones(len(hits), dtype=bool)
+    if maxEvalue is not None:
+        mask &= hits['evalue'] <= maxEvalue
+    if minIdentity is not None:
+        mask &= hits['pident'] >= minIdentity
+    if minBitscore is not None:
+        mask &= hits['bitscore'] >= minBitscore
+    if minLength is not None:
+        mask &= hits['length'] >= minLength
+    if queryId is not None:
+        mask &= hits['qseqid'] == queryId
+    return hits[mask]
+
+
+def buildHitIndex(npyFile, queriesFile=None):
+    '''Writes the index of a hit table next to it: the rows of the hits sorted by evalue and bitscore, with their
+    scores, identity and query coverage (if the query sequences are given), so that sorted and filtered pages of
+    hits are read without loading the whole table'''
+    hits = loadHitTable(npyFile)
+    index = np.zeros(len(hits), dtype=HIT_INDEX_DTYPE)
+    index['row'] = np.lexsort((-hits['bitscore'], hits['evalue']))
+    for name in ['evalue', 'bitscore', 'pident']:
+        index[name] = hits[name][index['row']]
+
+    if queriesFile and os.path.exists(queriesFile) and len(hits) > 0:
+        queryLengths = {queryId: len(seq) for queryId, seq in readFasta(queriesFile).items()}
+        queryIds, inverse = np.unique(hits['qseqid'], return_inverse=True)
+        lengths = np.array([queryLengths.get(queryId, 0) for queryId in queryIds], dtype='f4')[inverse]
+        aligned = np.abs(hits['qend'] - hits['qstart']) + 1
+        coverage = np.divide(100 * aligned, lengths, out=np.zeros(len(hits), dtype='f4'), where=lengths > 0)
+        index['coverage'] = np.minimum(coverage, 100)[index['row']]
+
+    np.save(getHitTableSideFile(npyFile, 'index.npy'), index, allow_pickle=False)
+    return index
+
+def loadHitIndex(npyFile, queriesFile=None):
+    '''Loads (memory-mapped) the index of a hit table, building it if missing or older than the table'''
+    indexFile = getHitTableSideFile(npyFile, 'index.npy')
+    if not os.path.exists(indexFile) or os.path.getmtime(indexFile) < os.path.getmtime(npyFile):
+        buildHitIndex(npyFile, queriesFile)
+    return np.load(indexFile, mmap_mode='r', allow_pickle=False)
+
+def getHitPage(npyFile, page=0, pageSize=100, sortBy='evalue', minIdentity=None, minCoverage=None,
+               queriesFile=None):
+    '''Returns a page of hits sorted by evalue or bitscore (sortBy) and filtered by identity and query coverage,
+    using the hit index. Only the rows of the page are read from the table.
+    Returns the hits of the page, their query coverage and the number of hits passing the filters'''
+    index = loadHitIndex(npyFile, queriesFile)
+    if minIdentity or minCoverage:
+        mask = np.ones(len(index), dtype=bool)
+        if minIdentity:
+            mask &= index['pident'] >= minIdentity
+        if minCoverage:
+            mask &= index['coverage'] >= minCoverage
+        index = index[mask]
+    if sortBy == 'bitscore':
+        index = index[np.argsort(-index['bitscore'], kind='stable')]
+
+    pageIndex = index[page * pageSize:(page + 1) * pageSize]
+    return loadHitTable(npyFile)[pageIndex['row']], np.array(pageIndex['coverage']), len(index)
+
+# ---------------------------------- Compact alignments  -----------------------
+def getAlignedQuerySegment(querySeq, qstart, qend, translate=False):
+    '''Returns the query residues covered by an alignment, reverse complemented for minus strand queries and
+    translated for translated searches (blastx, tblastx)'''
+    segment = querySeq[min(qstart, qend) - 1: max(qstart, qend)]
+    if qstart > qend or translate:
+        from Bio.Seq import Seq
+        segment = Seq(segment)
+        if qstart > qend:
+            segment = segment.reverse_complement()
+        if translate:
+            segment = segment.translate()
+        segment = str(segment)
+    return segment
+
+def getAlignedStrings(querySeq, qstart, qend, btop, translate=False):
+    '''Rebuilds the gapped query and subject strings of an alignment from the query sequence and its BTOP:
+    numbers are runs of identical residues and pairs of characters are the query and subject residues of a
+    substitution or gap ("-")'''
+    segment = getAlignedQuerySegment(querySeq, qstart, qend, translate)
+    queryParts, subjectParts, pos = [], [], 0
+    for op in re.findall(r'\d+|\D\D', btop):
+        if op.isdigit():
+            queryParts.append(segment[pos:pos + int(op)])
+            subjectParts.append(queryParts[-1])
+            pos += int(op)
+        else:
+            queryParts.append(op[0])
+            subjectParts.append(op[1])
+            pos += op[0] != '-'
+    return ''.join(queryParts), ''.join(subjectParts)
+
+
+def expandBtops(btops, qstarts):
+    '''Expands the BTOP of several alignments into aligned columns, with vectorized operations over all of them.
+    Returns the arrays (hitIdx, queryPos, subjectChar, insertionIdx) of the columns: 0-based query position
+    (of the previous query residue for insertions), subject character (b"" if identical to the query) and index of
+    the column in its insertion run (-1 if not an insertion)'''
+    tokens = [re.findall(r'\d+|\D\D', btop) for btop in btops]
+    nTokens = np.array([len(hitTokens) for hitTokens in tokens], dtype=int)
+    tokens = np.array([token for hitTokens in tokens for token in hitTokens], dtype='U')
+    if len(tokens) == 0:
+        return [np.zeros(0, dtype=dtype) for dtype in [int, int, 'S1', int]]
+
+    isRun = np.char.isdigit(tokens)
+    runLengths = np.ones(len(tokens), dtype=int)
+    runLengths[isRun] = tokens[isRun].astype(int)
+    pairChars = tokens[~isRun].astype('U2').view('U1').reshape(-1, 2)
+    queryChars, subjectChars = np.full(len(tokens), '', dtype='U1'), np.full(len(tokens), b'', dtype='S1')
+    queryChars[~isRun], subjectChars[~isRun] = pairChars[:, 0], pairChars[:, 1].astype('S1')
+
+    colTokens = np.repeat(np.arange(len(tokens)), runLengths)
+    hitIdxs = np.repeat(np.repeat(np.arange(len(nTokens)), nTokens), runLengths)
+    consumes = queryChars[colTokens] != '-'
+    # query positions advance with each consumed residue, restarting at the qstart of each hit
+    consumed = np.cumsum(consumes)
+    hitFirstCols = np.searchsorted(hitIdxs, np.arange(len(nTokens)))
+    hitOffsets = np.concatenate([[0], consumed])[hitFirstCols]
+    queryPos = np.asarray(qstarts, dtype=int)[hitIdxs] - 2 + consumed - hitOffsets[hitIdxs]
+
+    colIdxs = np.arange(len(colTokens))
+    lastConsumed = np.maximum.accumulate(np.where(consumes, colIdxs, -1))
+    insertionIdxs = np.where(consumes, -1, colIdxs - lastConsumed - 1)
+    return hitIdxs, queryPos, subjectChars[colTokens], insertionIdxs
+
+def buildQueryAnchoredMSA(querySeq, qstarts, btops):
+    '''Builds the query-anchored multiple alignment of the hits of a query, filling a preallocated character
+    matrix (query + hits x aligned columns) in vectorized steps. Residues inserted in the hits get their own columns,
+    gapped in the rest of rows. Returns the matrix (numpy "S1" array)'''
+    query = np.frombuffer(querySeq.encode(), dtype='S1')
+    hitIdxs, queryPos, subjectChars, insertionIdxs = expandBtops(btops, qstarts)
+    isInsertion = insertionIdxs >= 0
+
+    # Columns of each query residue, leaving room for the longest insertion after it
+    insertionCols = np.zeros(len(query) + 1, dtype=int)
+    np.maximum.at(insertionCols, queryPos[isInsertion] + 1, insertionIdxs[isInsertion] + 1)
+    queryCols = np.arange(len(query)) + np.cumsum(insertionCols[:len(query)])
+    nCols = len(query) + insertionCols.sum()
+
+    msa = np.full((len(btops) + 1, nCols), b'-', dtype='S1')
+    msa[0, queryCols] = query
+    anchorCols = queryCols[np.clip(queryPos, 0, len(query) - 1)]
+    cols = np.where(isInsertion, anchorCols + 1 + insertionIdxs, anchorCols)
+    chars = np.where(subjectChars == b'', query[np.clip(queryPos, 0, len(query) - 1)], subjectChars)
+    msa[hitIdxs + 1, cols] = chars
+    return msa
+
+def writeMSA(names, msa, outFile, fmt='fasta', lineLength=60):
+    '''Writes the rows of an alignment matrix (as built by buildQueryAnchoredMSA) in FASTA or Clustal format'''
+    rows = msa.view('S{}'.format(msa.shape[1])).ravel() if msa.shape[1] > 0 else [b''] * len(names)
+    with open(outFile, 'w') as f:
+        if fmt == 'fasta':
+            for name, row in zip(names, rows):
+                f.write('>{}\n{}\n'.format(name, row.decode()))
+        else:
+            f.write('CLUSTAL W multiple sequence alignment\n\n')
+            nameLength = max(len(name) for name in names) + 4
+            for start in range(0, msa.shape[1], lineLength):
+                for name, row in zip(names, rows):
+                    f.write('{}{}\n'.format(name.ljust(nameLength), row[start:start + lineLength].decode()))
+                f.write('\n')
+    return outFile
+
+
+# ---------------------------------- Query deduplication  -----------------------
+def groupIdenticalSequences(sequences):
+    '''Groups the sequences by a hash of their content.
+    Returns a list of [sequence, [indexes of its copies]] for the unique sequences, in order of appearance'''
+    groups = {}
+    for i, seq in enumerate(sequences):
+        key = hashlib.sha1(seq.upper().encode()).hexdigest()
+        groups.setdefault(key, [seq, []])[1].append(i)
+    return list(groups.values())
+
+def fanOutHits(hits, groups):
+    '''Copies the hits of each searched query to all the original queries it represents.
+    groups: {searchedQueryId: [originalQueryIds]}. Queries not in groups keep their hits as they are'''
+    if len(hits) == 0:
+        return hits
+    labels, firstRows, inverse = np.unique(hits['qseqid'], return_index=True, return_inverse=True)
+    labelNames = [groups.get(label, [label]) for label in labels]
+    rowCopies = np.array([len(names) for names in labelNames])[inverse]
+
+    outHits = np.repeat(hits.astype(getFittedDtype(hits.dtype, {'qseqid': itertools.chain(*labelNames)})), rowCopies)
+    rowIdxs, labelIdxs = np.repeat(np.arange(len(hits)), rowCopies), np.repeat(inverse, rowCopies)
+    copyIdxs = np.arange(len(outHits)) - np.repeat(np.cumsum(rowCopies) - rowCopies, rowCopies)
+    outHits['qseqid'] = [labelNames[labelIdx][copyIdx] for labelIdx, copyIdx in zip(labelIdxs, copyIdxs)]
+
+    #Hits grouped by original query, keeping the searched order
+    order = np.lexsort((rowIdxs, copyIdxs, firstRows[labelIdxs]))
+    return outHits[order]
+
+
+# ---------------------------------- Sequence retrieval  -----------------------
+def readFasta(fastaFile):
+    '''Returns a dictionary {seqId: sequence} from a fasta file, using the first word of the header as id'''
+    seqDic, seqId = {}, None
+    if not os.path.exists(fastaFile):
+        return seqDic
+    with open(fastaFile) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                seqId = line[1:].split()[0] if line[1:].strip() else ''
+                seqDic[seqId] = ''
+            elif seqId is not None:
+                seqDic[seqId] += line
+    return seqDic
+
+def writeFasta(seqDic, fastaFile, mode='w'):
+    with open(fastaFile, mode) as f:
+        for seqId, seq in seqDic.items():
+            f.write('>{}\n{}\n'.format(seqId, seq))
+    return fastaFile
+
+def getIdVariants(seqId):
+    '''Returns the forms a sequence id may take in the BLAST outputs: full id, pipe separated parts and
+    accessions with and without version'''
+    variants = {seqId}
+    for part in seqId.split('|'):
+        if part:
+            variants.add(part)
+            variants.add(part.split('.')[0])
+    return variants
+
+def mapToRequestedIds(ids, seqDic):
+    '''Maps the sequences retrieved by their database ids to the ids they were requested with'''
+    variantsDic = {}
+    for foundId, seq in seqDic.items():
+        for variant in getIdVariants(foundId):
+            variantsDic[variant] = seq
+
+    mapped = {}
+    for seqId in ids:
+        for variant in [seqId] + sorted(getIdVariants(seqId)):
+            if variant in variantsDic:
+                mapped[seqId] = variantsDic[variant]
+                break
+    return mapped
+
+def fetchLocalSequences(dbNames, ids, batchFile, cwd=None):
+    '''Retrieves the sequences of the ids from the local BLAST databases in a single blastdbcmd -entry_batch
+    call per database. Returns a dictionary {id: sequence} with the ids found'''
+    from blast import Plugin
+    if isinstance(dbNames, str):
+        dbNames = [dbNames]
+    cwd = cwd if cwd else Plugin.getDatabasesDir()
+
+    found, remaining = {}, list(ids)
+    for dbName in dbNames:
+        if not remaining:
+            break
+        with open(batchFile, 'w') as f:
+            f.write('\n'.join(remaining) + '\n')
+
+        # Entries not found are reported by blastdbcmd in stderr and do not stop the batch
+        cmd = [Plugin.getProgramPath('blastdbcmd'), '-db', dbName, '-entry_batch', os.path.abspath(batchFile),
+               '-outfmt', '%i %a %s']
+        res = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+        dbSeqs = {}
+        for line in res.stdout.split('\n'):
+            sline = line.split()
+            if len(sline) >= 2:
+                for foundId in sline[:-1]:
+                    dbSeqs[foundId] = sline[-1]
+
+        found.update(mapToRequestedIds(remaining, dbSeqs))
+        remaining = [seqId for seqId in remaining if seqId not in found]
+    return found
+
+def fetchRemoteSequences(ids, dbType='protein'):
+    '''Retrieves the sequences of the ids from NCBI in a single efetch call.
+    Returns a dictionary {id: sequence} with the ids found'''
+    if not ids:
+        return {}
+    return mapToRequestedIds(ids, parseFastaText(efetchFasta(ids, dbType)))
+
+def parseFastaText(fastaText):
+    '''Returns a dictionary {seqId: sequence} from the text of a fasta file'''
+    seqDic, seqId = {}, None
+    for line in fastaText.split('\n'):
+        line = line.strip()
+        if line.startswith('>'):
+            seqId = line[1:].split()[0] if line[1:].strip() else ''
+            seqDic[seqId] = ''
+        elif seqId is not None:
+            seqDic[seqId] += line
+    return seqDic
+
+def getCachedSequences(ids, cacheFile, dbName, remote=False, isAmino=True):
+    '''Returns the sequences of the ids, fetching in bulk only those not already stored in the cache fasta file'''
+    cached = readFasta(cacheFile)
+    missing = [seqId for seqId in ids if seqId not in cached]
+    if missing:
+        if remote:
+            newSeqs = fetchRemoteSequences(missing, dbType='protein' if isAmino else 'nucleotide')
+        else:
+            newSeqs = fetchLocalSequences(dbName, missing, cacheFile + '.ids')
+        writeFasta(newSeqs, cacheFile, mode='a')
+        cached.update(newSeqs)
+    return {seqId: cached[seqId] for seqId in ids if seqId in cached}
+
+
+# ---------------------------------- Similarity matrices  -----------------------
+def exportIndexedFasta(sequences, fastaFile, prefix='seq_'):
+    '''Writes the sequences into a fasta file named by their index (prefix + index), which are safe ids for
+    makeblastdb -parse_seqids. Returns the list of original sequence names, in index order'''
+    names = []
+    with open(fastaFile, 'w') as f:
+        for i, seq in enumerate(sequences):
+            names.append(seq.getSeqName() or seq.getId() or '{}{}'.format(prefix, i))
+            f.write('>{}{}\n{}\n'.format(prefix, i, seq.getSequence()))
+    return names
+
+def getIndexedIds(seqIds, prefix='seq_'):
+    '''Returns the integer indexes of the ids written by exportIndexedFasta'''
+    return np.char.replace(np.asarray(seqIds, dtype=str), prefix, '').astype(np.int64)
+
+def getTriangularChunks(nSeqs, nChunks):
+    '''Splits nSeqs queries into nChunks (start, end) ranges of similar work when each query i is only searched
+    against the subjects j >= i'''
+    nChunks = max(1, min(nChunks, nSeqs))
+    limits = np.round(nSeqs * (1 - np.sqrt(1 - np.arange(nChunks + 1) / nChunks))).astype(int)
+    limits = np.unique(limits)
+    return [(int(start), int(end)) for start, end in zip(limits[:-1], limits[1:])]
+
+def buildSimilarityCoo(hits, symmetric=False, prefix='seq_'):
+    '''Builds the (row, col, bitscore, evalue) COO arrays from an all vs all hit table of indexed ids.
+    Self hits are skipped and only the best HSP of each pair is kept. If symmetric, the hits of each
+    pair are searched only once (j > i) and mirrored'''
+    rows, cols = getIndexedIds(hits['qseqid'], prefix), getIndexedIds(hits['sseqid'], prefix)
+    mask = rows != cols
+    if symmetric:
+        mask &= cols > rows
+    rows, cols, hits = rows[mask], cols[mask], hits[mask]
+
+    #Best HSP (highest bitscore) for each pair
+    order = np.argsort(-hits['bitscore'], kind='stable')
+    rows, cols, hits = rows[order], cols[order], hits[order]
+    nCols = cols.max() + 1 if len(cols) > 0 else 1
+    _, firstIdxs = np.unique(rows * nCols + cols, return_index=True)
+    rows, cols = rows[firstIdxs], cols[firstIdxs]
+    bitscores, evalues = hits['bitscore'][firstIdxs], hits['evalue'][firstIdxs]
+
+    if symmetric:
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        bitscores, evalues = np.concatenate([bitscores, bitscores]), np.concatenate([evalues, evalues])
+    return rows, cols, bitscores, evalues
+
+def writeSimilarityMatrix(npzFile, rows, cols, bitscores, evalues, names):
+    np.savez_compressed(npzFile, row=rows, col=cols, bitscore=bitscores, evalue=evalues,
+                        names=np.asarray(names, dtype=str))
+    return npzFile
+
+def loadSimilarityMatrix(npzFile, values='bitscore'):
+    '''Returns the similarity matrix of the specified values (bitscore or evalue) as a scipy.sparse COO matrix.
+    Pairs without hit are not stored, so evalue 0.0 entries are explicitly stored'''
+    from scipy.sparse import coo_matrix
+    with np.load(npzFile, allow_pickle=False) as data:
+        nSeqs = len(data['names'])
+        return coo_matrix((data[values], (data['row'], data['col'])), shape=(nSeqs, nSeqs))
+
+def loadSimilarityNames(npzFile):
+    with np.load(npzFile, allow_pickle=False) as data:
+        return list(data['names'])
+
+
+# ---------------------------------- Reciprocal best hits  -----------------------
+def getBestHits(hits):
+    '''Returns the best hit (highest bitscore, lowest evalue) of each query, one row per query'''
+    order = np.lexsort((hits['evalue'], -hits['bitscore']))
+    hits = hits[order]
+    _, firstIdxs = np.unique(hits['qseqid'], return_index=True)
+    return hits[np.sort(firstIdxs)]
+
+def getReciprocalBestHits(forwardHits, reverseHits):
+    '''Joins the forward (A vs B) and reverse (B vs A) searches into the pairs of sequences which are the best hit
+    of each other. The join uses hash indexed best hit tables. Returns a pair table'''
+    forwardBest, reverseBest = getBestHits(forwardHits), getBestHits(reverseHits)
+    reverseIndex = {qId: i for i, qId in enumerate(reverseBest['qseqid'])}
+
+    pairs = []
+    for fHit in forwardBest:
+        rIdx = reverseIndex.get(fHit['sseqid'])
+        if rIdx is not None and reverseBest['sseqid'][rIdx] == fHit['qseqid']:
+            rHit = reverseBest[rIdx]
+            pairs.append((fHit['qseqid'], fHit['sseqid'], fHit['bitscore'], fHit['evalue'],
+                          rHit['bitscore'], rHit['evalue']))
+    dtype = getFittedDtype(PAIR_TABLE_DTYPE, {'seqA': [pair[0] for pair in pairs], 'seqB': [pair[1] for pair in pairs]})
+    return np.array(pairs, dtype=dtype)
+
+
+# ---------------------------------- PSSM checkpoints  -----------------------
+def getDatabaseVersion(dbName, dbDir=None, remote=False):
+    '''Returns a version tag of a BLAST database. Local databases are versioned by the name, size and modification
+    time of their files. Remote databases are considered to change daily'''
+    if remote:
+        return 'remote-{}'.format(time.strftime('%Y-%m-%d'))
+    dbFiles = sorted(glob.glob(os.path.join(dbDir, dbName + '.*')))
+    signature = [(os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f))) for f in dbFiles]
+    return hashlib.sha1(json.dumps(signature).encode()).hexdigest()
+
+def getPSSMCacheKey(querySequence, dbName, dbVersion, params):
+    '''Returns the cache key of the PSSM checkpoints of a query built over a database with some parameters'''
+    keyDic = {'query': hashlib.sha256(querySequence.upper().encode()).hexdigest(), 'db': dbName,
+              'version': dbVersion, 'params': params}
+    return hashlib.sha256(json.dumps(keyDic, sort_keys=True).encode()).hexdigest()
+
+def getCachedPSSMs(cacheDir):
+    '''Returns a dictionary {nRounds: pssmFile} with the checkpoints stored in a PSSM cache directory'''
+    cached = {}
+    for pssmFile in glob.glob(os.path.join(cacheDir, 'round_*.pssm')):
+        cached[int(os.path.basename(pssmFile).split('_')[1].split('.')[0])] = pssmFile
+    return cached
+
+def storePSSMCheckpoints(prefix, cacheDir, prevRounds=0):
+    '''Moves the checkpoints saved by psiblast -save_each_pssm (prefix.i, i being the iteration of that run) into the
+    cache directory, numbered by the total number of rounds they were built with'''
+    os.makedirs(cacheDir, exist_ok=True)
+    for pssmFile in glob.glob(prefix + '.*'):
+        iteration = pssmFile.split('.')[-1]
+        if iteration.isdigit():
+            nRounds = prevRounds + int(iteration)
+            shutil.move(pssmFile, os.path.join(cacheDir, 'round_{}.pssm'.format(nRounds)))
+            asciiFile = prefix + '_ascii.' + iteration
+            if os.path.exists(asciiFile):
+                shutil.move(asciiFile, os.path.join(cacheDir, 'round_{}.asnt'.format(nRounds)))
+
+
+# ---------------------------------- Database masks  -----------------------
+def splitFasta(fastaFile, nChunks, outPattern):
+    '''Splits a fasta file into nChunks files of similar total length (outPattern.format(chunkIdx)).
+    Returns the list of chunk files'''
+    seqDic = readFasta(fastaFile)
+    nChunks = max(1, min(nChunks, len(seqDic)))
+    chunkLetters, chunkSeqs = [0] * nChunks, [{} for _ in range(nChunks)]
+    for seqId in sorted(seqDic, key=lambda x: -len(seqDic[x])):
+        chunkIdx = chunkLetters.index(min(chunkLetters))
+        chunkSeqs[chunkIdx][seqId] = seqDic[seqId]
+        chunkLetters[chunkIdx] += len(seqDic[seqId])
+    return [writeFasta(seqs, outPattern.format(i)) for i, seqs in enumerate(chunkSeqs)]
+
+def getDatabaseMaskAlgorithms(dbName, cwd=None):
+    '''Returns a dictionary {algorithmName: algorithmID} with the masks stored in a local BLAST database'''
+    from blast import Plugin
+    cwd = cwd if cwd else Plugin.getDatabasesDir()
+    res = subprocess.run([Plugin.getProgramPath('blastdbcmd'), '-db', dbName, '-info'], cwd=cwd,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    algorithms, read = {}, False
+    for line in res.stdout.split('\n'):
+        if line.startswith('Available filtering algorithms'):
+            read = True
+        elif read:
+            sline = line.split()
+            if len(sline) >= 2 and sline[0].isdigit():
+                algorithms[sline[1]] = int(sline[0])
+            elif line.strip() and not line.strip().startswith('Algorithm'):
+                read = False
+    return algorithms
+
+
+# ---------------------------------- Multi-database search  -----------------------
+def getDatabaseLetters(dbName, cwd=None):
+    '''Returns the total number of letters (residues or bases) of a local BLAST database, 0 if it cannot be read'''
+    from blast import Plugin
+    cwd = cwd if cwd else Plugin.getDatabasesDir()
+    res = subprocess.run([Plugin.getProgramPath('blastdbcmd'), '-db', dbName, '-info'], cwd=cwd,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    match = re.search(r'([\d,]+) sequences; ([\d,]+) total', res.stdout)
+    return int(match.group(2).replace(',', '')) if match else 0
+
+def mergeDatabaseHits(dbHits, dbNames):
+    '''Merges the hits of the same queries searched in several databases into a single ranking, recording the source
+    database of each hit in a "database" column. The hits of each query are sorted by evalue, which are comparable
+    when the searches share the same search space (-dbsize). Queries keep the order in which they appear'''
+    hits = np.concatenate([addHitColumn(hits, DATABASE_DTYPE, dbName) for hits, dbName in zip(dbHits, dbNames)])
+    if len(hits) == 0:
+        return hits
+    _, firstIdxs, inverse = np.unique(hits['qseqid'], return_index=True, return_inverse=True)
+    return hits[np.lexsort((-hits['bitscore'], hits['evalue'], firstIdxs[inverse]))]
+
+
+# ---------------------------------- Parameter sweeps  -----------------------
+def splitGridValues(text):
+    '''Values of a comma separated grid parameter, [''] (BLAST default) if empty'''
+    values = [value.strip() for value in text.split(',') if value.strip()]
+    return values or ['']
+
+def getParameterGrid(gridValues):
+    '''All the combinations of the grid values {parName: [values]}, as a list of {parName: value}'''
+    names = list(gridValues)
+    return [dict(zip(names, combo)) for combo in itertools.product(*[gridValues[name] for name in names])]
+
+def getCombinationErrors(combo, program):
+    '''Returns the problems of a combination of parameters (evalue, word_size, gaps, matrix or matchMismatch) for
+    a BLAST program, checking the scoring and gap costs accepted by BLAST (ALLOWED_BLAST_GAPS, blastnMM)'''
+    errors = []
+    for parName in ['evalue', 'word_size']:
+        try:
+            if combo[parName]:
+                float(combo[parName])
+        except ValueError:
+            errors.append('{} {} is not a number'.format(parName, combo[parName]))
+
+    # Gap costs without scoring are checked against the default scoring of the program
+    defScoring = {'blastp': 'BLOSUM62', 'blastp-fast': 'BLOSUM62', 'megablast': '1/-2'}.get(program, '2/-3')
+    scoring = combo.get('matrix') if program in ['blastp', 'blastp-fast'] else combo.get('matchMismatch')
+    scoring = scoring or defScoring
+    if program not in ['blastp', 'blastp-fast'] and scoring not in blastnMM:
+        errors.append('match/mismatch {} is not one of {}'.format(scoring, blastnMM))
+    elif scoring not in ALLOWED_BLAST_GAPS:
+        errors.append('unknown scoring matrix {}'.format(scoring))
+    elif combo['gaps'] and combo['gaps'] not in ALLOWED_BLAST_GAPS[scoring]:
+        errors.append('gap costs {} not allowed with {} (allowed: {})'.
+                      format(combo['gaps'], scoring, ALLOWED_BLAST_GAPS[scoring]))
+
+    if combo['word_size'] and not errors:
+        wordSize = float(combo['word_size'])
+        if program in ['blastp', 'blastp-fast'] and not 2 <= wordSize < 8:
+            errors.append('protein word size must be between 2 and 7')
+        elif program == 'dc-megablast' and wordSize not in [11, 12]:
+            errors.append('dc-megablast word size must be 11 or 12')
+        elif program in ['blastn', 'megablast'] and wordSize < 4:
+            errors.append('nucleotide word size must be at least 4')
+    return errors
+
+def getCombinationArgs(combo):
+    '''BLAST arguments of a combination of sweep parameters. Empty values keep the BLAST defaults'''
+    args = ''
+    for parName in ['evalue', 'word_size', 'matrix']:
+        if combo.get(parName):
+            args += ' -{} {}'.format(parName, combo[parName])
+    if combo.get('gaps'):
+        args += ' -gapopen {} -gapextend {}'.format(*combo['gaps'].split('/'))
+    if combo.get('matchMismatch'):
+        args += ' -reward {} -penalty {}'.format(*combo['matchMismatch'].split('/'))
+    return args
+
+def getPairOverlaps(hitTables):
+    '''Jaccard overlap between the query-subject pairs found by each hit table, as a square matrix'''
+    pairSets = [set(zip(hits['qseqid'], hits['sseqid'])) for hits in hitTables]
+    overlaps = np.ones((len(pairSets), len(pairSets)), dtype=np.float32)
+    for i, j in itertools.combinations(range(len(pairSets)), 2):
+        union = len(pairSets[i] | pairSets[j])
+        overlaps[i, j] = overlaps[j, i] = len(pairSets[i] & pairSets[j]) / union if union else 1.0
+    return overlaps
+
+def writeSweepTable(npzFile, table, overlaps):
+    np.savez_compressed(npzFile, table=table, overlaps=overlaps)
+    return npzFile
+
+def loadSweepTable(npzFile):
+    '''Returns the comparison table and the overlaps matrix of a parameter sweep'''
+    with np.load(npzFile, allow_pickle=False) as data:
+        return data['table'], data['overlaps']
+
+# ---------------------------------- Query windows  -----------------------
+def getWindowStarts(seqLength, windowSize, overlap):
+    '''Returns the 0-based start positions of the overlapping windows covering a sequence'''
+    if windowSize <= 0 or seqLength <= windowSize:
+        return [0]
+    return list(range(0, seqLength - overlap, windowSize - overlap))
+
+def splitQueryWindows(seqDic, windowSize, overlap):
+    '''Splits the sequences in overlapping windows. Returns a list with the {seqId: segment} of each window,
+    so that each query appears only once per window'''
+    windows = []
+    for seqId, seq in seqDic.items():
+        for windowIdx, start in enumerate(getWindowStarts(len(seq), windowSize, overlap)):
+            if windowIdx == len(windows):
+                windows.append({})
+            windows[windowIdx][seqId] = seq[start:start + windowSize]
+    return windows
+
+def mergeWindowHits(windowHits, starts):
+    '''Maps the hits of each query window back to the query coordinates and merges the redundant HSPs found in the
+    overlaps: HSPs of the same query, subject, strand and diagonal with overlapping query ranges are reduced to the
+    best scored one. Returns the hits grouped by query and sorted by evalue'''
+    hits = []
+    for wHits, start in zip(windowHits, starts):
+        wHits = wHits.copy()
+        wHits['qstart'] += start
+        wHits['qend'] += start
+        hits.append(wHits)
+    hits = np.concatenate(hits) if hits else np.zeros(0, dtype=HIT_TABLE_DTYPE)
+    if len(hits) == 0:
+        return hits
+
+    minus = hits['send'] < hits['sstart']
+    diagonal = np.where(minus, hits['sstart'] + hits['qstart'], hits['sstart'] - hits['qstart'])
+    order = np.lexsort((hits['qstart'], diagonal, minus, hits['sseqid'], hits['qseqid']))
+    hits, diagonal, minus = hits[order], diagonal[order], minus[order]
+
+    sameDiagonal = (hits['qseqid'][1:] == hits['qseqid'][:-1]) & (hits['sseqid'][1:] == hits['sseqid'][:-1]) & \
+                   (minus[1:] == minus[:-1]) & (diagonal[1:] == diagonal[:-1])
+    overlapping = sameDiagonal & (hits['qstart'][1:] <= hits['qend'][:-1])
+    clusters = np.concatenate([[0], np.cumsum(~overlapping)])
+
+    bestFirst = np.lexsort((-hits['bitscore'], clusters))
+    _, firstIdxs = np.unique(clusters[bestFirst], return_index=True)
+    hits = hits[bestFirst[firstIdxs]]
+
+    _, queryRanks = np.unique(hits['qseqid'], return_inverse=True)
+    return hits[np.lexsort((-hits['bitscore'], hits['evalue'], queryRanks))]
+
+
+# ---------------------------------- Chunk checkpoints  -----------------------
+def getDoneMarker(outFile):
+    return outFile + '.done'
+
+def getQueriesKey(queryIds, sequences):
+    '''Key of the queries of a search: the ids of its batch and the sequences searched {label: sequence}.
+    Recorded in the completion markers, so that the output of a different group of queries is not reused'''
+    return hashlib.sha1(json.dumps([[str(objId) for objId in queryIds], sequences]).encode()).hexdigest()
+
+def markDone(outFile, **info):
+    '''Writes the completion marker of an output file, with its size and checksum, once the file is on disk.
+    The marker is replaced atomically, so it is either absent or complete after a crash'''
+    from .store import getFileHash
+    with open(outFile, 'rb') as f:
+        os.fsync(f.fileno())
+    marker = dict(info, size=os.path.getsize(outFile), sha256=getFileHash(outFile))
+    tmpFile = getDoneMarker(outFile) + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump(marker, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpFile, getDoneMarker(outFile))
+    return marker
+
+def isDone(outFile, **info):
+    '''Whether an output file has a completion marker matching its current size and checksum, and the info it
+    was marked with (e.g: the key of the searched queries)'''
+    from .store import getFileHash
+    if not os.path.exists(outFile) or not os.path.exists(getDoneMarker(outFile)):
+        return False
+    try:
+        with open(getDoneMarker(outFile)) as f:
+            marker = json.load(f)
+    except ValueError:
+        return False
+    if any(marker.get(key) != value for key, value in info.items()):
+        return False
+    return marker.get('size') == os.path.getsize(outFile) and marker.get('sha256') == getFileHash(outFile)
+
+def mergeDoneFiles(chunkFiles, outFile, **info):
+    '''Concatenates the output files of the chunks of a task, checking first that all of them are complete,
+    and marks the merged file as done with the given info'''
+    missing = [chunkFile for chunkFile in chunkFiles if not isDone(chunkFile)]
+    if missing:
+        raise ValueError('{} out of {} chunks are not complete: {}'.
+                         format(len(missing), len(chunkFiles), ', '.join(os.path.basename(f) for f in missing)))
+    with open(outFile, 'wb') as fOut:
+        for chunkFile in chunkFiles:
+            with open(chunkFile, 'rb') as fIn:
+                shutil.copyfileobj(fIn, fOut)
+    return markDone(outFile, chunks=len(chunkFiles), **info)
+
+
+# ---------------------------------- NCBI web services  -----------------------
+RETRY_CODES = [429, 500, 502, 503, 504]
+
+def requestURL(url, data=None, retries=5, backoff=1.0, timeout=120):
+    '''Returns the content (bytes) of an HTTP request (POST if data). Throttled (429) and failed (5xx) requests,
+    connection errors, timeouts and broken responses (e.g: closed connection, incomplete read) are retried with
+    exponential backoff, waiting what the server asks in Retry-After if present'''
+    import socket, http.client
+    from urllib import request, error, parse
+    if isinstance(data, dict):
+        data = parse.urlencode(data).encode()
+    for attempt in range(retries + 1):
+        try:
+            with request.urlopen(url, data=data, timeout=timeout) as response:
+                return response.read()
+        except error.HTTPError as e:
+            if e.code not in RETRY_CODES or attempt == retries:
+                raise
+            retryAfter = e.headers.get('Retry-After')
+            wait = float(retryAfter) if retryAfter and retryAfter.replace('.', '', 1).isdigit() \
+                else backoff * 2 ** attempt
+        except (error.URLError, socket.timeout, TimeoutError, ConnectionError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+        time.sleep(wait)
+
+def eutilsRequest(tool, params, **kwargs):
+    '''Request to an NCBI E-utility (esearch, efetch, epost...) at the base URL configured in the plugin
+    (NCBI_EUTILS_URL). The parameters are sent by POST so that long id lists fit'''
+    from blast import Plugin
+    params = dict(params, tool='scipion-chem-blast')
+    if Plugin.getNCBIApiKey():
+        params['api_key'] = Plugin.getNCBIApiKey()
+    return requestURL('{}/{}.fcgi'.format(Plugin.getEutilsURL().rstrip('/'), tool), data=params, **kwargs)
+
+def esearchIds(dbName, term, retmax=20):
+    '''Returns the ids of the NCBI entries of a database matching a search term'''
+    jDic = json.loads(eutilsRequest('esearch', {'db': dbName, 'term': term, 'retmax': retmax, 'retmode': 'json'}))
+    return jDic['esearchresult']['idlist']
+
+def esearchPages(dbName, term, maxEntries, pageSize=500):
+    '''Generator of the pages of ids of the NCBI entries matching a search term, up to maxEntries.
+    The term is searched once and stored in the NCBI history server (usehistory), which also returns the first page
+    and the count. The next pages are read with retstart from the stored WebEnv / query_key (efetch of the id list),
+    so the search is not repeated and large searches are neither truncated nor held in memory'''
+    params = {'db': dbName, 'term': term, 'usehistory': 'y', 'retmode': 'json', 'retmax': min(pageSize, maxEntries)}
+    result = json.loads(eutilsRequest('esearch', params))['esearchresult']
+    count, ids = min(int(result.get('count', 0)), maxEntries), result['idlist'][:maxEntries]
+    pageParams = {'db': dbName, 'WebEnv': result.get('webenv'), 'query_key': result.get('querykey', '1'),
+                  'rettype': 'uilist', 'retmode': 'text'}
+    retstart = 0
+    while ids:
+        yield ids
+        retstart += len(ids)
+        if retstart >= count or not pageParams['WebEnv']:
+            break
+        pageParams['retstart'], pageParams['retmax'] = retstart, min(pageSize, count - retstart)
+        ids = eutilsRequest('efetch', pageParams).decode().split()
+
+def splitFastaRecords(fastaText):
+    '''Returns the texts of the records of a fasta text, in order'''
+    records = ('\n' + fastaText.strip()).split('\n>')[1:]
+    return ['>{}\n'.format(record.strip()) for record in records]
+
+def efetchFasta(ids, dbName):
+    '''Returns the text of the fasta records of the NCBI ids in a single efetch call'''
+    return eutilsRequest('efetch', {'db': dbName, 'id': ','.join(ids), 'rettype': 'fasta',
+                                    'retmode': 'text'}).decode()
+
+def efetchFastaRecords(ids, dbName):
+    '''Returns a dictionary {id: fasta record} of the NCBI ids. If some ids return no record, the records cannot be
+    matched by order and they are fetched one by one: the ids without record are not included'''
+    records = splitFastaRecords(efetchFasta(ids, dbName))
+    if len(records) == len(ids):
+        return dict(zip(ids, records))
+
+    idRecords = {}
+    for ncbiId in ids:
+        records = splitFastaRecords(efetchFasta([ncbiId], dbName))
+        if records:
+            idRecords[ncbiId] = records[0]
+    return idRecords
+
+def getPubChemSDFURL(cid, dim=3):
+    from blast import Plugin
+    return '{}/compound/CID/{}/record/SDF/?record_type={}d&response_type=save&response_basename=Conformer{}D_CID_{}'.\
+        format(Plugin.getPubChemURL().rstrip('/'), cid, dim, dim, cid)
+
+def fetchPubChemSDF(cid, outFile):
+    '''Downloads the 3D structure of a PubChem compound in SDF, or the 2D one if there is no 3D conformer.
+    Returns the file or None if the compound could not be downloaded'''
+    from urllib import error
+    for dim in [3, 2]:
+        try:
+            content = requestURL(getPubChemSDFURL(cid, dim))
+        except error.HTTPError:
+            continue
+        with open(outFile, 'wb') as f:
+            f.write(content)
+        return outFile
+
+
+# ---------------------------------- Smith-Waterman re-scoring  -----------------------
+NUCLEOTIDE_COMPLEMENT = str.maketrans('ACGTUNRYKMBVDHacgtunrykmbvdh', 'TGCAANYRMKVBHDtgcaanyrmkvbhd')
+
+def reverseComplement(sequence):
+    return sequence.translate(NUCLEOTIDE_COMPLEMENT)[::-1]
+
+def getSubstitutionMatrix(matrixName=None, reward=2, penalty=-3):
+    '''Returns the alphabet and integer score array of a scoring matrix (e.g: BLOSUM62) or, if no matrix name is
+    given, of the nucleotide match reward / mismatch penalty (N mismatching everything)'''
+    if matrixName:
+        from Bio.Align import substitution_matrices
+        matrix = substitution_matrices.load(matrixName)
+        return ''.join(matrix.alphabet), np.array(matrix, dtype=np.int32)
+    alphabet = 'ACGTN'
+    scores = np.where(np.eye(len(alphabet), dtype=bool), reward, penalty).astype(np.int32)
+    scores[-1, :] = scores[:, -1] = penalty
+    return alphabet, scores
+
+def encodeSequences(seqs, alphabet):
+    '''Returns the sequences as a zero-padded (nSeqs, maxLength) array of alphabet indexes and their lengths.
+    Letters out of the alphabet are encoded as X (proteins) or N (nucleotides)'''
+    unknown = next((alphabet.index(char) for char in 'XN' if char in alphabet), len(alphabet) - 1)
+    lookup = np.full(256, unknown, dtype=np.intp)
+    for i, char in enumerate(alphabet):
+        lookup[ord(char.upper())] = lookup[ord(char.lower())] = i
+
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.intp)
+    codes = np.zeros((len(seqs), max(1, lengths.max(initial=0))), dtype=np.intp)
+    for i, seq in enumerate(seqs):
+        codes[i, :len(seq)] = lookup[np.frombuffer(seq.encode('ascii', 'replace'), dtype=np.uint8)]
+    return codes, lengths
+
+def smithWatermanScores(queries, subjects, scores, alphabet, gapOpen, gapExtend):
+    '''Exact local alignment (Smith-Waterman-Gotoh) scores of the pairs queries[i] - subjects[i], with affine gaps
+    costing gapOpen + k * gapExtend for a gap of length k (BLAST convention).
+    The pairs are aligned at once, sweeping the anti-diagonals of their dynamic programming matrices: the cells of a
+    diagonal only depend on the two previous ones, so each step is computed for all the cells of all the pairs with
+    numpy operations. Only the last two diagonals are kept, indexed by the query position'''
+    if len(queries) == 0:
+        return np.zeros(0, dtype=np.int32)
+    qCodes, qLengths = encodeSequences(queries, alphabet)
+    sCodes, sLengths = encodeSequences(subjects, alphabet)
+    nPairs, m, n = len(queries), qCodes.shape[1], sCodes.shape[1]
+    minScore, openCost = np.int32(-2 ** 28), np.int32(gapOpen + gapExtend)
+
+    # Column 0 of the diagonals is the matrix border (query position 0)
+    qIdxs = np.arange(m + 1)
+    qCodes = np.hstack([np.zeros((nPairs, 1), dtype=np.intp), qCodes])
+    qValid = (qIdxs >= 1) & (qIdxs <= qLengths[:, None])
+
+    hPrev2 = np.zeros((nPairs, m + 1), dtype=np.int32)
+    hPrev, ePrev, fPrev = hPrev2.copy(), np.full_like(hPrev2, minScore), np.full_like(hPrev2, minScore)
+    border = np.zeros((nPairs, 1), dtype=np.int32)
+    best = np.zeros(nPairs, dtype=np.int32)
+    for diag in range(2, m + n + 1):
+        sIdxs = diag - qIdxs
+        valid = qValid & (sIdxs >= 1) & (sIdxs <= sLengths[:, None])
+        match = scores[qCodes, sCodes[:, np.clip(sIdxs - 1, 0, n - 1)]]
+
+        # E: gap in the query, from cell (i, j-1), same index. F: gap in the subject, from (i-1, j), previous index
+        e = np.maximum(hPrev - openCost, ePrev - gapExtend)
+        f = np.maximum(np.hstack([border, hPrev[:, :-1]]) - openCost,
+                       np.hstack([border + minScore, fPrev[:, :-1]]) - gapExtend)
+        h = np.maximum(np.maximum(np.hstack([border, hPrev2[:, :-1]]) + match, 0), np.maximum(e, f))
+
+        h[~valid], e[~valid], f[~valid] = 0, minScore, minScore
+        np.maximum(best, h.max(axis=1), out=best)
+        hPrev2, hPrev, ePrev, fPrev = hPrev, h, e, f
+    return best
+
+def rescoreTopHits(hits, querySeqs, subjectSeqs, nTop, matrixName=None, reward=2, penalty=-3, gapOpen=11,
+                   gapExtend=1, batchSize=128):
+    '''Returns the hits with a "swscore" column holding the exact Smith-Waterman score of the full query and subject
+    sequences for the nTop best subjects (by bitscore) of each query, NaN for the rest.
+    querySeqs, subjectSeqs: {seqId: sequence}. The pairs are aligned in batches of similar lengths to save padding.
+    With nucleotide scoring (no matrixName), the minus strand hits (send < sstart) of a subject are a different
+    pair, aligned against its reverse complement'''
+    outHits = addHitColumn(hits, SW_SCORE_DTYPE, np.nan)
+    if len(hits) == 0 or nTop <= 0:
+        return outHits
+
+    minus = hits['send'] < hits['sstart'] if not matrixName else np.zeros(len(hits), dtype=bool)
+    pairs = np.char.add(np.char.add(np.char.add(hits['qseqid'], '\t'), hits['sseqid']), np.where(minus, '\t-', ''))
+    uniquePairs, firstRows, inverse = np.unique(pairs, return_index=True, return_inverse=True)
+    bestScores = np.full(len(uniquePairs), -np.inf)
+    np.maximum.at(bestScores, inverse, hits['bitscore'])
+    pairQueries, pairSubjects, pairMinus = hits['qseqid'][firstRows], hits['sseqid'][firstRows], minus[firstRows]
+
+    # Rank of each pair among the pairs of its query, by decreasing bitscore
+    order = np.lexsort((-bestScores, pairQueries))
+    _, queryStarts, queryCounts = np.unique(pairQueries[order], return_index=True, return_counts=True)
+    ranks = np.empty(len(order), dtype=int)
+    ranks[order] = np.arange(len(order)) - np.repeat(queryStarts, queryCounts)
+
+    selected = [i for i in np.flatnonzero(ranks < nTop)
+                if pairQueries[i] in querySeqs and pairSubjects[i] in subjectSeqs]
+    selected.sort(key=lambda i: (len(querySeqs[pairQueries[i]]), len(subjectSeqs[pairSubjects[i]])))
+    alphabet, scores = getSubstitutionMatrix(matrixName, reward, penalty)
+    pairScores = np.full(len(uniquePairs), np.nan, dtype=np.float32)
+    for start in range(0, len(selected), batchSize):
+        batch = selected[start:start + batchSize]
+        subjects = [subjectSeqs[pairSubjects[i]] for i in batch]
+        subjects = [reverseComplement(subject) if pairMinus[i] else subject for i, subject in zip(batch, subjects)]
+        pairScores[batch] = smithWatermanScores([querySeqs[pairQueries[i]] for i in batch], subjects,
+                                                scores, alphabet, gapOpen, gapExtend)
+    outHits['swscore'] = pairScores[inverse]
+    return outHits
@@ -3,3 +3,5 @@
 # Module to declare viewers
 # Find documentation here: https://scipion-em.github.io/docs/docs/developer/creating-a-viewer
 # **************************************************************************
+
+from .viewer_blast_hits import BLASTHitsViewer
@@ -0,0 +1,110 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import pyworkflow.protocol.params as params
+from pyworkflow.viewer import ProtocolViewer, DESKTOP_TKINTER, TextView
+from pwem.viewers.views import TableView
+
+from ..protocols import ProtChemBLAST
+
+SORT_FIELDS = ['evalue', 'bitscore']
+HIT_COLUMNS = ['qseqid', 'sseqid', 'pident', 'length', 'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
+
+class BLASTHitsViewer(ProtocolViewer):
+    """Pages through the hits of a BLAST search, sorted and filtered with the index of the hit table so that only
+    the hits of the page are loaded. The alignments of the hits are rebuilt on demand"""
+    _label = 'BLAST hits viewer'
+    _targets = [ProtChemBLAST]
+    _environments = [DESKTOP_TKINTER]
+
+    def _defineParams(self, form):
+        form.addSection(label='Hits')
+        group = form.addGroup('Sorting and filters')
+        group.addParam('sortBy', params.EnumParam, default=0, choices=['Evalue', 'Bitscore'],
+                       display=params.EnumParam.DISPLAY_HLIST, label='Sort hits by: ')
+        group.addParam('minIdentity', params.FloatParam, default=0,
+                       label='Minimum identity (%): ', help='Only hits with this percentage of identity are shown')
+        group.addParam('minCoverage', params.FloatParam, default=0,
+                       label='Minimum query coverage (%): ',
+                       help='Only hits whose alignment covers this percentage of the query are shown')
+
+        group = form.addGroup('Pages')
+        group.addParam('pageSize', params.IntParam, default=100, label='Hits per page: ')
+        group.addParam('page', params.IntParam, default=1, label='Page: ')
+        group.addParam('displayHits', params.LabelParam, label='Display page of hits: ',
+                       help='Table with the hits of the page')
+        group.addParam('hitNumber', params.IntParam, default=1, label='Hit number: ',
+                       help='Position of the hit in the sorted and filtered hits (as in the "#" column)')
+        group.addParam('displayAlignment', params.LabelParam, label='Display alignment of the hit: ')
+
+    def _getVisualizeDict(self):
+        return {'displayHits': self._showHits,
+                'displayAlignment': self._showAlignment}
+
+    def _showHits(self, paramName=None):
+        if not hasattr(self.protocol, 'outputHitTable'):
+            return [self.errorMessage('The hit table is created when the search finishes')]
+
+        pageSize, page = max(1, self.pageSize.get()), max(1, self.page.get())
+        hits, coverages, nHits = self.getHitPage(page - 1, pageSize)
+        if len(hits) == 0:
+            return [self.infoMessage('No hit passes the filters in page {}'.format(page), title='BLAST hits')]
+
+        first = (page - 1) * pageSize + 1
+        dataList = [tuple([first + i] + [hit[column] for column in HIT_COLUMNS] + ['{:.1f}'.format(coverage)])
+                    for i, (hit, coverage) in enumerate(zip(hits, coverages))]
+        mesg = 'Hits {} to {} out of {} ({} pages)'.format(first, first + len(hits) - 1, nHits,
+                                                         (nHits - 1) // pageSize + 1)
+        return [TableView(headerList=['#'] + HIT_COLUMNS + ['coverage'], dataList=dataList, mesg=mesg,
+                          title='BLAST hits', height=min(len(hits), 30))]
+
+    def _showAlignment(self, paramName=None):
+        if not hasattr(self.protocol, 'outputHitTable'):
+            return [self.errorMessage('The hit table is created when the search finishes')]
+
+        hitNumber = self.hitNumber.get()
+        hits, _, nHits = self.getHitPage(hitNumber - 1, 1)
+        if len(hits) == 0:
+            return [self.errorMessage('Hit number must be between 1 and {}'.format(nHits))]
+
+        hit = hits[0]
+        querySeq, subjectSeq = self.protocol.outputHitTable.getAlignments(hits)[0]
+        alignFile = self.protocol._getExtraPath('viewerAlignment.txt')
+        with open(alignFile, 'w') as f:
+            f.write('Query: {} ({}-{})\nSubject: {} ({}-{})\nEvalue: {}  Bitscore: {}  Identity: {}%\n\n'.
+                    format(hit['qseqid'], hit['qstart'], hit['qend'], hit['sseqid'], hit['sstart'], hit['send'],
+                           hit['evalue'], hit['bitscore'], hit['pident']))
+            for start in range(0, len(querySeq), 60):
+                match = ''.join('|' if q == s else ' ' for q, s in zip(querySeq[start:start + 60],
+                                                                      subjectSeq[start:start + 60]))
+                f.write('Query    {}\n         {}\nSubject  {}\n\n'.
+                        format(querySeq[start:start + 60], match, subjectSeq[start:start + 60]))
+        return [TextView([alignFile], title='Alignment of hit {}'.format(hitNumber))]
+
+    def getHitPage(self, page, pageSize):
+        return self.protocol.outputHitTable.getHitPage(page, pageSize, sortBy=SORT_FIELDS[self.sortBy.get()],
+                                                       minIdentity=self.minIdentity.get(),
+                                                       minCoverage=self.minCoverage.get())
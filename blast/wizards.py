@@ -30,9 +30,11 @@ Wizard to show default values for a blast configuration
 """
 
 # Imports
+import json
 from pwem.wizards.wizard import EmWizard
-from pwchem.wizards import AddElementWizard
-from .protocols import ProtChemBLAST, ProtChemNCBIDownload
+
+from blast import Plugin
+from .protocols import ProtChemBLAST, ProtChemNCBIDownload, ProtChemBLASTSweep
 from .constants import DEF_BLAST_PARAMS
 
 class SetDefaultBLASTParameters(EmWizard):
@@ -42,39 +44,65 @@ class SetDefaultBLASTParameters(EmWizard):
         protocol = form.protocol
         form.setVar('evalue', 0.05)
 
-        blatsProgram = protocol.getSelectedBLASTProgram()
+        blatsProgram, tuning = protocol.getSelectedBLASTProgram(), None
+        if protocol.usesAutoTuning():
+            tuning = self.showAutoTuning(form)
+            blatsProgram = tuning['task']
         for attr in DEF_BLAST_PARAMS[blatsProgram]:
             form.setVar(attr, DEF_BLAST_PARAMS[blatsProgram][attr])
+        if tuning is not None:
+            form.setVar('word_size', str(tuning['wordSize']))
 
+    def showAutoTuning(self, form):
+        '''Sets the program that the automatic tuning would choose now for the first batch of queries.
+        Returns the tuning decision'''
+        from .utils import getDatabaseLetters
+        protocol = form.protocol
+        queries = list(protocol.getInputQueries().values())
+        batchSize = protocol.queryChunkSize.get() if protocol.queryChunkSize.get() > 0 else len(queries)
+        dbLetters = getDatabaseLetters(protocol.getDatabaseName()) if protocol.localSearch.get() else 0
+        tuning = protocol.chooseAutoTuning([len(query.getSequence()) for query in queries[:batchSize]],
+                                           dbLetters, protocol.getBatchThreads())
 
-class AddNCBI_ID_Wizard(AddElementWizard):
-    """Add ID or keyword in NCBI fetch protocol to the list"""
-    _targets, _inputs, _outputs = [], {}, {}
-
-    def show(self, form, *params):
-      inputParam, outputParam = self.getInputOutput(form)
-      protocol = form.protocol
-
-      inID = getattr(protocol, inputParam[0]).get()
-      searchMode = getattr(protocol, inputParam[2]).get()
-
-      if inID and inID.strip() != '':
-          prevList = self.curePrevList(getattr(protocol, outputParam[0]).get())
-
-          if searchMode == 0:
-              towrite = prevList + '{"ID": "%s"}\n' % (inID.strip())
-
-          else:
-              maxEntries = getattr(protocol, inputParam[1]).get()
-              if maxEntries:
-                  towrite = prevList + '{"ID": "%s", "maxEntries": "%s"}\n' % (inID.strip(), maxEntries)
-
-          form.setVar(outputParam[0], towrite)
+        isProtein = protocol.isProteinDatabase()
+        form.setVar('blastProteinProgram' if isProtein else 'blastNucleotideProgram',
+                    protocol.getBLASTProgramChoices(protein=isProtein).index(tuning['task']))
+        return tuning
 
 
-AddNCBI_ID_Wizard().addTarget(protocol=ProtChemNCBIDownload,
-                              targets=['addEntry'],
-                              inputs=['inputID', 'maxEntries', 'searchMode'],
-                              outputs=['listIDs'])
+class SelectLocalDatabaseWizard(EmWizard):
+    """Lists the local databases to choose the one to search. The databases directory is only read here and when
+    the protocol is validated, not when the protocol form is built"""
+    _targets = [(ProtChemBLAST, ['dbName']), (ProtChemBLASTSweep, ['dbName'])]
 
+    def show(self, form, *params):
+        from pyworkflow.gui.tree import ListTreeProviderString
+        from pyworkflow.gui import dialog
+        from pyworkflow.object import String
+        databases = Plugin.getLocalDatabases()
+        if not databases:
+            dialog.showInfo('Local databases', 'No database found in {}'.format(Plugin.getDatabasesDir()), form.root)
+            return
+        provider = ListTreeProviderString([String(dbName) for dbName in databases])
+        dlg = dialog.ListDialog(form.root, 'Local databases', provider, 'Select the database to search')
+        if dlg.resultYes() and dlg.values:
+            form.setVar('dbName', dlg.values[0].get())
+
+
+class AddNCBI_ID_Wizard(EmWizard):
+    """Add ID or keyword in NCBI fetch protocol to the list"""
+    _targets = [(ProtChemNCBIDownload, ['addEntry'])]
 
+    def show(self, form, *params):
+        protocol = form.protocol
+        inID = protocol.inputID.get()
+        if not inID or not inID.strip():
+            return
+
+        entry = {'ID': inID.strip()}
+        if protocol.searchMode.get() != 0:
+            if not protocol.maxEntries.get():
+                return
+            entry['maxEntries'] = str(protocol.maxEntries.get())
+        prevList = (protocol.listIDs.get() or '').strip()
+        form.setVar('listIDs', (prevList + '\n' if prevList else '') + json.dumps(entry) + '\n')